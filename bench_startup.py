@@ -0,0 +1,131 @@
+"""
+Startup-time benchmark: from importing the bot to the first handled update.
+
+Bot API calls are answered by an in-process stand-in session, so no network or
+real token is needed. Every run prints one JSON line with the timings of each
+stage; ``--output`` appends it to a file to track the numbers over time, and
+``--max-seconds`` makes the run fail when the total exceeds a budget.
+
+Usage::
+
+    python3 bench_startup.py --output bench_startup.jsonl --max-seconds 10
+"""
+
+import time
+
+STARTED = time.perf_counter()
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import json  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+from datetime import datetime, timezone  # noqa: E402
+from typing import List, Optional  # noqa: E402
+
+BENCH_TOKEN = "42:startup-benchmark"
+BENCH_USER = {"id": 1, "is_bot": False, "first_name": "Bench"}
+BENCH_CHAT = {"id": 1, "type": "private"}
+
+
+def _make_update(update_id: int, text: str):
+    from aiogram.types import Update
+
+    return Update.model_validate(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": BENCH_CHAT,
+                "from": BENCH_USER,
+                "text": text,
+            },
+        }
+    )
+
+
+def _make_session():
+    from aiogram.client.session.base import BaseSession
+
+    class StubSession(BaseSession):
+        """Answers every Bot API call without touching the network."""
+
+        async def make_request(self, bot, method, timeout=None):
+            return None
+
+        async def stream_content(
+            self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True
+        ):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return StubSession()
+
+
+async def _run() -> dict:
+    timings = {}
+    import bot as bot_module
+
+    timings["import"] = time.perf_counter() - STARTED
+
+    mark = time.perf_counter()
+    from session import SessionStore
+
+    bot = bot_module.create_bot(BENCH_TOKEN, session=_make_session())
+    dp = bot_module.create_dispatcher(
+        sessions=SessionStore(cold_dir=tempfile.mkdtemp())
+    )
+    timings["create_app"] = time.perf_counter() - mark
+
+    mark = time.perf_counter()
+    await dp.feed_update(bot, _make_update(1, "/start"))
+    timings["first_update"] = time.perf_counter() - mark
+
+    mark = time.perf_counter()
+    await dp.feed_update(bot, _make_update(2, "🐱 Karnaks Puck"))
+    await dp.feed_update(bot, _make_update(3, "☕ Thermomug"))
+    await dp.feed_update(bot, _make_update(4, "🎮 Start Game"))
+    timings["first_game"] = time.perf_counter() - mark
+    if not dp["sessions"][BENCH_USER["id"]].in_game:
+        raise RuntimeError("The benchmark game did not start.")
+
+    timings["total"] = time.perf_counter() - STARTED
+    return timings
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Measure bot startup time.")
+    parser.add_argument(
+        "--output", help="append the result as a JSON line to this file"
+    )
+    parser.add_argument(
+        "--max-seconds", type=float, help="fail if the total time exceeds this budget"
+    )
+    args = parser.parse_args(argv)
+
+    timings = asyncio.run(_run())
+    result = {
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        **{stage: round(seconds, 4) for stage, seconds in timings.items()},
+    }
+    line = json.dumps(result)
+    print(line)
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(line + "\n")
+
+    if args.max_seconds is not None and timings["total"] > args.max_seconds:
+        print(
+            f"Startup took {timings['total']:.2f}s, over the {args.max_seconds}s budget.",
+            file=sys.stderr,
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
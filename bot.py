@@ -1,19 +1,68 @@
 """
 Telegram bot on aiogram and asyncio for play in s21_school text game
+
+Importing this module only declares the handlers with :func:`on`. The bot, the
+dispatcher, the game catalog and the keyboards are built explicitly by
+:func:`create_bot` and :func:`create_dispatcher`, so the handlers can be
+imported in tests and worker processes without side effects. The subsystems
+(sessions, statistics, broadcasts, tracing and so on) are imported by the
+factory or setup function that enables them.
 """
 
-from aiogram import Bot, Dispatcher, types
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from __future__ import annotations
+
+from aiogram import Bot, Dispatcher, F, Router, types
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from aiogram.filters import Command, CommandObject, Filter, or_f
+from aiogram.types import FSInputFile, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram import F
-from load_data import init_game_elements
-from load_map import init_start_location, load_map
 import asyncio
 import logging
 import io
 import os
 import contextlib
-from colorlog import ColoredFormatter
+import functools
+import json
+import multiprocessing
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple, Union
+
+if TYPE_CHECKING:
+    from broadcast import Broadcaster
+    from diagnostics import AllocationTracker
+    from health import HealthServer
+    from inline import InlineSearch
+    from leaderboard import Leaderboard
+    from lifecycle import InFlightTracker
+    from mapimage import MapRenderer
+    from middlewares import ConcurrencyLimiter, ThrottlingMiddleware
+    from profiling import Profiler
+    from scheduler import Scheduler, Timer
+    from session import SessionStore
+    from stats import GameStats
+    from transport import PooledSession
+
+logger = logging.getLogger(__name__)
+_handlers = []
+
+valid_player_names = [
+    "🐱 Karnaks Puck",
+    "🦉 Odis Wish",
+    "🦾 Alucard",
+    "🎸 Johnny Silverhand",
+]
+# Flags of the handlers that run game logic, see CONCURRENCY_LIMITS and
+# THROTTLE_COSTS.
+GAME = {"concurrency": "game"}
+START = {"concurrency": "game", "throttle": "start"}
+MAP = {"concurrency": "map", "throttle": "map"}
+# Destinations per page of the travel menu; a keyboard has at most 100 buttons.
+TRAVEL_PAGE = 20
+
+valid_items = ["🧴 Head & Shoulders", "👕 T-shirt", "☕ Thermomug", "📦 Stickerpack"]
 
 
 def setup_logger():
@@ -35,6 +84,8 @@ def setup_logger():
         logger.info("This is an info message")
         logger.error("This is an error message")
     """
+    from colorlog import ColoredFormatter
+
     handler = logging.StreamHandler()
     formatter = ColoredFormatter(
         "%(log_color)s%(asctime)s - %(levelname)s - %(message)s",
@@ -55,63 +106,776 @@ def setup_logger():
     return logger
 
 
-logger = setup_logger()
+class Keyboards:
+    """
+    Reply keyboards of the bot menus, built once per item set, see :func:`get_keyboards`.
 
-API_TOKEN = os.environ.get("TOKEN")  # api token for your bot
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
-player = None
-verters = []
-npcs = []
-player_choices = {}
-player_location = {}
-valid_player_names = [
-    "🐱 Karnaks Puck",
-    "🦉 Odis Wish",
-    "🦾 Alucard",
-    "🎸 Johnny Silverhand",
-]
-valid_items = ["🧴 Head & Shoulders", "👕 T-shirt", "☕ Thermomug", "📦 Stickerpack"]
-locations = load_map()
-
-logger.info(f"Map loaded with {len(locations)} locations.")
-
-main_menu_buttons = ReplyKeyboardMarkup(
-    keyboard=[
-        [
-            KeyboardButton(text="🧑‍🎤 Choose Player"),
-            KeyboardButton(text="🗡️ Choose First Item"),
-        ],
-        [KeyboardButton(text="🎮 Start Game")],
-        [KeyboardButton(text="❌ End Game")],
-    ],
-    resize_keyboard=True,
-)
+    Attributes:
+        main_menu (ReplyKeyboardMarkup): The main menu.
+        players (ReplyKeyboardMarkup): The player type submenu.
+        items (ReplyKeyboardMarkup): The first item submenu.
+    """
 
-player_buttons = ReplyKeyboardMarkup(
-    keyboard=[
-        [KeyboardButton(text="🐱 Karnaks Puck"), KeyboardButton(text="🦉 Odis Wish")],
-        [
-            KeyboardButton(text="🦾 Alucard"),
-            KeyboardButton(text="🎸 Johnny Silverhand"),
-        ],
-        [KeyboardButton(text="🔙 Back to Main Menu")],
-    ],
-    resize_keyboard=True,
-)
+    def __init__(self, items: Sequence[str] = tuple(valid_items)):
+        self.main_menu = ReplyKeyboardMarkup(
+            keyboard=[
+                [
+                    KeyboardButton(text="🧑‍🎤 Choose Player"),
+                    KeyboardButton(text="🗡️ Choose First Item"),
+                ],
+                [KeyboardButton(text="🎮 Start Game")],
+                [
+                    KeyboardButton(text="🏆 Leaderboard"),
+                    KeyboardButton(text="❌ End Game"),
+                ],
+            ],
+            resize_keyboard=True,
+        )
 
-item_buttons = ReplyKeyboardMarkup(
-    keyboard=[
-        [KeyboardButton(text="🧴 Head & Shoulders"), KeyboardButton(text="👕 T-shirt")],
-        [KeyboardButton(text="☕ Thermomug"), KeyboardButton(text="📦 Stickerpack")],
-        [KeyboardButton(text="🔙 Back to Main Menu")],
-    ],
-    resize_keyboard=True,
-)
+        self.players = ReplyKeyboardMarkup(
+            keyboard=[
+                [
+                    KeyboardButton(text="🐱 Karnaks Puck"),
+                    KeyboardButton(text="🦉 Odis Wish"),
+                ],
+                [
+                    KeyboardButton(text="🦾 Alucard"),
+                    KeyboardButton(text="🎸 Johnny Silverhand"),
+                ],
+                [KeyboardButton(text="🔙 Back to Main Menu")],
+            ],
+            resize_keyboard=True,
+        )
+
+        self.items = ReplyKeyboardMarkup(
+            keyboard=[
+                [KeyboardButton(text=item) for item in items[row : row + 2]]
+                for row in range(0, len(items), 2)
+            ]
+            + [[KeyboardButton(text="🔙 Back to Main Menu")]],
+            resize_keyboard=True,
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def get_keyboards(items: Tuple[str, ...] = tuple(valid_items)) -> Keyboards:
+    """
+    Returns the keyboards of an item set, shared by every bot that offers those items.
+
+    Args:
+        items (Tuple[str, ...]): The first items offered to the players.
+
+    Returns:
+        Keyboards: The reply keyboards.
+    """
+    return Keyboards(items)
+
+
+class BotSettings:
+    """
+    Settings of one bot hosted by the process, see :func:`load_bot_settings`.
+
+    Attributes:
+        name (str): Name of the bot; namespaces its sessions, leaderboard and statistics.
+        token (str, optional): The bot token.
+        start_location (int, optional): Location where games start, instead of the catalog's.
+        items (Tuple[str, ...]): The first items offered to the players.
+    """
+
+    def __init__(
+        self,
+        name: str = "",
+        token: Optional[str] = None,
+        start_location: Optional[int] = None,
+        items: Sequence[str] = tuple(valid_items),
+    ):
+        self.name = name
+        self.token = token
+        self.start_location = start_location
+        self.items = tuple(items)
+
+
+def load_bot_settings(path: str) -> List[BotSettings]:
+    """
+    Reads the bots to host from a JSON file.
+
+    The file holds a list of objects with a ``name`` and optionally a ``token``,
+    a ``start_location`` and ``items``. A bot without a ``token`` reads it from
+    the ``TOKEN_<NAME>`` environment variable, e.g. ``TOKEN_KAZAN``.
+
+    Args:
+        path (str): The JSON file.
+
+    Returns:
+        List[BotSettings]: The settings of the bots, in file order.
+
+    Raises:
+        ValueError: If a bot has no name or no token, or two bots share a name.
+    """
+    with open(path, encoding="utf-8") as file:
+        entries = json.load(file)
+    bots = []
+    for entry in entries:
+        name = entry.get("name", "")
+        token = entry.get("token") or os.environ.get(f"TOKEN_{name.upper()}")
+        if not name or not token:
+            raise ValueError(f"Bot {name!r} in {path} needs a name and a token.")
+        if any(bot.name == name for bot in bots):
+            raise ValueError(f"Bot {name!r} is listed twice in {path}.")
+        bots.append(
+            BotSettings(
+                name=name,
+                token=token,
+                start_location=entry.get("start_location"),
+                items=entry.get("items", valid_items),
+            )
+        )
+    return bots
+
+
+def on(observer: str, *filters, **kwargs):
+    """
+    Declares a handler without attaching it to any router yet.
+
+    Declared handlers are registered on a fresh router by :func:`create_router`,
+    so importing this module does no registration work and any number of
+    dispatchers can be built from the same handlers.
+
+    Args:
+        observer (str): The router observer, e.g. ``"message"`` or ``"callback_query"``.
+        *filters: Filters of the handler.
+        **kwargs: Passed on to the observer's ``register``, e.g. ``flags``.
+
+    Returns:
+        Callable: A decorator that records the handler and returns it unchanged.
+    """
+
+    def decorator(handler):
+        _handlers.append((observer, handler, filters, kwargs))
+        return handler
+
+    return decorator
+
+
+def create_router() -> Router:
+    """
+    Builds a router with every handler declared with :func:`on`.
+
+    Returns:
+        Router: A new router, in declaration order of the handlers.
+    """
+    router = Router()
+    for observer, handler, filters, kwargs in _handlers:
+        getattr(router, observer).register(handler, *filters, **kwargs)
+    return router
+
+
+class IsAdmin(Filter):
+    """
+    Passes only updates from the operators listed in the ``ADMIN_IDS`` environment variable.
+    """
+
+    async def __call__(
+        self, event: types.TelegramObject, event_from_user: types.User, admins: set
+    ) -> bool:
+        return event_from_user.id in admins
+
+
+class IsItem(Filter):
+    """
+    Passes only messages naming one of the first items offered by the bot.
+    """
+
+    async def __call__(self, message: types.Message, settings: BotSettings) -> bool:
+        return message.text in settings.items
+
+
+class InGame(Filter):
+    """
+    Passes only updates from users with a running game and injects their session.
+    """
+
+    async def __call__(
+        self,
+        event: types.TelegramObject,
+        event_from_user: types.User,
+        sessions: SessionStore,
+    ) -> Union[bool, Dict[str, Any]]:
+        from tracing import span
+
+        with span("session"):
+            session = sessions.get(event_from_user.id)
+        if session is None or not session.in_game:
+            return False
+        return {"session": session}
+
+
+def create_transport() -> PooledSession:
+    """
+    Creates the HTTP transport to the Bot API configured from environment variables.
+
+    ``BOT_API_URL`` points the bot to another Bot API server, e.g. a local
+    ``stub_api.py``. ``HTTP_POOL_SIZE`` caps the pooled keep-alive connections,
+    ``HTTP_CONNECT_TIMEOUT`` and ``HTTP_READ_TIMEOUT`` are in seconds,
+    ``HTTP_RETRIES`` is the number of retries of a failed call, and the circuit
+    breaker opens after ``BREAKER_THRESHOLD`` consecutive failures for
+    ``BREAKER_RESET`` seconds.
+
+    Returns:
+        PooledSession: The aiogram session.
+    """
+    from transport import CircuitBreaker, PooledSession
+
+    api_url = os.environ.get("BOT_API_URL")
+    return PooledSession(
+        api=TelegramAPIServer.from_base(api_url) if api_url else PRODUCTION,
+        pool_size=int(os.environ.get("HTTP_POOL_SIZE", 100)),
+        connect_timeout=float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5)),
+        read_timeout=float(os.environ.get("HTTP_READ_TIMEOUT", 30)),
+        retries=int(os.environ.get("HTTP_RETRIES", 3)),
+        breaker=CircuitBreaker(
+            threshold=int(os.environ.get("BREAKER_THRESHOLD", 5)),
+            reset_timeout=float(os.environ.get("BREAKER_RESET", 30)),
+        ),
+    )
+
+
+def create_bot(token: Optional[str] = None, **kwargs) -> Bot:
+    """
+    Creates the Bot API client.
+
+    Args:
+        token (str, optional): The bot token; read from the ``TOKEN`` environment variable if not given.
+        **kwargs: Passed on to :class:`aiogram.Bot`; the ``session`` defaults to :func:`create_transport`.
+
+    Returns:
+        Bot: The bot instance, with its outbound calls timed in traced updates.
+    """
+    from tracing import ApiSpanMiddleware
+
+    kwargs.setdefault("session", create_transport())
+    bot = Bot(token=token or os.environ.get("TOKEN"), **kwargs)
+    bot.session.middleware(ApiSpanMiddleware())
+    return bot
+
+
+def create_session_store(namespace: str = "") -> SessionStore:
+    """
+    Creates the session store configured from environment variables.
+
+    ``SESSION_MAX_HOT`` caps the number of sessions kept in memory,
+    ``SESSION_MAX_BYTES`` caps their estimated memory, ``SESSION_TTL`` is the idle
+    time in seconds before a session moves to disk and ``SESSION_DIR`` is where
+    idle sessions are kept.
+
+    Args:
+        namespace (str): Subdirectory of ``SESSION_DIR`` for the sessions of one of several bots.
+
+    Returns:
+        SessionStore: The session store.
+    """
+    from session import SessionStore
+
+    max_bytes = os.environ.get("SESSION_MAX_BYTES")
+    return SessionStore(
+        max_hot=int(os.environ.get("SESSION_MAX_HOT", 10000)),
+        max_bytes=int(max_bytes) if max_bytes else None,
+        ttl=float(os.environ.get("SESSION_TTL", 1800)),
+        cold_dir=os.path.join(os.environ.get("SESSION_DIR", "sessions"), namespace),
+    )
+
+
+def namespaced(path: Optional[str], name: str) -> Optional[str]:
+    """
+    Inserts the name of a hosted bot before the extension of a file, e.g. ``trace.kazan.jsonl``.
+
+    Args:
+        path (str, optional): The file configured for the process.
+        name (str): The name of the bot; empty for a single bot.
+
+    Returns:
+        str or None: The file of the bot.
+    """
+    if not path or not name:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{name}{ext}"
+
+
+def create_shared(catalog=None, cold_dir: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Builds the immutable content and the caches that several bots can share.
+
+    If ``CONTENT_PACK`` is set and no catalog is given, the catalog is read
+    lazily from that memory-mapped content pack, see :mod:`contentpack`.
+    Inline queries are answered from a search index over the catalog, with the
+    results of the last ``INLINE_CACHE_SIZE`` queries cached and Telegram
+    allowed to cache answers for ``INLINE_CACHE_TIME`` seconds, see :mod:`inline`.
+    Map images are rendered by ``MAP_WORKERS`` processes and cached as PNG files
+    in ``MAP_CACHE_DIR`` and as Telegram file IDs, see :mod:`mapimage`.
+    Allocations are traced on demand with ``TRACEMALLOC_FRAMES`` frames per
+    traceback, see :mod:`diagnostics`.
+
+    Args:
+        catalog (Catalog, optional): The game content; loaded from disk if not given.
+        cold_dir (str, optional): Directory of the map caches; ``SESSION_DIR`` if not given.
+
+    Returns:
+        dict: The ``catalog``, ``inline_search``, ``maps`` and ``allocations`` workflow data.
+    """
+    from diagnostics import AllocationTracker
+    from inline import InlineSearch
+    from mapimage import MapRenderer
+
+    if catalog is None and os.environ.get("CONTENT_PACK"):
+        from contentpack import load_pack_catalog
+
+        catalog = load_pack_catalog(os.environ["CONTENT_PACK"])
+    elif catalog is None:
+        from catalog import load_catalog
+
+        catalog = load_catalog()
+    logger.info(
+        f"Catalog {catalog.version} loaded with {len(catalog.locations)} locations."
+    )
+    if cold_dir is None:
+        cold_dir = os.environ.get("SESSION_DIR", "sessions")
+    maps = MapRenderer(
+        cache_dir=os.environ.get("MAP_CACHE_DIR", os.path.join(cold_dir, "maps")),
+        executor=ProcessPoolExecutor(
+            max_workers=int(os.environ.get("MAP_WORKERS", 2)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ),
+        path=os.path.join(cold_dir, "map_ids.snapshot"),
+    )
+    inline_search = InlineSearch(
+        catalog,
+        cache_size=int(os.environ.get("INLINE_CACHE_SIZE", 256)),
+        cache_time=int(os.environ.get("INLINE_CACHE_TIME", 300)),
+    )
+    allocations = AllocationTracker(frames=int(os.environ.get("TRACEMALLOC_FRAMES", 1)))
+    return {
+        "catalog": catalog,
+        "inline_search": inline_search,
+        "maps": maps,
+        "allocations": allocations,
+    }
+
+
+def create_dispatcher(
+    catalog=None,
+    tap_window: float = 0.0,
+    sessions: Optional[SessionStore] = None,
+    throttle_rate: Optional[float] = None,
+    settings: Optional[BotSettings] = None,
+    shared: Optional[Dict[str, Any]] = None,
+) -> Dispatcher:
+    """
+    Builds the dispatcher with everything the handlers depend on.
+
+    The catalog, the keyboards and the session store are stored in the
+    dispatcher's workflow data, from where aiogram passes them to handlers that
+    declare them as arguments. Several dispatchers, one per hosted bot, can share
+    the catalog, the inline search and the map renderer built by
+    :func:`create_shared`, and the keyboards of their item set; the sessions,
+    the leaderboard and the statistics stay per bot.
+
+    Updates of one user are processed one at a time, and repeated taps on the
+    same inline button are dropped while the first one is still being processed,
+    see :class:`UserSerializationMiddleware`.
+    Running updates are counted, and on shutdown they get up to ``DRAIN_TIMEOUT``
+    seconds to finish before anything is torn down, see :mod:`lifecycle`. They
+    can be profiled on demand, see :mod:`profiling`. If ``TRACE_FILE`` is set, a
+    ``TRACE_SAMPLE`` share of the updates is traced to that file, see :mod:`tracing`.
+    Score changes and other game events of the handlers are recorded on the
+    leaderboard and in the game statistics, see :mod:`leaderboard` and :mod:`stats`.
+    The private chats that write to the bot are recorded for the ``/broadcast``
+    command, which sends at most ``BROADCAST_RATE`` messages per second, reading
+    and checkpointing ``BROADCAST_PAGE`` chats at a time, see :mod:`broadcast`.
+    Quests accepted with a deadline are reminded ``QUEST_REMINDER`` seconds
+    before it and failed when it passes, by the timers of :mod:`scheduler`.
+
+    At most ``MAX_CONCURRENT`` handlers run at the same time, and
+    ``CONCURRENCY_LIMITS`` (e.g. ``game=16``) caps classes of handlers. Once
+    ``HIGH_WATER`` updates wait for a slot, the updates of the ``SHED_CLASSES``
+    (e.g. ``map``) are rejected with a notice until the queue shrinks, see
+    :class:`middlewares.ConcurrencyLimiter`. Ahead of the per-user lock and the
+    handler slots, each user may spend ``THROTTLE_RATE`` tokens per second with
+    bursts of ``THROTTLE_BURST``; the handlers of an action cost
+    ``THROTTLE_COSTS`` tokens (e.g. ``start=5``), ``THROTTLE_ACTIONS`` (e.g.
+    ``start=3``) caps the uses of an action per user and minute, and updates
+    over a limit are shed, see :class:`middlewares.ThrottlingMiddleware`. Inline
+    queries have a bucket of their own, of ``INLINE_THROTTLE_BURST`` queries
+    refilled at ``INLINE_THROTTLE_RATE`` per second.
+
+    Args:
+        catalog (Catalog, optional): The game content; loaded from disk if not given.
+        tap_window (float): Seconds after a button tap was processed during which an identical tap is still a duplicate; 0 drops only taps in flight.
+        sessions (SessionStore, optional): The session store; configured from the environment if not given.
+        throttle_rate (float, optional): Tokens per second of each user; ``THROTTLE_RATE`` if not given, 0 disables throttling.
+        settings (BotSettings, optional): The settings of the bot; the defaults if not given.
+        shared (dict, optional): The result of :func:`create_shared`; built from ``catalog`` if not given.
+
+    Returns:
+        Dispatcher: The dispatcher with the bot router included.
+    """
+    from broadcast import Broadcaster, ChatRegistry, RegistryMiddleware
+    from leaderboard import Leaderboard, LeaderboardMiddleware
+    from lifecycle import InFlightTracker, setup_drain
+    from middlewares import (
+        ConcurrencyLimiter,
+        SessionPinMiddleware,
+        ThrottlingMiddleware,
+        UserSerializationMiddleware,
+        parse_limits,
+    )
+    from profiling import Profiler, ProfilingMiddleware
+    from scheduler import DeadlineMiddleware, Scheduler
+    from stats import GameStats, StatsMiddleware
+
+    if settings is None:
+        settings = BotSettings()
+    if sessions is None:
+        sessions = create_session_store(settings.name)
+    owns_shared = shared is None
+    if owns_shared:
+        shared = create_shared(catalog, sessions.cold_dir)
+    catalog = shared["catalog"]
+    if sessions.measure is None:
+        from diagnostics import session_sizer
+
+        sessions.measure = session_sizer(catalog)
+    if settings.start_location is not None and not (
+        0 <= settings.start_location < len(catalog.locations)
+    ):
+        raise ValueError(
+            f"Bot {settings.name!r} starts at unknown location {settings.start_location}."
+        )
+
+    in_flight = InFlightTracker()
+    limiter = ConcurrencyLimiter(
+        limit=int(os.environ.get("MAX_CONCURRENT", 64)),
+        class_limits=parse_limits(os.environ.get("CONCURRENCY_LIMITS", "")),
+        high_water=int(os.environ.get("HIGH_WATER", 200)) or None,
+        shed=filter(None, os.environ.get("SHED_CLASSES", "map").split(",")),
+    )
+    if throttle_rate is None:
+        throttle_rate = float(os.environ.get("THROTTLE_RATE", 1.0))
+    throttle = (
+        ThrottlingMiddleware(
+            rate=throttle_rate,
+            burst=float(os.environ.get("THROTTLE_BURST", 10)),
+            costs=parse_limits(os.environ.get("THROTTLE_COSTS", "start=5,map=2")),
+            action_limits=parse_limits(os.environ.get("THROTTLE_ACTIONS", "start=3")),
+            inline_rate=float(os.environ.get("INLINE_THROTTLE_RATE", 5)),
+            inline_burst=float(os.environ.get("INLINE_THROTTLE_BURST", 20)),
+        )
+        if throttle_rate > 0
+        else None
+    )
+    profiler = Profiler(output_dir=os.environ.get("PROFILE_DIR", "profiles"))
+    admins = {
+        int(admin_id)
+        for admin_id in os.environ.get("ADMIN_IDS", "").split(",")
+        if admin_id
+    }
+    leaderboard = Leaderboard(os.path.join(sessions.cold_dir, "leaderboard.snapshot"))
+    stats = GameStats(os.path.join(sessions.cold_dir, "stats.snapshot"))
+    sessions.on_demote = stats.session_demoted
+    sessions.on_promote = stats.session_promoted
+    registry = ChatRegistry(os.path.join(sessions.cold_dir, "chats.sqlite"))
+    broadcaster = Broadcaster(
+        registry,
+        rate=float(os.environ.get("BROADCAST_RATE", 20)),
+        page_size=int(os.environ.get("BROADCAST_PAGE", 100)),
+    )
+    scheduler = Scheduler(os.path.join(sessions.cold_dir, "timers.snapshot"))
+    dp = Dispatcher(
+        **shared,
+        settings=settings,
+        keyboards=get_keyboards(settings.items),
+        sessions=sessions,
+        leaderboard=leaderboard,
+        stats=stats,
+        broadcaster=broadcaster,
+        scheduler=scheduler,
+        in_flight=in_flight,
+        limiter=limiter,
+        throttle=throttle,
+        profiler=profiler,
+        admins=admins,
+    )
+    dp.update.outer_middleware(in_flight)
+    # Registered before the other shutdown hooks, so the subsystems stop once no
+    # handler runs.
+    setup_drain(dp, in_flight, timeout=float(os.environ.get("DRAIN_TIMEOUT", 10)))
+    trace_file = namespaced(os.environ.get("TRACE_FILE"), settings.name)
+    if trace_file:
+        from tracing import Tracer, setup_tracing
+
+        tracer = Tracer(
+            trace_file,
+            max_bytes=int(os.environ.get("TRACE_MAX_BYTES", 10 * 1024 * 1024)),
+            backup_count=int(os.environ.get("TRACE_BACKUPS", 5)),
+            sample=float(os.environ.get("TRACE_SAMPLE", 1.0)),
+        )
+        setup_tracing(dp, tracer)
+    dp.update.outer_middleware(ProfilingMiddleware(profiler))
+    if throttle is not None:
+        # Ahead of the per-user lock, so floods are shed instead of queued.
+        dp.update.outer_middleware(throttle)
+    dp.update.outer_middleware(UserSerializationMiddleware(window=tap_window))
+    dp.update.outer_middleware(SessionPinMiddleware())
+    dp.message.outer_middleware(RegistryMiddleware(registry))
+    if throttle is not None:
+        dp.message.middleware(throttle)
+        dp.callback_query.middleware(throttle)
+    dp.message.middleware(limiter)
+    dp.callback_query.middleware(limiter)
+    deadlines = DeadlineMiddleware(
+        scheduler, remind_before=float(os.environ.get("QUEST_REMINDER", 600))
+    )
+    for observer in (dp.message, dp.callback_query):
+        observer.middleware(LeaderboardMiddleware(leaderboard))
+        observer.middleware(StatsMiddleware(stats))
+        observer.middleware(deadlines)
+    dp.shutdown.register(log_session_stats)
+    # Ahead of the handoff, so the cursor is checkpointed before the next
+    # process can take the lock and resume from it.
+    dp.shutdown.register(stop_broadcast)
+    dp.shutdown.register(stop_scheduler)
+    if owns_shared:
+        dp.shutdown.register(log_inline_stats)
+        dp.shutdown.register(close_map_renderer)
+    dp.include_router(create_router())
+    return dp
+
+
+async def log_session_stats(
+    sessions: SessionStore,
+    limiter: ConcurrencyLimiter,
+    throttle: Optional[ThrottlingMiddleware],
+):
+    """
+    Logs the tier sizes and hit rates of the session store, the waits for a handler slot and the throttled updates.
+
+    Args:
+        sessions (SessionStore): The session store.
+        limiter (ConcurrencyLimiter): The limit on concurrently running handlers.
+        throttle (ThrottlingMiddleware, optional): The per-user rate limit, if enabled.
+    """
+    logger.info(f"Session store: {sessions.stats()}")
+    logger.info(f"Handler slots: {limiter.stats()}")
+    if throttle is not None:
+        logger.info(f"Throttling: {throttle.stats()}")
+
+
+async def resume_broadcast(broadcaster: Broadcaster, bot: Bot):
+    """
+    Resumes a broadcast interrupted by the previous process.
+
+    Args:
+        broadcaster (Broadcaster): The broadcasts of the bot.
+        bot (Bot): The bot to send with.
+    """
+    broadcaster.resume(bot)
+
+
+async def stop_broadcast(broadcaster: Broadcaster):
+    """
+    Interrupts the running broadcast, checkpointed to resume on startup.
+
+    Args:
+        broadcaster (Broadcaster): The broadcasts of the bot.
+    """
+    await broadcaster.stop()
+
+
+async def close_chat_registry(broadcaster: Broadcaster):
+    """
+    Closes the chat registry, once no update can record a chat in it anymore.
+
+    Args:
+        broadcaster (Broadcaster): The broadcasts of the bot.
+    """
+    broadcaster.registry.close()
+
+
+async def start_scheduler(scheduler: Scheduler, bot: Bot, sessions: SessionStore):
+    """
+    Registers the handlers of the quest deadline timers and starts firing timers.
+
+    Args:
+        scheduler (Scheduler): The timers of the bot.
+        bot (Bot): The bot to notify the players with.
+        sessions (SessionStore): The session store.
+    """
+    scheduler.register(
+        "quest_reminder", functools.partial(remind_deadlines, bot, sessions)
+    )
+    scheduler.register(
+        "quest_deadline", functools.partial(expire_deadlines, bot, sessions)
+    )
+    scheduler.start()
+
+
+async def stop_scheduler(scheduler: Scheduler):
+    """
+    Stops firing timers; the pending ones are saved with the leaderboard and reloaded on startup.
+
+    Args:
+        scheduler (Scheduler): The timers of the bot.
+    """
+    await scheduler.stop()
+    logger.info(f"Scheduler: {scheduler.stats()}")
+
+
+def pending_quest(sessions: SessionStore, user_id: int, name: str, due: float):
+    """
+    Returns the session of a player whose quest is still pending with the given deadline.
+
+    Timers are not cancelled when a game ends, so a timer of a finished game,
+    or of a quest accepted again since, finds no such quest.
+
+    Args:
+        sessions (SessionStore): The session store.
+        user_id (int): The ID of the player.
+        name (str): The name of the quest.
+        due (float): The deadline the timer was scheduled for.
+
+    Returns:
+        Session: The session, or None if the quest is no longer pending.
+    """
+    session = sessions.get(user_id)
+    if session is None or not session.in_game:
+        return None
+    quest = session.player.quests.get(name)
+    if quest is None or quest.get("done") or quest.get("due") != due:
+        return None
+    return session
+
+
+async def notify(bot: Bot, user_id: int, text: str):
+    """
+    Sends a message to a player outside of an update, ignoring chats that are gone.
+
+    Args:
+        bot (Bot): The bot to send with.
+        user_id (int): The ID of the player.
+        text (str): The message.
+    """
+    try:
+        await bot.send_message(chat_id=user_id, text=text)
+    except TelegramAPIError as error:
+        logger.debug(f"Could not notify user {user_id}: {error}")
+
+
+async def remind_deadlines(bot: Bot, sessions: SessionStore, timers: List[Timer]):
+    """
+    Reminds the players of the quests whose deadline is close.
+
+    Args:
+        bot (Bot): The bot to send with.
+        sessions (SessionStore): The session store.
+        timers (List[Timer]): The reminder timers of one tick.
+    """
+    for timer in timers:
+        user_id, name, due = timer.payload
+        if pending_quest(sessions, user_id, name, due) is None:
+            continue
+        minutes = max(1, round((due - time.time()) / 60))
+        await notify(
+            bot, user_id, f"⏰ {minutes} minutes left to finish the quest '{name}'."
+        )
+
+
+async def expire_deadlines(bot: Bot, sessions: SessionStore, timers: List[Timer]):
+    """
+    Fails the quests whose deadline passed and tells the players.
+
+    The penalty is applied to every session of the batch first, then the players
+    are notified. The leaderboard and the statistics pick up the score change
+    and the ``quest_expired`` event on the next update of the player.
+
+    Args:
+        bot (Bot): The bot to send with.
+        sessions (SessionStore): The session store.
+        timers (List[Timer]): The deadline timers of one tick.
+    """
+    notices = []
+    for timer in timers:
+        user_id, name, due = timer.payload
+        session = pending_quest(sessions, user_id, name, due)
+        if session is None:
+            continue
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            session.player.miss_deadline(name, due)
+        notices.append((user_id, f"⌛ {output.getvalue().strip()}"))
+    for user_id, text in notices:
+        await notify(bot, user_id, text)
+
+
+async def log_inline_stats(inline_search: InlineSearch):
+    """
+    Logs the size and hit rate of the inline result cache.
+
+    Args:
+        inline_search (InlineSearch): The inline query search.
+    """
+    logger.info(f"Inline result cache: {inline_search.cache.stats()}")
+
+
+async def close_map_renderer(maps: MapRenderer):
+    """
+    Logs how map images were served and stops the rendering processes.
+
+    Args:
+        maps (MapRenderer): The map renderer.
+    """
+    logger.info(f"Map images: {maps.stats()}")
+    maps.close()
+
+
+async def log_transport_stats(bot: Bot):
+    """
+    Logs the request counters and the connection reuse of the Bot API transport.
+
+    Args:
+        bot (Bot): The bot whose session is inspected.
+    """
+    from transport import PooledSession
+
+    if isinstance(bot.session, PooledSession):
+        logger.info(f"Bot API transport: {bot.session.stats()}")
+
+
+def get_session(sessions: SessionStore, user_id: int):
+    """
+    Returns the session of a user, creating an empty one if needed.
+
+    Args:
+        sessions (SessionStore): The session store.
+        user_id (int): The ID of the user.
+
+    Returns:
+        Session: The session of the user.
+    """
+    from session import Session
+    from tracing import span
+
+    with span("session"):
+        session = sessions.get(user_id)
+    if session is None:
+        session = sessions[user_id] = Session(user_id)
+        logger.info(f"Initialized player choices for user {user_id}.")
+    return session
 
 
-@dp.message(F.text == "/start")
-async def send_welcome(message: types.Message):
+@on("message", F.text == "/start")
+async def send_welcome(
+    message: types.Message, sessions: SessionStore, keyboards: Keyboards
+):
     """
     Handles the '/start' command when the user initiates the bot.
 
@@ -119,14 +883,17 @@ async def send_welcome(message: types.Message):
 
     Args:
         message (types.Message): The message object containing the user's command.
+        sessions (SessionStore): The session store.
+        keyboards (Keyboards): The reply keyboards.
     """
-    player_choices[message.from_user.id] = {"player": None, "item": None}
+    session = get_session(sessions, message.from_user.id)
+    session.player_name = session.item = None
     logger.info(f"New user started the bot: {message.from_user.id}")
-    await message.answer("Welcome! Choose an option:", reply_markup=main_menu_buttons)
+    await message.answer("Welcome! Choose an option:", reply_markup=keyboards.main_menu)
 
 
-@dp.message(F.text.in_({"🧑‍🎤 Choose Player", "🗡️ Choose First Item"}))
-async def show_submenu(message: types.Message):
+@on("message", F.text.in_({"🧑‍🎤 Choose Player", "🗡️ Choose First Item"}))
+async def show_submenu(message: types.Message, keyboards: Keyboards):
     """
     Handles menu choices for selecting a player or first item.
 
@@ -134,30 +901,20 @@ async def show_submenu(message: types.Message):
 
     Args:
         message (types.Message): The message object containing the user's choice.
+        keyboards (Keyboards): The reply keyboards.
     """
     if message.text == "🧑‍🎤 Choose Player":
         logger.debug(f"User {message.from_user.id} is choosing a player.")
-        await message.answer("Choose a player type:", reply_markup=player_buttons)
+        await message.answer("Choose a player type:", reply_markup=keyboards.players)
     elif message.text == "🗡️ Choose First Item":
         logger.debug(f"User {message.from_user.id} is choosing an item.")
-        await message.answer("Choose an item type:", reply_markup=item_buttons)
-
-
-def initialize_user_if_needed(user_id):
-    """
-    Initializes the player's choices for a given user if they haven't been initialized yet.
-
-    Args:
-        user_id (int): The ID of the user to initialize.
-    """
-    global player_choices
-    if user_id not in player_choices:
-        player_choices[user_id] = {"player": None, "item": None}
-        logger.info(f"Initialized player choices for user {user_id}.")
+        await message.answer("Choose an item type:", reply_markup=keyboards.items)
 
 
-@dp.message(F.text.in_(valid_player_names))
-async def choose_player(message: types.Message):
+@on("message", F.text.in_(valid_player_names))
+async def choose_player(
+    message: types.Message, sessions: SessionStore, keyboards: Keyboards
+):
     """
     Handles the user's selection of a player.
 
@@ -165,22 +922,26 @@ async def choose_player(message: types.Message):
 
     Args:
         message (types.Message): The message object containing the player's choice.
+        sessions (SessionStore): The session store.
+        keyboards (Keyboards): The reply keyboards.
     """
     user_id = message.from_user.id
-    initialize_user_if_needed(user_id)
+    session = get_session(sessions, user_id)
     chosen_player = (
         message.text if message.text in valid_player_names else message.text.strip()
     )
-    player_choices[user_id]["player"] = chosen_player
+    session.player_name = chosen_player
     logger.info(f"User {user_id} selected player: {chosen_player}")
     await message.answer(
         f"Player {chosen_player} selected. Now choose an item:",
-        reply_markup=item_buttons,
+        reply_markup=keyboards.items,
     )
 
 
-@dp.message(F.text.in_(valid_items))
-async def choose_item(message: types.Message):
+@on("message", IsItem())
+async def choose_item(
+    message: types.Message, sessions: SessionStore, keyboards: Keyboards
+):
     """
     Handles the user's selection of an item.
 
@@ -188,20 +949,21 @@ async def choose_item(message: types.Message):
 
     Args:
         message (types.Message): The message object containing the item choice.
+        sessions (SessionStore): The session store.
+        keyboards (Keyboards): The reply keyboards.
     """
     user_id = message.from_user.id
-    initialize_user_if_needed(user_id)
-    chosen_item = message.text if message.text in valid_items else message.text.strip()
-    player_choices[user_id]["item"] = chosen_item
+    session = get_session(sessions, user_id)
+    session.item = message.text
     logger.info(f"User {user_id} selected item: {message.text}")
     await message.answer(
         f"Item {message.text} selected. You can start the game now!",
-        reply_markup=main_menu_buttons,
+        reply_markup=keyboards.main_menu,
     )
 
 
-@dp.message(F.text == "🔙 Back to Main Menu")
-async def back_to_main_menu(message: types.Message):
+@on("message", F.text == "🔙 Back to Main Menu")
+async def back_to_main_menu(message: types.Message, keyboards: Keyboards):
     """
     Handles the user's request to return to the main menu.
 
@@ -209,37 +971,262 @@ async def back_to_main_menu(message: types.Message):
 
     Args:
         message (types.Message): The message object containing the user's request.
+        keyboards (Keyboards): The reply keyboards.
     """
     logger.debug(f"User {message.from_user.id} returned to the main menu.")
-    await message.answer("Choose an option:", reply_markup=main_menu_buttons)
-
-
-@dp.message(F.text == "❌ End Game")
-async def end_game(message: types.Message):
+    await message.answer("Choose an option:", reply_markup=keyboards.main_menu)
+
+
+@on("message", F.text == "❌ End Game")
+async def end_game(
+    message: types.Message,
+    sessions: SessionStore,
+    keyboards: Keyboards,
+    event_from_user: types.User,
+    stats: GameStats,
+    reason: str = "quit",
+):
     """
     Ends the current game session for the user.
 
-    Removes the user's location and player choices, and provides the option to start a new game.
+    Removes the user's session, and provides the option to start a new game.
     Logs the action if the user was in a game, otherwise notifies the user that no game was in progress.
 
     Args:
         message (types.Message): The message object containing the user's request to end the game.
+        sessions (SessionStore): The session store.
+        keyboards (Keyboards): The reply keyboards.
+        event_from_user (types.User): The user whose game is ended.
+        stats (GameStats): The game statistics.
+        reason (str): Why the game ends: ``"quit"``, ``"completed"`` or ``"expelled"``.
     """
-    user_id = message.from_user.id
-    if user_id in player_location:
-        del player_location[user_id]
-        del player_choices[user_id]
+    user_id = event_from_user.id
+    session = sessions.get(user_id)
+    if session is not None and session.in_game:
+        del sessions[user_id]
+        stats.game_ended(session.player.level, reason)
         await message.answer(
             "Game has been ended. You can start a new game by clicking 'Start Game'.",
-            reply_markup=main_menu_buttons,
+            reply_markup=keyboards.main_menu,
         )
         logger.info(f"User {user_id} has ended the game.")
     else:
         await message.answer("You are not in a game. Start the game first.")
 
 
-@dp.message(F.text == "🎮 Start Game")
-async def start_game(message: types.Message):
+@on("message", or_f(F.text == "🏆 Leaderboard", Command("top")))
+async def show_leaderboard(
+    message: types.Message, leaderboard: Leaderboard, event_from_user: types.User
+):
+    """
+    Shows the best players and the rank of the user.
+
+    Args:
+        message (types.Message): The message object containing the user's request.
+        leaderboard (Leaderboard): The global leaderboard.
+        event_from_user (types.User): The user asking for the leaderboard.
+    """
+    rows = [
+        f"{row.rank}. {row.name}: level {row.level}, {row.level_points} points"
+        for row in leaderboard.top()
+    ]
+    rank = leaderboard.rank(event_from_user.id)
+    if rank is None:
+        footer = "Complete a project to get on the leaderboard."
+    else:
+        footer = f"Your best rank: {rank} of {len(leaderboard)}."
+    await message.answer(
+        "🏆 Leaderboard\n\n"
+        + ("\n".join(rows) or "Nobody is ranked yet.")
+        + f"\n\n{footer}"
+    )
+
+
+@on("message", Command("stats"), IsAdmin())
+async def show_stats(
+    message: types.Message,
+    stats: GameStats,
+    in_flight: InFlightTracker,
+    limiter: ConcurrencyLimiter,
+    inline_search: InlineSearch,
+    throttle: Optional[ThrottlingMiddleware],
+    scheduler: Scheduler,
+):
+    """
+    Handles the admin '/stats' command: replies with the game statistics and the update load.
+
+    Args:
+        message (types.Message): The message object containing the command.
+        stats (GameStats): The game statistics.
+        in_flight (InFlightTracker): The counter of updates being processed.
+        limiter (ConcurrencyLimiter): The limit on concurrently running handlers.
+        inline_search (InlineSearch): The inline query search, for its cache hit rate.
+        throttle (ThrottlingMiddleware, optional): The per-user rate limit, if enabled.
+        scheduler (Scheduler): The timers of the bot.
+    """
+    load = limiter.stats()
+    cache = inline_search.cache.stats()
+    text = (
+        f"{stats.report()}\n\n"
+        f"⚙️ Updates in flight: {in_flight.in_flight}, "
+        f"running {load['running']}/{limiter.limit}, waiting {load['waiting']} "
+        f"(max {load['max_waiting']}), rejected {load['rejected']}, "
+        f"delayed {load['delayed']}, "
+        f"wait avg {load['wait_avg_ms']:.1f} ms, max {load['wait_max_ms']:.1f} ms.\n"
+        f"🔎 Inline cache: {cache['cached']} queries, hit rate {cache['hit_rate']:.0%} "
+        f"({cache['hits']} hits, {cache['misses']} misses)."
+    )
+    if throttle is not None:
+        shed = throttle.stats()
+        text += (
+            f"\n🚦 Throttling: {shed['shed']} shed, {shed['ignored']} ignored, "
+            f"{shed['passed']} passed, {shed['buckets']} buckets."
+        )
+    timers = scheduler.stats()
+    text += (
+        f"\n⏳ Timers: {timers['pending']} pending, {timers['fired']} fired "
+        f"in {timers['batches']} batches, max late {timers['max_late_ms']:.0f} ms."
+    )
+    await message.answer(text)
+
+
+@on("message", Command("profile"), IsAdmin())
+async def start_profiling(
+    message: types.Message, command: CommandObject, profiler: Profiler
+):
+    """
+    Handles the admin '/profile' command: profiles the bot for a while and replies with the top functions.
+
+    ``/profile 30s`` profiles for 30 seconds, ``/profile 100`` for the next 100 updates.
+
+    Args:
+        message (types.Message): The message object containing the command.
+        command (CommandObject): The parsed command with its argument.
+        profiler (Profiler): The profiler of the dispatcher.
+    """
+    from profiling import parse_window
+
+    try:
+        window = parse_window(command.args or "")
+    except ValueError:
+        await message.answer("Usage: /profile 30s (seconds) or /profile 100 (updates).")
+        return
+    if profiler.active:
+        await message.answer("Profiling is already running.")
+        return
+
+    async def report(summary: str):
+        await message.answer(summary[:4000])
+
+    profiler.start(**window, on_done=report)
+    await message.answer("Profiling started.")
+
+
+@on("message", Command("memory"), IsAdmin())
+async def show_memory(
+    message: types.Message,
+    command: CommandObject,
+    sessions: SessionStore,
+    catalog,
+    allocations: AllocationTracker,
+):
+    """
+    Handles the admin '/memory' command: reports what games cost in memory and where memory grows.
+
+    ``/memory`` measures the sessions in memory by component. ``/memory start``
+    starts tracing allocations, ``/memory diff`` takes a snapshot and lists the
+    allocation sites that grew most since the previous one, ``/memory baseline``
+    since tracing started, and ``/memory stop`` stops tracing.
+
+    Args:
+        message (types.Message): The message object containing the command.
+        command (CommandObject): The parsed command with its argument.
+        sessions (SessionStore): The session store.
+        catalog (Catalog): The game content, not counted in the sessions.
+        allocations (AllocationTracker): The allocation tracer of the process.
+    """
+    from diagnostics import account_sessions, format_footprint
+
+    action = (command.args or "").strip()
+    if not action:
+        report = account_sessions(sessions.hot_sessions(), catalog)
+        await message.answer(format_footprint(report))
+    elif action == "start":
+        allocations.start()
+        await message.answer("Allocation tracing started; /memory diff compares.")
+    elif action == "stop":
+        allocations.stop()
+        await message.answer("Allocation tracing stopped.")
+    elif action in ("diff", "baseline"):
+        if not allocations.active:
+            await message.answer("Allocation tracing is off; /memory start starts it.")
+            return
+        allocations.snapshot()
+        await message.answer(
+            allocations.report(since_baseline=action == "baseline")[:4000]
+        )
+    else:
+        await message.answer("Usage: /memory [start|diff|baseline|stop].")
+
+
+@on("message", Command("broadcast"), IsAdmin())
+async def broadcast_announcement(
+    message: types.Message,
+    command: CommandObject,
+    broadcaster: Broadcaster,
+    bot: Bot,
+):
+    """
+    Handles the admin '/broadcast' command: sends an announcement to every user of the bot.
+
+    ``/broadcast <text>`` starts a broadcast, ``/broadcast`` alone reports the
+    progress of the last one and ``/broadcast cancel`` stops the running one.
+
+    Args:
+        message (types.Message): The message object containing the command.
+        command (CommandObject): The parsed command with its argument.
+        broadcaster (Broadcaster): The broadcasts of the bot.
+        bot (Bot): The bot to send with.
+    """
+    text = (command.args or "").strip()
+    if text == "cancel":
+        cancelled = await broadcaster.cancel()
+        await message.answer(
+            "Broadcast cancelled." if cancelled else "No broadcast is running."
+        )
+    elif text:
+        if broadcaster.running:
+            await message.answer(
+                "A broadcast is already running; /broadcast cancel stops it."
+            )
+            return
+        broadcast_id = broadcaster.start(bot, text)
+        await message.answer(
+            f"📣 Broadcast {broadcast_id} started to "
+            f"{len(broadcaster.registry)} chats."
+        )
+    else:
+        progress = broadcaster.progress()
+        if progress is None:
+            await message.answer("Usage: /broadcast <text>, or /broadcast cancel.")
+            return
+        await message.answer(
+            f"📣 Broadcast {progress['id']} "
+            f"{progress['status']}: "
+            f"{progress['sent']} sent, {progress['pruned']} blocked and pruned, "
+            f"{progress['failed']} failed of {progress['total']} chats "
+            f"in {progress['seconds']:.0f}s."
+        )
+
+
+@on("message", F.text == "🎮 Start Game", flags=START)
+async def start_game(
+    message: types.Message,
+    sessions: SessionStore,
+    catalog,
+    stats: GameStats,
+    settings: BotSettings,
+):
     """
     Starts a new game for the user if both player and item have been selected.
 
@@ -248,18 +1235,26 @@ async def start_game(message: types.Message):
 
     Args:
         message (types.Message): The message object containing the user's request to start the game.
+        sessions (SessionStore): The session store.
+        catalog (Catalog): The game content.
+        stats (GameStats): The game statistics.
+        settings (BotSettings): The settings of the bot, for its start location.
     """
-    global player, verters, npcs
+    from tracing import span
+
     user_id = message.from_user.id
-    initialize_user_if_needed(user_id)
-    choices = player_choices[user_id]
-    if choices["player"] and choices["item"]:
+    session = get_session(sessions, user_id)
+    if session.ready:
+        if session.in_game:
+            stats.game_ended(session.player.level, "quit")
         logger.info(
-            f"User is starting the game with player {choices['player']} and item {choices['item']}."
+            f"User is starting the game with player {session.player_name} and item {session.item}."
         )
-        player, verters, npcs = init_game_elements(choices["player"], choices["item"])
-        init_start_location()
-        await show_location_info(message)
+        with span("game", action="start"):
+            session.start_game(catalog, settings.start_location)
+        stats.game_started(session.player.level)
+        stats.visited(catalog.locations[session.player.current_location]["name"])
+        await show_location_info(message, session, catalog)
     else:
         logger.warning(
             f"User {user_id} tried to start the game without selecting both player and item."
@@ -269,7 +1264,13 @@ async def start_game(message: types.Message):
         )
 
 
-async def congratulate_player(message: types.Message):
+async def congratulate_player(
+    message: types.Message,
+    sessions: SessionStore,
+    keyboards: Keyboards,
+    user: types.User,
+    stats: GameStats,
+):
     """
     Sends a congratulatory message to the user for completing the game by reaching level 9.
 
@@ -277,14 +1278,45 @@ async def congratulate_player(message: types.Message):
 
     Args:
         message (types.Message): The message object containing the user's level-up event.
+        sessions (SessionStore): The session store.
+        keyboards (Keyboards): The reply keyboards.
+        user (types.User): The user who completed the game.
+        stats (GameStats): The game statistics.
     """
     await message.answer(
         "🎉 Congratulations on reaching level 9! You've completed the game!"
     )
-    await end_game(message)
+    await end_game(message, sessions, keyboards, user, stats, reason="completed")
 
 
-async def show_location_info(message: types.Message):
+def nearest_unfinished_project(session, catalog):
+    """
+    Finds the closest project the player has not completed yet.
+
+    Uses the routing table of the catalog, so the lookup costs one distance read
+    per remaining project once the routes from the location are cached.
+
+    Args:
+        session (Session): The session whose position and quests are checked.
+        catalog (Catalog): The game content.
+
+    Returns:
+        tuple or None: ``(project_name, location_id, distance)``, or None if every
+        reachable project is done.
+    """
+    player = session.player
+    unfinished = {}
+    for verter in session.verters:
+        if not player.quests.get(verter.name, {}).get("done"):
+            unfinished.setdefault(catalog.quests[verter.name]["location"], verter.name)
+    nearest = catalog.routes.nearest(player.current_location, unfinished)
+    if nearest is None:
+        return None
+    location_id, distance = nearest
+    return unfinished[location_id], location_id, distance
+
+
+async def show_location_info(message: types.Message, session, catalog):
     """
     Displays the current location information to the player, along with available actions.
 
@@ -301,53 +1333,104 @@ async def show_location_info(message: types.Message):
 
     Args:
         message (types.Message): The message object from the user, used to display the location and available actions.
-    Global Variables:
-        player (Player): The player object containing the current location.
-        verters (List[Verter]): List of Verters present in the game world.
-        npcs (List[NPC]): List of NPCs present in the game world.
+        session (Session): The session with the player, verters and NPCs of the game.
+        catalog (Catalog): The game content.
     """
+    from tracing import span
 
-    global player, verters, npcs
-    current_location = locations[str(player.current_location)]
-    npcs_in_location = [npc for npc in npcs if npc.location == current_location["name"]]
+    locations = catalog.locations
+    current_location = locations[session.player.current_location]
+    npcs_in_location = [
+        npc for npc in session.npcs if npc.location == current_location["name"]
+    ]
     verters_in_location = [
-        verter for verter in verters if verter.location == current_location["name"]
+        verter
+        for verter in session.verters
+        if verter.location == current_location["name"]
     ]
 
-    direction_keyboard = InlineKeyboardBuilder()
-    for direction in current_location["connections"]:
-        direction_keyboard.button(
-            text=direction.capitalize(), callback_data=f"move_{direction}"
-        )
-    verter_keyboard = InlineKeyboardBuilder()
-    for verter in verters_in_location:
-        verter_keyboard.button(
-            text=f"Try {verter.name}", callback_data=f"fight_{verter.name}"
+    with span("keyboard"):
+        direction_keyboard = InlineKeyboardBuilder()
+        for direction in current_location["connections"]:
+            direction_keyboard.button(
+                text=direction.capitalize(), callback_data=f"move_{direction}"
+            )
+        direction_keyboard.button(text="🧭 Travel to...", callback_data="travelmenu")
+        direction_keyboard.button(text="🗺 Map", callback_data="map")
+        verter_keyboard = InlineKeyboardBuilder()
+        for verter in verters_in_location:
+            verter_keyboard.button(
+                text=f"Try {verter.name}", callback_data=f"fight_{verter.name}"
+            )
+        npc_keyboard = InlineKeyboardBuilder()
+        for npc in npcs_in_location:
+            npc_keyboard.button(text=npc.name, callback_data=f"talk_{npc.name}")
+
+        if len(verters_in_location) > 1:
+            verter_keyboard.button(
+                text="🏃 Run all projects here", callback_data="fightall"
+            )
+        verter_keyboard.adjust(3)
+        npc_keyboard.adjust(3)
+        direction_keyboard.adjust(2)
+        direction_markup = direction_keyboard.as_markup()
+        verter_markup = verter_keyboard.as_markup()
+        npc_markup = npc_keyboard.as_markup()
+
+    hint = ""
+    nearest = nearest_unfinished_project(session, catalog)
+    if nearest:
+        project_name, location_id, distance = nearest
+        where = (
+            "right here"
+            if distance == 0
+            else f"in {locations[location_id]['name']} ({distance} moves away)"
         )
-    npc_keyboard = InlineKeyboardBuilder()
-    for npc in npcs_in_location:
-        npc_keyboard.button(text=npc.name, callback_data=f"talk_{npc.name}")
-
-    verter_keyboard.adjust(3)
-    npc_keyboard.adjust(3)
-    direction_keyboard.adjust(2)
+        hint = f"\n\nNearest unfinished project: {project_name}, {where}."
 
     await message.answer(
-        text=f"Location: {current_location['name']}\n\nDescription: {current_location['description']}\n\nFrom this location you can go to direction:",
-        reply_markup=direction_keyboard.as_markup(),
+        text=f"Location: {current_location['name']}\n\nDescription: {current_location['description']}\n\n❤️ Nerve cells: {session.player.hp}{hint}\n\nFrom this location you can go to direction:",
+        reply_markup=direction_markup,
     )
     await message.answer(
         text="In this location you can start project:",
-        reply_markup=verter_keyboard.as_markup(),
+        reply_markup=verter_markup,
     )
     await message.answer(
         text="Try speakin with Peer in this location:",
-        reply_markup=npc_keyboard.as_markup(),
+        reply_markup=npc_markup,
     )
 
 
-@dp.callback_query(lambda c: c.data.startswith("fight_"))
-async def fight_verter(query: types.CallbackQuery):
+@on("inline_query")
+async def answer_inline_query(query: types.InlineQuery, inline_search: InlineSearch):
+    """
+    Handles inline queries: looks up projects and locations by name from any chat.
+
+    Results come from the search index and result cache of :mod:`inline`, a page
+    at a time; Telegram asks for the next page with the returned offset.
+
+    Args:
+        query (types.InlineQuery): The inline query.
+        inline_search (InlineSearch): The inline query search.
+    """
+    results, next_offset = inline_search.page(query.query, query.offset)
+    await query.answer(
+        results,
+        cache_time=inline_search.cache_time,
+        is_personal=False,
+        next_offset=next_offset,
+    )
+
+
+@on("callback_query", F.data.startswith("fight_"), InGame(), flags=GAME)
+async def fight_verter(
+    query: types.CallbackQuery,
+    session,
+    sessions: SessionStore,
+    keyboards: Keyboards,
+    stats: GameStats,
+):
     """
     Handles the player's request to fight a Verter (enemy).
 
@@ -357,33 +1440,130 @@ async def fight_verter(query: types.CallbackQuery):
 
     Args:
         query (types.CallbackQuery): The callback query from the player's interaction with the Verter.
-
-    Global Variables:
-        player (Player): The player object who is attacking the Verter.
-        verters (List[Verter]): List of all available Verters in the game world.
+        session (Session): The session of the player who is attacking the Verter.
+        sessions (SessionStore): The session store.
+        keyboards (Keyboards): The reply keyboards.
+        stats (GameStats): The game statistics.
     """
-    global player
+    from tracing import span
+
+    player = session.player
     verter_name = query.data.split("_")[1]
-    verter = next((verter for verter in verters if verter.name == verter_name), None)
+    verter = next(
+        (verter for verter in session.verters if verter.name == verter_name), None
+    )
 
     if verter:
         output = io.StringIO()
-        with contextlib.redirect_stdout(output):
+        with span("game", action="attack"), contextlib.redirect_stdout(output):
             player.attack(verter)
 
         response = output.getvalue().strip()
         await query.message.answer(response or "No response from the Verter.")
         await query.answer("You try project: " + verter_name + ".")
         if player.level == 9:
-            await congratulate_player(query.message)
-        if "therapist" in response:
-            await end_game(query.message)
+            await congratulate_player(
+                query.message, sessions, keyboards, query.from_user, stats
+            )
+        elif "therapist" in response:
+            await end_game(
+                query.message,
+                sessions,
+                keyboards,
+                query.from_user,
+                stats,
+                reason="expelled",
+            )
     else:
         await query.answer("This Verter does not exist.")
 
 
-@dp.callback_query(lambda c: c.data.startswith("talk_"))
-async def talk_to_npc(query: types.CallbackQuery):
+@on("callback_query", F.data == "fightall", InGame(), flags=GAME)
+async def fight_all_verters(
+    query: types.CallbackQuery,
+    session,
+    sessions: SessionStore,
+    keyboards: Keyboards,
+    catalog,
+    stats: GameStats,
+):
+    """
+    Handles the player's request to try every remaining project in the location at once.
+
+    Fights are resolved one after another against every Verter of the current location
+    whose project is not done yet, stopping early if the player gets expelled.
+    Instead of one message per fight, a single summary with the result, HP change and
+    level change of every project is sent.
+
+    Args:
+        query (types.CallbackQuery): The callback query from the "Run all projects here" button.
+        session (Session): The session of the player who is attacking the Verters.
+        sessions (SessionStore): The session store.
+        keyboards (Keyboards): The reply keyboards.
+        catalog (Catalog): The game content.
+        stats (GameStats): The game statistics.
+    """
+    from tracing import span
+
+    player = session.player
+    location_name = catalog.locations[player.current_location]["name"]
+    remaining = [
+        verter
+        for verter in session.verters
+        if verter.location == location_name
+        and not player.quests.get(verter.name, {}).get("done")
+    ]
+    if not remaining:
+        await query.answer("All projects here are already done.")
+        return
+
+    start_hp, start_level = player.hp, player.level
+    lines = []
+    expelled = False
+    for verter in remaining:
+        hp, level = player.hp, player.level
+        with span("game", action="attack"), contextlib.redirect_stdout(
+            io.StringIO()
+        ) as output:
+            player.attack(verter)
+        passed = player.quests.get(verter.name, {}).get("done")
+        line = f"{'✅' if passed else '❌'} {verter.name}: HP {player.hp - hp:+d}"
+        if player.level != level:
+            line += f", level {level} → {player.level}"
+        lines.append(line)
+        if "therapist" in output.getvalue() or player.level == 9:
+            expelled = "therapist" in output.getvalue()
+            break
+
+    skipped = len(remaining) - len(lines)
+    summary = "\n".join(lines)
+    summary += (
+        f"\n\nTotal: HP {start_hp} → {player.hp}, level {start_level} → {player.level}."
+    )
+    if skipped:
+        summary += f"\nStopped early, {skipped} project(s) not tried."
+    await query.message.answer(summary)
+    await query.answer(f"You tried {len(lines)} project(s).")
+    if player.level == 9:
+        await congratulate_player(
+            query.message, sessions, keyboards, query.from_user, stats
+        )
+    elif expelled:
+        await query.message.answer(
+            "####You have been expelled. You are given a certificate to visit a therapist.####"
+        )
+        await end_game(
+            query.message,
+            sessions,
+            keyboards,
+            query.from_user,
+            stats,
+            reason="expelled",
+        )
+
+
+@on("callback_query", F.data.startswith("talk_"), InGame(), flags=GAME)
+async def talk_to_npc(query: types.CallbackQuery, session):
     """
     Handles the player's request to talk to an NPC.
 
@@ -392,19 +1572,17 @@ async def talk_to_npc(query: types.CallbackQuery):
 
     Args:
         query (types.CallbackQuery): The callback query from the player's interaction with the NPC.
-
-    Global Variables:
-        player (Player): The player object who is talking to the NPC.
-        npcs (List[NPC]): List of all available NPCs in the game world.
+        session (Session): The session of the player who is talking to the NPC.
     """
-    global player
+    from tracing import span
+
     npc_name = query.data.split("_")[1]
-    npc = next((npc for npc in npcs if npc.name == npc_name), None)
+    npc = next((npc for npc in session.npcs if npc.name == npc_name), None)
 
     if npc:
         output = io.StringIO()
-        with contextlib.redirect_stdout(output):
-            player.talk_to(npc)
+        with span("game", action="talk"), contextlib.redirect_stdout(output):
+            session.player.talk_to(npc)
 
         response = output.getvalue().strip()
         await query.message.answer(response or "No response from the NPC.")
@@ -413,8 +1591,10 @@ async def talk_to_npc(query: types.CallbackQuery):
         await query.answer("This NPC does not exist.")
 
 
-@dp.callback_query(F.data.startswith("move_"))
-async def handle_move_callback(query: types.CallbackQuery):
+@on("callback_query", F.data.startswith("move_"), InGame(), flags=GAME)
+async def handle_move_callback(
+    query: types.CallbackQuery, session, catalog, stats: GameStats
+):
     """
     Handles the player's movement between locations.
 
@@ -423,27 +1603,424 @@ async def handle_move_callback(query: types.CallbackQuery):
 
     Args:
         query (types.CallbackQuery): The callback query from the player's interaction with the movement buttons.
-
-    Global Variables:
-        player (Player): The player object whose location is being updated.
-        locations (Dict[str, Dict]): A dictionary representing all locations and their connections in the game world.
+        session (Session): The session of the player whose location is being updated.
+        catalog (Catalog): The game content with all locations and their connections.
+        stats (GameStats): The game statistics.
     """
-    global player
+    player = session.player
     direction = query.data.split("_")[1]
-    current_location = locations[str(player.current_location)]
+    current_location = catalog.locations[player.current_location]
     if direction in current_location["connections"].keys():
         new_location = current_location["connections"][direction]
         player.current_location = new_location
-        await show_location_info(query.message)
+        player.visited.add(new_location)
+        stats.visited(catalog.locations[new_location]["name"])
+        await show_location_info(query.message, session, catalog)
         await query.answer()
     else:
         await query.answer(
-            f"Invalid direction! Available directions: {', '.join(locations[current_location]['connections'].keys())}."
+            f"Invalid direction! Available directions: {', '.join(current_location['connections'].keys())}."
+        )
+
+
+def travel_page(session, catalog, page: int):
+    """
+    Builds one page of the locations of the travel menu, nearest first.
+
+    Args:
+        session (Session): The session of the player who wants to travel.
+        catalog (Catalog): The game content.
+        page (int): The page number, clamped to the existing pages.
+
+    Returns:
+        tuple: The text and the inline keyboard of the page.
+    """
+    distances = catalog.routes.distances_from(session.player.current_location)
+    reachable = sorted(
+        (distance, location_id)
+        for location_id, distance in enumerate(distances)
+        if distance > 0
+    )
+    pages = max(1, -(-len(reachable) // TRAVEL_PAGE))
+    page = min(max(page, 0), pages - 1)
+    keyboard = InlineKeyboardBuilder()
+    for distance, location_id in reachable[
+        page * TRAVEL_PAGE : (page + 1) * TRAVEL_PAGE
+    ]:
+        keyboard.button(
+            text=f"{catalog.locations[location_id]['name']} ({distance})",
+            callback_data=f"goto_{location_id}",
+        )
+    keyboard.adjust(2)
+    if pages == 1:
+        return "Travel to location:", keyboard.as_markup()
+    navigation = []
+    if page > 0:
+        navigation.append(
+            types.InlineKeyboardButton(
+                text="◀️ Nearer", callback_data=f"travelpage_{page - 1}"
+            )
+        )
+    if page < pages - 1:
+        navigation.append(
+            types.InlineKeyboardButton(
+                text="Farther ▶️", callback_data=f"travelpage_{page + 1}"
+            )
+        )
+    keyboard.row(*navigation)
+    return f"Travel to location ({page + 1}/{pages}):", keyboard.as_markup()
+
+
+@on("callback_query", F.data == "travelmenu", InGame(), flags=GAME)
+async def show_travel_menu(query: types.CallbackQuery, session, catalog):
+    """
+    Shows the places the player can travel to in one step.
+
+    Lists the other reachable locations, nearest first and ``TRAVEL_PAGE`` at a
+    time, and the nearest unfinished projects, each annotated with the number of
+    moves the trip replaces.
+
+    Args:
+        query (types.CallbackQuery): The callback query from the "Travel to..." button.
+        session (Session): The session of the player who wants to travel.
+        catalog (Catalog): The game content.
+    """
+    from tracing import span
+
+    player = session.player
+    distances = catalog.routes.distances_from(player.current_location)
+    with span("keyboard"):
+        location_text, location_markup = travel_page(session, catalog, 0)
+        projects = []
+        for verter in session.verters:
+            if player.quests.get(verter.name, {}).get("done"):
+                continue
+            quest = catalog.quests[verter.name]
+            distance = distances[quest["location"]]
+            if distance > 0:
+                projects.append((distance, quest["id"], verter.name))
+        projects.sort()
+        project_keyboard = InlineKeyboardBuilder()
+        for distance, quest_id, name in projects[:TRAVEL_PAGE]:
+            project_keyboard.button(
+                text=f"{name} ({distance})", callback_data=f"goproj_{quest_id}"
+            )
+        project_keyboard.adjust(2)
+        project_markup = project_keyboard.as_markup()
+
+    await query.message.answer(text=location_text, reply_markup=location_markup)
+    await query.message.answer(
+        text=(
+            "Or go straight to a project:"
+            if len(projects) <= TRAVEL_PAGE
+            else "Or go straight to one of the nearest projects:"
+        ),
+        reply_markup=project_markup,
+    )
+    await query.answer()
+
+
+@on("callback_query", F.data.startswith("travelpage_"), InGame(), flags=GAME)
+async def turn_travel_page(query: types.CallbackQuery, session, catalog):
+    """
+    Shows another page of the locations of the travel menu in the same message.
+
+    Args:
+        query (types.CallbackQuery): The callback query with the page number.
+        session (Session): The session of the player who wants to travel.
+        catalog (Catalog): The game content.
+    """
+    text, markup = travel_page(session, catalog, int(query.data.split("_")[1]))
+    try:
+        await query.message.edit_text(text, reply_markup=markup)
+    except TelegramBadRequest:
+        # The page did not change, e.g. after a double tap.
+        pass
+    await query.answer()
+
+
+@on(
+    "callback_query",
+    F.data.startswith("goto_") | F.data.startswith("goproj_"),
+    InGame(),
+    flags=GAME,
+)
+async def handle_travel_callback(
+    query: types.CallbackQuery, session, catalog, stats: GameStats
+):
+    """
+    Moves the player along the shortest route to a location or project at once.
+
+    The route comes from the routing table of the catalog. Only the
+    destination is shown, instead of every location on the way.
+
+    Args:
+        query (types.CallbackQuery): The callback query with the destination location or project ID.
+        session (Session): The session of the player whose location is being updated.
+        catalog (Catalog): The game content.
+        stats (GameStats): The game statistics.
+    """
+    player = session.player
+    kind, target = query.data.split("_", 1)
+    if kind == "goproj":
+        destination = catalog.quests[catalog.quest_keys[int(target)]]["location"]
+    else:
+        destination = int(target)
+
+    path = catalog.routes.path(player.current_location, destination)
+    if path is None:
+        await query.answer("There is no way to get there from here.")
+        return
+    player.current_location = destination
+    player.visited.update(path)
+    stats.visited(catalog.locations[destination]["name"])
+    logger.debug(f"User {query.from_user.id} traveled {len(path)} moves.")
+    await show_location_info(query.message, session, catalog)
+    await query.answer(
+        f"You traveled {len(path)} moves to {catalog.locations[destination]['name']}."
+    )
+
+
+@on("callback_query", F.data == "map", InGame(), flags=MAP)
+async def show_map(query: types.CallbackQuery, session, catalog, maps: MapRenderer):
+    """
+    Sends an image of the map with the explored locations and the player's position.
+
+    Identical maps are sent again by their Telegram file ID, and otherwise
+    uploaded from the PNG cache or rendered off the event loop, see :mod:`mapimage`.
+
+    Args:
+        query (types.CallbackQuery): The callback query from the "Map" button.
+        session (Session): The session of the player.
+        catalog (Catalog): The game content.
+        maps (MapRenderer): The map renderer.
+    """
+    player = session.player
+    picture = await maps.render(catalog, player.visited, player.current_location)
+    caption = (
+        f"🗺 You are in {catalog.locations[player.current_location]['name']}. "
+        f"Explored {len(player.visited)} of {len(catalog.locations)} locations."
+    )
+    if picture.file_id is not None:
+        try:
+            await query.message.answer_photo(picture.file_id, caption=caption)
+            await query.answer()
+            return
+        except TelegramBadRequest:
+            maps.forget(picture.key)
+    sent = await query.message.answer_photo(FSInputFile(picture.path), caption=caption)
+    if sent is not None and sent.photo:
+        maps.remember(picture.key, sent.photo[-1].file_id)
+    await query.answer()
+
+
+@on("callback_query")
+async def handle_stale_callback(query: types.CallbackQuery):
+    """
+    Answers buttons pressed outside of a running game, e.g. after the game ended.
+
+    Args:
+        query (types.CallbackQuery): The callback query that no game handler accepted.
+    """
+    await query.answer("You are not in a game. Start the game first.")
+
+
+def setup_hosting(
+    dp: Dispatcher,
+    saved: Sequence[Any],
+    profile: bool = True,
+    health: Optional[HealthServer] = None,
+):
+    """
+    Registers the process-level hooks of a dispatcher before it starts polling.
+
+    The sessions and the ``saved`` objects are handed off between the old and
+    the new process through ``HANDOFF_FILE``, see :mod:`lifecycle`; it defaults
+    to the sessions directory, and every hosted bot gets its own. A starting
+    process waits up to ``HANDOFF_WAIT`` seconds for a predecessor that is still
+    draining to write its snapshot. The ``saved`` objects that changed are also
+    checkpointed every ``CHECKPOINT_INTERVAL`` seconds, 0 to only save them on
+    shutdown. An interrupted broadcast is resumed, and the timers start firing,
+    once the handoff is done.
+    ``PROFILE_SECONDS`` or ``PROFILE_UPDATES`` profile the first seconds or
+    updates after startup. The process stops being ready as soon as a
+    dispatcher shuts down.
+
+    Args:
+        dp (Dispatcher): The dispatcher of one bot.
+        saved (Sequence): Objects saved on shutdown and reloaded on startup.
+        profile (bool): Whether to profile on startup; only one profiler can run at a time.
+        health (HealthServer, optional): The health endpoints of the process.
+    """
+    from lifecycle import setup_lifecycle
+
+    if health is not None:
+
+        async def drain_health():
+            health.drain()
+
+        dp.shutdown.register(drain_health)
+    dp.shutdown.register(log_transport_stats)
+    setup_lifecycle(
+        dp,
+        dp["sessions"],
+        saved=saved,
+        handoff_file=namespaced(os.environ.get("HANDOFF_FILE"), dp["settings"].name)
+        or os.path.join(dp["sessions"].cold_dir, "handoff.snapshot"),
+        handoff_wait=float(os.environ.get("HANDOFF_WAIT", 30)),
+        checkpoint_interval=float(os.environ.get("CHECKPOINT_INTERVAL", 60)),
+    )
+    # After the takeover, once the previous process checkpointed its broadcast
+    # and its timers, and the sessions the timers notify are restored.
+    dp.startup.register(resume_broadcast)
+    dp.startup.register(start_scheduler)
+    # After the handoff, so that even updates that outlived the drain can write.
+    dp.shutdown.register(close_chat_registry)
+    profile_seconds = os.environ.get("PROFILE_SECONDS")
+    profile_updates = os.environ.get("PROFILE_UPDATES")
+    if profile and (profile_seconds or profile_updates):
+
+        async def log_profile(summary: str):
+            logger.info(summary)
+
+        async def profile_on_startup(profiler: Profiler):
+            profiler.start(
+                seconds=float(profile_seconds) if profile_seconds else None,
+                updates=int(profile_updates) if profile_updates else None,
+                on_done=log_profile,
+            )
+
+        dp.startup.register(profile_on_startup)
+
+
+def create_health(bots: Sequence[Bot], catalog) -> Optional[HealthServer]:
+    """
+    Creates the health endpoints configured from environment variables, if enabled.
+
+    ``HEALTH_PORT`` enables ``/livez`` and ``/readyz`` on ``HEALTH_HOST``. The
+    event loop lag is measured every ``LAG_INTERVAL`` seconds, a loop stuck for
+    ``LAG_THRESHOLD`` seconds gets its stack logged, and a process whose last
+    lag exceeds ``READY_LAG`` seconds is not ready, see :mod:`health`.
+
+    Args:
+        bots (Sequence[Bot]): The bots of the process, probed for Bot API reachability.
+        catalog (Catalog): The game content, for its version.
+
+    Returns:
+        HealthServer or None: The health endpoints, not started yet; None if ``HEALTH_PORT`` is not set.
+    """
+    if not os.environ.get("HEALTH_PORT"):
+        return None
+    from health import HealthServer, LagMonitor
+
+    return HealthServer(
+        LagMonitor(
+            interval=float(os.environ.get("LAG_INTERVAL", 0.5)),
+            threshold=float(os.environ.get("LAG_THRESHOLD", 1.0)),
+        ),
+        bots,
+        catalog.version,
+        ready_lag=float(os.environ.get("READY_LAG", 1.0)),
+    )
+
+
+async def serve_health(health: Optional[HealthServer]):
+    """
+    Starts the health endpoints, if enabled, on ``HEALTH_HOST:HEALTH_PORT``.
+
+    Args:
+        health (HealthServer, optional): The health endpoints, see :func:`create_health`.
+    """
+    if health is not None:
+        await health.start(
+            os.environ.get("HEALTH_HOST", "0.0.0.0"), int(os.environ["HEALTH_PORT"])
         )
 
 
+async def host_bots(bots: List[BotSettings]):
+    """
+    Polls several bots in one process and one event loop.
+
+    The bots share the catalog, the inline search, the map renderer and the
+    keyboards, see :func:`create_shared`, while each one has its own
+    :class:`aiogram.Bot`, dispatcher and sessions under ``SESSION_DIR/<name>``.
+    ``SIGINT`` and ``SIGTERM`` stop every bot, each draining and handing off its
+    own sessions.
+
+    Args:
+        bots (List[BotSettings]): The bots to host, e.g. from :func:`load_bot_settings`.
+    """
+    shared = create_shared()
+    clients = [create_bot(settings.token) for settings in bots]
+    health = create_health(clients, shared["catalog"])
+    hosted = []
+    for bot, settings in zip(clients, bots):
+        dp = create_dispatcher(settings=settings, shared=shared)
+        saved = (dp["leaderboard"], dp["stats"], dp["scheduler"])
+        if not hosted:
+            # The first bot saves and reloads the shared map file IDs.
+            saved += (shared["maps"],)
+        setup_hosting(dp, saved, profile=not hosted, health=health)
+        hosted.append((bot, dp))
+    logger.info(
+        f"Hosting {len(hosted)} bots: {', '.join(settings.name for settings in bots)}."
+    )
+
+    async def stop(dp: Dispatcher):
+        with contextlib.suppress(RuntimeError):
+            await dp.stop_polling()
+
+    def stop_all():
+        for _, dp in hosted:
+            asyncio.ensure_future(stop(dp))
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_all)
+    await serve_health(health)
+    try:
+        await asyncio.gather(
+            *(
+                dp.start_polling(
+                    bot,
+                    handle_signals=False,
+                    tasks_concurrency_limit=int(os.environ.get("MAX_BACKLOG", 1000)),
+                )
+                for bot, dp in hosted
+            )
+        )
+    finally:
+        await log_inline_stats(shared["inline_search"])
+        await close_map_renderer(shared["maps"])
+        if health is not None:
+            await health.stop()
+
+
 async def main():
-    await dp.start_polling(bot)
+    setup_logger()
+    bots_file = os.environ.get("BOTS_FILE")
+    if bots_file:
+        await host_bots(load_bot_settings(bots_file))
+        return
+    bot = create_bot()
+    dp = create_dispatcher()
+    health = create_health([bot], dp["catalog"])
+    setup_hosting(
+        dp,
+        saved=(dp["leaderboard"], dp["stats"], dp["scheduler"], dp["maps"]),
+        health=health,
+    )
+    await serve_health(health)
+    try:
+        # MAX_BACKLOG is a hard cap on the updates taken from Telegram and not
+        # finished, including those waiting for their user's lock or a handler
+        # slot; past it polling pauses. Load is shed earlier, at HIGH_WATER.
+        await dp.start_polling(
+            bot, tasks_concurrency_limit=int(os.environ.get("MAX_BACKLOG", 1000))
+        )
+    finally:
+        if health is not None:
+            await health.stop()
 
 
 if __name__ == "__main__":
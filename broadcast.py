@@ -0,0 +1,433 @@
+"""
+Module with the announcements sent by operators to every user of the bot.
+
+Every private chat that writes to the bot is recorded in a :class:`ChatRegistry`,
+an SQLite table of chat IDs that survives restarts and grows with one insert
+per new user. A :class:`Broadcaster` then sends an announcement to the chats
+of the registry in pages of ``page_size`` chat IDs, in chat ID order, at most
+``rate`` messages per second, below the global limit of about 30 messages per
+second of the Bot API.
+
+After every page the broadcast records the last chat ID it reached, so a
+broadcast interrupted by a restart or a crash resumes from there and at most
+one page of chats receives the announcement twice. Chats that blocked the bot
+or were deleted are pruned from the registry, and the counters and the status
+of the last broadcast are reported with ``/broadcast``. Only the errors of a
+chat itself count it as failed: while the Bot API is unreachable, answers with
+a server error or its circuit breaker is open, the broadcast backs off and
+retries the same chat instead of skipping the chats past it.
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.types import Message
+
+logger = logging.getLogger(__name__)
+
+# Chat IDs of private chats are positive; a cursor below every chat ID starts a
+# broadcast from the first chat.
+FIRST_CHAT = -(2**63)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL,
+    cursor INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    pruned INTEGER NOT NULL DEFAULT 0,
+    started REAL NOT NULL,
+    finished REAL,
+    cancelled INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class ChatRegistry:
+    """
+    Persistent set of the chat IDs that started the bot, with the broadcasts to them.
+
+    Attributes
+    ----------
+    path : str
+        The SQLite database file.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ----------
+        path : str
+            The SQLite database file; created if missing.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(broadcasts)")}
+        if "cancelled" not in columns:
+            self.db.execute(
+                "ALTER TABLE broadcasts ADD COLUMN cancelled INTEGER NOT NULL DEFAULT 0"
+            )
+        self._known: Set[int] = {
+            chat_id for (chat_id,) in self.db.execute("SELECT chat_id FROM chats")
+        }
+
+    def __len__(self) -> int:
+        return len(self._known)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._known
+
+    def add(self, chat_id: int) -> bool:
+        """
+        Record a chat; known chats cost a set lookup and no write.
+
+        Returns
+        -------
+        bool
+            Whether the chat was new.
+        """
+        if chat_id in self._known:
+            return False
+        self.db.execute(
+            "INSERT OR IGNORE INTO chats (chat_id, added) VALUES (?, ?)",
+            (chat_id, time.time()),
+        )
+        self._known.add(chat_id)
+        return True
+
+    def remove(self, chat_id: int) -> None:
+        """
+        Forget a chat, e.g. one that blocked the bot.
+        """
+        self.db.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+        self._known.discard(chat_id)
+
+    def page(self, after: int, size: int) -> List[int]:
+        """
+        The next chat IDs, in order.
+
+        Parameters
+        ----------
+        after : int
+            Chat ID after which the page starts; ``FIRST_CHAT`` for the first page.
+        size : int
+            Maximum number of chat IDs.
+
+        Returns
+        -------
+        List[int]
+            The chat IDs; empty after the last chat.
+        """
+        return [
+            chat_id
+            for (chat_id,) in self.db.execute(
+                "SELECT chat_id FROM chats WHERE chat_id > ? ORDER BY chat_id LIMIT ?",
+                (after, size),
+            )
+        ]
+
+    def close(self) -> None:
+        """
+        Close the database.
+        """
+        self.db.close()
+
+
+class RegistryMiddleware(BaseMiddleware):
+    """
+    Records the private chats that write to the bot in a :class:`ChatRegistry`.
+    """
+
+    def __init__(self, registry: ChatRegistry):
+        self.registry = registry
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        if event.chat.type == "private":
+            self.registry.add(event.chat.id)
+        return await handler(event, data)
+
+
+class Broadcaster:
+    """
+    Sends announcements to every chat of a registry, one broadcast at a time.
+
+    Attributes
+    ----------
+    registry : ChatRegistry
+        The chats to send to, and where broadcasts are checkpointed.
+    rate : float
+        Maximum messages per second.
+    page_size : int
+        Chat IDs read and checkpointed at a time.
+    backoff : float
+        Seconds before the first retry of a chat while the Bot API fails.
+    max_backoff : float
+        Longest wait between retries, doubled from ``backoff``.
+    """
+
+    def __init__(
+        self,
+        registry: ChatRegistry,
+        rate: float = 20.0,
+        page_size: int = 100,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        """
+        Parameters
+        ----------
+        registry : ChatRegistry
+            The chats to send to, and where broadcasts are checkpointed.
+        rate : float
+            Maximum messages per second.
+        page_size : int
+            Chat IDs read and checkpointed at a time.
+        backoff : float
+            Seconds before the first retry of a chat while the Bot API fails.
+        max_backoff : float
+            Longest wait between retries, doubled from ``backoff``.
+        """
+        self.registry = registry
+        self.rate = rate
+        self.page_size = page_size
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        """
+        Whether a broadcast is being sent.
+        """
+        return self._task is not None and not self._task.done()
+
+    def start(self, bot: Bot, text: str) -> int:
+        """
+        Start sending an announcement to every chat of the registry.
+
+        Parameters
+        ----------
+        bot : Bot
+            The bot to send with.
+        text : str
+            The announcement.
+
+        Returns
+        -------
+        int
+            The ID of the broadcast.
+
+        Raises
+        ------
+        RuntimeError
+            If another broadcast is running.
+        """
+        if self.running:
+            raise RuntimeError("Another broadcast is running.")
+        # A broadcast that stopped on an error is superseded by the new one.
+        self.registry.db.execute(
+            "UPDATE broadcasts SET finished = ?, cancelled = 1 WHERE finished IS NULL",
+            (time.time(),),
+        )
+        broadcast_id = self.registry.db.execute(
+            "INSERT INTO broadcasts (text, cursor, total, started) VALUES (?, ?, ?, ?)",
+            (text, FIRST_CHAT, len(self.registry), time.time()),
+        ).lastrowid
+        self._spawn(self._send(bot, broadcast_id))
+        return broadcast_id
+
+    def resume(self, bot: Bot) -> Optional[int]:
+        """
+        Resume the last broadcast if it was interrupted before it finished.
+
+        Parameters
+        ----------
+        bot : Bot
+            The bot to send with.
+
+        Returns
+        -------
+        int or None
+            The ID of the resumed broadcast, or None.
+        """
+        row = self.registry.db.execute(
+            "SELECT id FROM broadcasts WHERE finished IS NULL ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        if row is None or self.running:
+            return None
+        logger.info(f"Resuming broadcast {row[0]}: {self.progress()}")
+        self._spawn(self._send(bot, row[0]))
+        return row[0]
+
+    def _spawn(self, coro: Awaitable[None]) -> None:
+        # In an empty context: the task outlives the /broadcast update, and
+        # must not hold on to its trace, see :mod:`tracing`.
+        self._task = contextvars.Context().run(asyncio.create_task, coro)
+
+    async def cancel(self) -> bool:
+        """
+        Stop the running broadcast; it is checkpointed and marked as cancelled.
+
+        Returns
+        -------
+        bool
+            Whether a broadcast was running.
+        """
+        if not self.running:
+            return False
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self.registry.db.execute(
+            "UPDATE broadcasts SET finished = ?, cancelled = 1 WHERE finished IS NULL",
+            (time.time(),),
+        )
+        return True
+
+    async def stop(self) -> None:
+        """
+        Interrupt the running broadcast on shutdown, to be resumed on startup.
+        """
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def progress(self) -> Optional[Dict[str, Any]]:
+        """
+        Counters of the last broadcast.
+
+        Returns
+        -------
+        dict or None
+            ``id``, ``total``, ``sent``, ``failed`` and ``pruned`` chats,
+            ``running``, the ``status`` (``"running"``, ``"finished"`` once every
+            chat was reached, ``"cancelled"``, or ``"interrupted"`` by a restart
+            or an error) and the ``seconds`` it has been or was sent for; None if
+            there was no broadcast.
+        """
+        row = self.registry.db.execute(
+            "SELECT id, total, sent, failed, pruned, started, finished, cancelled "
+            "FROM broadcasts ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        broadcast_id, total, sent, failed, pruned, started, finished, cancelled = row
+        if self.running:
+            status = "running"
+        elif finished is None:
+            status = "interrupted"
+        else:
+            status = "cancelled" if cancelled else "finished"
+        return {
+            "id": broadcast_id,
+            "total": total,
+            "sent": sent,
+            "failed": failed,
+            "pruned": pruned,
+            "running": self.running,
+            "status": status,
+            "seconds": (finished or time.time()) - started,
+        }
+
+    async def _deliver(self, bot: Bot, chat_id: int, text: str) -> str:
+        delay = self.backoff
+        while True:
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                return "sent"
+            except TelegramRetryAfter as error:
+                logger.warning(f"Broadcast throttled for {error.retry_after}s.")
+                await asyncio.sleep(error.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as error:
+                # Also the open circuit breaker: the chat is fine, the API is not.
+                logger.warning(f"Broadcast paused for {delay}s: {error}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+            except TelegramForbiddenError:
+                self.registry.remove(chat_id)
+                return "pruned"
+            except TelegramAPIError as error:
+                logger.debug(f"Broadcast to {chat_id} failed: {error}")
+                return "failed"
+
+    async def _send(self, bot: Bot, broadcast_id: int) -> None:
+        db = self.registry.db
+        text, cursor = db.execute(
+            "SELECT text, cursor FROM broadcasts WHERE id = ?", (broadcast_id,)
+        ).fetchone()
+        interval = 1 / self.rate
+        counts = {"sent": 0, "failed": 0, "pruned": 0}
+
+        def checkpoint(finished: Optional[float] = None):
+            db.execute(
+                "UPDATE broadcasts SET cursor = ?, sent = sent + ?, failed = failed + ?,"
+                " pruned = pruned + ?, finished = ? WHERE id = ?",
+                (
+                    cursor,
+                    counts["sent"],
+                    counts["failed"],
+                    counts["pruned"],
+                    finished,
+                    broadcast_id,
+                ),
+            )
+            for outcome in counts:
+                counts[outcome] = 0
+
+        next_send = time.monotonic()
+        try:
+            while True:
+                chat_ids = self.registry.page(cursor, self.page_size)
+                if not chat_ids:
+                    break
+                for chat_id in chat_ids:
+                    delay = next_send - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    next_send = max(next_send, time.monotonic()) + interval
+                    counts[await self._deliver(bot, chat_id, text)] += 1
+                    cursor = chat_id
+                checkpoint()
+                logger.info(f"Broadcast {broadcast_id}: {self.progress()}")
+        except asyncio.CancelledError:
+            checkpoint()
+            raise
+        except Exception:
+            checkpoint()
+            logger.exception(f"Broadcast {broadcast_id} stopped.")
+            raise
+        checkpoint(time.time())
+        logger.info(f"Broadcast {broadcast_id} finished: {self.progress()}")
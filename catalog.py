@@ -0,0 +1,420 @@
+"""
+Module for compiling game content into a single prebuilt catalog.
+
+The compiler validates ``info/*.json`` for consistency (quest keys and names,
+project locations, item and NPC references, map connections, NPC dialogues),
+resolves the
+cross-references to integer IDs and writes one artifact that the bot reads
+at startup instead of parsing every content file separately.
+
+Usage::
+
+    python3 catalog.py              # validate and write info/catalog.json
+    python3 catalog.py --check      # validate only
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from typing import Any, Dict, List, Optional
+
+from dialogue import Dialogue, compile_dialogues, validate_dialogues
+from routing import RoutingTable
+
+INFO_DIR = "info"
+CATALOG_FILE = os.path.join(INFO_DIR, "catalog.json")
+SOURCE_FILES = (
+    "dialogues.json",
+    "items.json",
+    "locations.json",
+    "phrases.json",
+    "quests.json",
+)
+CATALOG_FORMAT = 2
+START_LOCATION_KEY = "1"
+
+NPC_NAMES = [
+    "Meow, Booba",
+    "Odsi Whish",
+    "Ymir Fritz",
+    "Mario",
+    "Bowser",
+    "Sakura",
+    "Nana",
+    "Karnaks Puck",
+    "Fry",
+    "Basic",
+    "Johnny Silverhand",
+    "V",
+    "Bender Rodriges",
+    "Sif",
+    "Belmont",
+]
+NPC_TYPES = ["Peer", "ADM", "Other"]
+OPPOSITE_DIRECTIONS = {
+    "North": "South",
+    "South": "North",
+    "East": "West",
+    "West": "East",
+}
+
+
+class ContentError(ValueError):
+    """
+    Raised when game content fails validation.
+
+    Attributes
+    ----------
+    errors : List[str]
+        Every problem found, one message per entry.
+    """
+
+    def __init__(self, errors: List[str]):
+        self.errors = errors
+        super().__init__(
+            f"{len(errors)} content error(s):\n" + "\n".join(f"- {e}" for e in errors)
+        )
+
+
+class Catalog:
+    """
+    Immutable, validated view of the game content.
+
+    Attributes
+    ----------
+    version : str
+        Hash of the source files the catalog was compiled from.
+    start_location : int
+        ID of the location where every game starts.
+    locations : List[Dict[str, Any]]
+        Locations indexed by their integer ID. ``connections`` map a direction
+        to the integer ID of the neighbouring location.
+    location_ids : Dict[str, int]
+        Maps the original location keys from ``locations.json`` to IDs.
+    quests : Dict[str, Dict[str, Any]]
+        Quests keyed by name. ``location`` and ``item_id`` hold resolved IDs.
+    quest_keys : List[str]
+        Quest names indexed by quest ID.
+    projects : List[str]
+        Names of the quests of type ``project``.
+    items : List[Dict[str, Any]]
+        Items indexed by their integer ID.
+    phrases : Dict[str, List[str]]
+        Verter and peer phrases.
+    npc_names : List[str]
+        Names NPCs can have.
+    npc_types : List[str]
+        Types NPCs can have.
+    routes : RoutingTable
+        Shortest paths between locations, computed on demand.
+    dialogues : Dict[str, Dialogue]
+        Compiled dialogue of every NPC type.
+    """
+
+    def __init__(self, data: Dict[str, Any]):
+        self.version: str = data["version"]
+        self.start_location: int = data["start_location"]
+        self.locations: List[Dict[str, Any]] = data["locations"]
+        self.location_ids: Dict[str, int] = {
+            location["key"]: location["id"] for location in self.locations
+        }
+        self.quests: Dict[str, Dict[str, Any]] = data["quests"]
+        self.quest_keys: List[str] = list(self.quests)
+        self.projects: List[str] = data["projects"]
+        self.items: List[Dict[str, Any]] = data["items"]
+        self.phrases: Dict[str, List[str]] = data["phrases"]
+        self.npc_names: List[str] = data["npc_names"]
+        self.npc_types: List[str] = data["npc_types"]
+        self.routes: RoutingTable = RoutingTable(self.locations)
+        self.dialogues: Dict[str, Dialogue] = {
+            npc_type: Dialogue(tables) for npc_type, tables in data["dialogues"].items()
+        }
+
+    def location_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        """
+        Find a location by its display name.
+
+        Parameters
+        ----------
+        name : str
+            The name of the location.
+
+        Returns
+        -------
+        dict or None
+            The location, or None if no location has that name.
+        """
+        return next((loc for loc in self.locations if loc["name"] == name), None)
+
+
+def _read_sources(info_dir: str) -> Dict[str, Any]:
+    sources = {}
+    for file_name in SOURCE_FILES:
+        with open(os.path.join(info_dir, file_name), "r") as file:
+            sources[file_name] = json.load(file)
+    return sources
+
+
+def _sources_version(info_dir: str) -> str:
+    digest = hashlib.sha256()
+    for file_name in SOURCE_FILES:
+        with open(os.path.join(info_dir, file_name), "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+
+def validate_content(
+    items: Dict[str, Any],
+    locations: Dict[str, Dict[str, Any]],
+    phrases: Dict[str, List[str]],
+    quests: Dict[str, Dict[str, Any]],
+    dialogues: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> List[str]:
+    """
+    Check the raw content files for consistency.
+
+    Parameters
+    ----------
+    items : dict
+        Contents of ``items.json``.
+    locations : dict
+        Contents of ``locations.json``.
+    phrases : dict
+        Contents of ``phrases.json``.
+    quests : dict
+        Contents of ``quests.json``.
+    dialogues : dict, optional
+        Contents of ``dialogues.json``; not checked if not given.
+
+    Returns
+    -------
+    list
+        Human-readable error messages; empty if the content is consistent.
+    """
+    errors = []
+
+    if START_LOCATION_KEY not in locations:
+        errors.append(f"start location '{START_LOCATION_KEY}' does not exist")
+    for key, location in locations.items():
+        for field in ("name", "description", "connections"):
+            if field not in location:
+                errors.append(f"location '{key}' has no '{field}'")
+        for direction, target in location.get("connections", {}).items():
+            if target not in locations:
+                errors.append(
+                    f"location '{key}' connects {direction} to missing location '{target}'"
+                )
+                continue
+            back = locations[target].get("connections", {})
+            opposite = OPPOSITE_DIRECTIONS.get(direction)
+            if opposite is None:
+                errors.append(f"location '{key}' has unknown direction '{direction}'")
+            elif back.get(opposite) != key:
+                errors.append(
+                    f"location '{key}' connects {direction} to '{target}', "
+                    f"but '{target}' does not connect {opposite} back"
+                )
+
+    item_names = set()
+    for item in items.get("items", []):
+        if item["name"] in item_names:
+            errors.append(f"item '{item['name']}' is defined more than once")
+        item_names.add(item["name"])
+
+    for key, quest in quests.items():
+        if quest.get("name") != key:
+            errors.append(f"quest '{key}' has mismatched name '{quest.get('name')}'")
+        for field in ("description", "health", "level_points", "phrase", "type"):
+            if field not in quest:
+                errors.append(f"quest '{key}' has no '{field}'")
+        if quest.get("location_id") not in locations:
+            errors.append(
+                f"quest '{key}' is at missing location '{quest.get('location_id')}'"
+            )
+        if "item" in quest and quest["item"] not in item_names:
+            errors.append(f"quest '{key}' needs unknown item '{quest['item']}'")
+        if "npc_name" in quest and quest["npc_name"] not in NPC_NAMES:
+            errors.append(f"quest '{key}' refers to unknown NPC '{quest['npc_name']}'")
+        if "npc_type" in quest and quest["npc_type"] not in NPC_TYPES:
+            errors.append(
+                f"quest '{key}' refers to unknown NPC type '{quest['npc_type']}'"
+            )
+        deadline = quest.get("deadline_minutes")
+        if deadline is not None and (type(deadline) is not int or deadline <= 0):
+            errors.append(f"quest '{key}' has invalid deadline '{deadline}'")
+
+    for group, minimum in (("verter_phrases", 1), ("peer_phrases", 5)):
+        if len(phrases.get(group, [])) < minimum:
+            errors.append(f"phrases need at least {minimum} '{group}'")
+
+    if dialogues is not None:
+        for npc_type in NPC_TYPES:
+            if npc_type not in dialogues:
+                errors.append(f"NPC type '{npc_type}' has no dialogue")
+        errors += validate_dialogues(dialogues)
+
+    return errors
+
+
+def compile_catalog(info_dir: str = INFO_DIR) -> Dict[str, Any]:
+    """
+    Validate the content in ``info_dir`` and build the catalog data.
+
+    Parameters
+    ----------
+    info_dir : str
+        Directory with the source JSON files.
+
+    Returns
+    -------
+    dict
+        Serializable catalog data, see :class:`Catalog`.
+
+    Raises
+    ------
+    ContentError
+        If the content is inconsistent.
+    """
+    sources = _read_sources(info_dir)
+    items = sources["items.json"]
+    locations = sources["locations.json"]
+    phrases = sources["phrases.json"]
+    quests = sources["quests.json"]
+    dialogues = sources["dialogues.json"]
+
+    errors = validate_content(items, locations, phrases, quests, dialogues)
+    if errors:
+        raise ContentError(errors)
+
+    location_keys = sorted(locations, key=lambda key: (len(key), key))
+    location_ids = {key: index for index, key in enumerate(location_keys)}
+    item_ids = {item["name"]: index for index, item in enumerate(items["items"])}
+
+    compiled_locations = [
+        {
+            "id": location_ids[key],
+            "key": key,
+            "name": locations[key]["name"],
+            "description": locations[key]["description"],
+            "universe": locations[key].get("universe", ""),
+            "connections": {
+                direction: location_ids[target]
+                for direction, target in locations[key]["connections"].items()
+            },
+        }
+        for key in location_keys
+    ]
+    compiled_quests = {}
+    for index, (key, quest) in enumerate(quests.items()):
+        compiled = {
+            **quest,
+            "id": index,
+            "location": location_ids[quest["location_id"]],
+        }
+        if "item" in quest:
+            compiled["item_id"] = item_ids[quest["item"]]
+        compiled_quests[key] = compiled
+
+    return {
+        "format": CATALOG_FORMAT,
+        "version": _sources_version(info_dir),
+        "start_location": location_ids[START_LOCATION_KEY],
+        "locations": compiled_locations,
+        "quests": compiled_quests,
+        "projects": [
+            key for key, quest in quests.items() if quest.get("type") == "project"
+        ],
+        "items": [{**item, "id": index} for index, item in enumerate(items["items"])],
+        "phrases": phrases,
+        "npc_names": NPC_NAMES,
+        "npc_types": NPC_TYPES,
+        "dialogues": compile_dialogues(dialogues),
+    }
+
+
+def write_catalog(data: Dict[str, Any], catalog_file: str = CATALOG_FILE) -> None:
+    """
+    Write compiled catalog data to disk atomically.
+
+    Parameters
+    ----------
+    data : dict
+        Catalog data returned by :func:`compile_catalog`.
+    catalog_file : str
+        Path of the artifact to write.
+    """
+    tmp_file = catalog_file + ".tmp"
+    with open(tmp_file, "w") as file:
+        json.dump(data, file, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_file, catalog_file)
+
+
+def _is_stale(catalog_file: str, info_dir: str) -> bool:
+    try:
+        built = os.stat(catalog_file).st_mtime
+    except FileNotFoundError:
+        return True
+    return any(
+        os.stat(os.path.join(info_dir, file_name)).st_mtime > built
+        for file_name in SOURCE_FILES
+    )
+
+
+def load_catalog(catalog_file: str = CATALOG_FILE, info_dir: str = INFO_DIR) -> Catalog:
+    """
+    Load the prebuilt catalog with a single read.
+
+    If the artifact is missing, stale or was written by another format
+    version, the content is compiled (and validated) in memory instead.
+
+    Parameters
+    ----------
+    catalog_file : str
+        Path of the prebuilt artifact.
+    info_dir : str
+        Directory with the source JSON files.
+
+    Returns
+    -------
+    Catalog
+        The loaded catalog.
+    """
+    if not _is_stale(catalog_file, info_dir):
+        with open(catalog_file, "r") as file:
+            data = json.load(file)
+        if data.get("format") == CATALOG_FORMAT:
+            return Catalog(data)
+    return Catalog(compile_catalog(info_dir))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Validate and compile game content.")
+    parser.add_argument("--info-dir", default=INFO_DIR, help="content directory")
+    parser.add_argument("-o", "--output", default=CATALOG_FILE, help="artifact path")
+    parser.add_argument(
+        "--check", action="store_true", help="only validate, do not write"
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        data = compile_catalog(args.info_dir)
+    except ContentError as error:
+        print(error, file=sys.stderr)
+        return 1
+
+    if not args.check:
+        write_catalog(data, args.output)
+        print(
+            f"Catalog {data['version']} written to {args.output}: "
+            f"{len(data['locations'])} locations, {len(data['quests'])} quests, "
+            f"{len(data['items'])} items."
+        )
+    else:
+        print("Content is consistent.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
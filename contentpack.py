@@ -0,0 +1,527 @@
+"""
+Module with memory-mapped content packs.
+
+A content pack holds the compiled catalog (see :mod:`catalog`) in one file
+made of a small JSON header, fixed-width offset indexes and a data region
+with one JSON record per location, quest, item or phrase. The file is opened
+with :mod:`mmap`, so the worker processes of a host share its pages in the
+page cache instead of each holding a parsed copy of ``info/*.json``.
+
+Records are decoded only when they are read, and the most recently read ones
+are kept in a small LRU cache. A section of records behaves like a read-only
+list (:class:`Records`) or, when its records have keys, like a read-only dict
+(:class:`KeyedRecords`), so a :class:`catalog.Catalog` can be built on top of
+a pack without changing the code that reads it.
+
+File layout (integers are little-endian)::
+
+    b"CPAK" | format: u32 | header size: u32 | header: JSON
+    for every section:
+        index:  count * (offset: u64, key size: u32, value size: u32)
+        hashes: count * (key hash: u64, record: u32), sorted, keyed sections only
+    data: key bytes followed by the JSON value, for every record
+
+Usage::
+
+    python3 contentpack.py build            # compile info/ into info/content.pack
+    python3 contentpack.py stats            # describe the sections of a pack
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from bisect import bisect_left
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from catalog import INFO_DIR, Catalog, _is_stale, compile_catalog
+
+PACK_FILE = os.path.join(INFO_DIR, "content.pack")
+PACK_FORMAT = 2
+MAGIC = b"CPAK"
+PREFIX = struct.Struct("<4sII")
+ENTRY = struct.Struct("<QII")
+HASH = struct.Struct("<QI")
+META_FIELDS = (
+    "version",
+    "start_location",
+    "projects",
+    "npc_names",
+    "npc_types",
+    "dialogues",
+)
+
+_packs: Dict[str, "ContentPack"] = {}
+
+
+def _key_hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def _encode(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def write_pack(
+    sections: Dict[str, Iterable[Tuple[Optional[str], Any]]],
+    meta: Dict[str, Any],
+    pack_file: str = PACK_FILE,
+) -> None:
+    """
+    Write a content pack to disk atomically.
+
+    A pack opened from the same path with :func:`open_pack` is closed, and the
+    next call opens the new file.
+
+    Parameters
+    ----------
+    sections : Dict[str, Iterable[Tuple[Optional[str], Any]]]
+        Records of every section as ``(key, value)`` pairs. A section is keyed
+        if its first record has a key; then every record needs a unique key.
+    meta : Dict[str, Any]
+        Small JSON-serializable data stored in the header.
+    pack_file : str
+        Path of the pack to write.
+    """
+    data = bytearray()
+    layouts = []
+    for name, records in sections.items():
+        index = bytearray()
+        hashes = []
+        keyed = None
+        for number, (key, value) in enumerate(records):
+            if keyed is None:
+                keyed = key is not None
+            key_bytes = key.encode() if keyed else b""
+            value_bytes = _encode(value)
+            index += ENTRY.pack(len(data), len(key_bytes), len(value_bytes))
+            data += key_bytes + value_bytes
+            if keyed:
+                hashes.append((_key_hash(key_bytes), number))
+        hashes.sort()
+        layouts.append(
+            (
+                name,
+                index,
+                b"".join(HASH.pack(*entry) for entry in hashes) if keyed else None,
+            )
+        )
+
+    # Offsets in the header depend on the header size, so settle it first.
+    header_size = 0
+    while True:
+        offset = PREFIX.size + header_size
+        header = {"meta": meta, "sections": {}}
+        for name, index, hashes in layouts:
+            section = {"count": len(index) // ENTRY.size, "index": offset}
+            offset += len(index)
+            if hashes is not None:
+                section["hashes"] = offset
+                offset += len(hashes)
+            header["sections"][name] = section
+        header["data"] = offset
+        header_bytes = _encode(header)
+        if len(header_bytes) <= header_size:
+            header_bytes = header_bytes.ljust(header_size)
+            break
+        header_size = len(header_bytes) + 16
+
+    # A temporary file of its own, so workers rebuilding the same pack at once
+    # do not write into each other's file.
+    descriptor, tmp_file = tempfile.mkstemp(
+        prefix=os.path.basename(pack_file) + ".",
+        suffix=".tmp",
+        dir=os.path.dirname(os.path.abspath(pack_file)),
+    )
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(PREFIX.pack(MAGIC, PACK_FORMAT, header_size))
+            file.write(header_bytes)
+            for _, index, hashes in layouts:
+                file.write(index)
+                if hashes is not None:
+                    file.write(hashes)
+            file.write(data)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, pack_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    # The opened pack maps the replaced file, so it would keep serving the old
+    # content.
+    pack = _packs.pop(os.path.abspath(pack_file), None)
+    if pack is not None:
+        pack.close()
+
+
+def build_pack(data: Dict[str, Any], pack_file: str = PACK_FILE) -> None:
+    """
+    Write compiled catalog data as a content pack.
+
+    Parameters
+    ----------
+    data : dict
+        Catalog data returned by :func:`catalog.compile_catalog`.
+    pack_file : str
+        Path of the pack to write.
+    """
+    write_pack(
+        {
+            "locations": ((None, location) for location in data["locations"]),
+            "quests": data["quests"].items(),
+            "items": ((None, item) for item in data["items"]),
+            **{
+                f"phrases.{group}": ((None, phrase) for phrase in phrases)
+                for group, phrases in data["phrases"].items()
+            },
+        },
+        {field: data[field] for field in META_FIELDS},
+        pack_file,
+    )
+
+
+class ContentPack:
+    """
+    A content pack opened with :mod:`mmap`.
+
+    Attributes
+    ----------
+    path : str
+        Path of the pack.
+    meta : Dict[str, Any]
+        The data stored in the header.
+    cache_size : int
+        Number of decoded records kept in the LRU cache.
+    hits : int
+        Reads answered from the cache.
+    misses : int
+        Reads that decoded a record.
+    """
+
+    def __init__(self, path: str = PACK_FILE, cache_size: int = 256):
+        """
+        Parameters
+        ----------
+        path : str
+            Path of the pack.
+        cache_size : int
+            Number of decoded records kept in the LRU cache.
+
+        Raises
+        ------
+        ValueError
+            If the file is not a content pack of a supported format.
+        """
+        self.path = path
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[Tuple[str, int], Any]" = OrderedDict()
+        with open(path, "rb") as file:
+            self._buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_size = PREFIX.unpack_from(self._buffer)
+        if magic != MAGIC or version != PACK_FORMAT:
+            self._buffer.close()
+            raise ValueError(f"{path} is not a content pack of format {PACK_FORMAT}")
+        header = json.loads(self._buffer[PREFIX.size : PREFIX.size + header_size])
+        self.meta: Dict[str, Any] = header["meta"]
+        self._data: int = header["data"]
+        self._sections: Dict[str, Dict[str, int]] = header["sections"]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._sections
+
+    def __getitem__(self, name: str) -> "_Section":
+        section = self._sections[name]
+        return (KeyedRecords if "hashes" in section else Records)(self, name)
+
+    def sections(self) -> List[str]:
+        """
+        Names of the sections, in file order.
+        """
+        return list(self._sections)
+
+    def count(self, name: str) -> int:
+        """
+        Number of records of a section.
+        """
+        return self._sections[name]["count"]
+
+    def _entry(self, name: str, number: int) -> Tuple[int, int, int]:
+        section = self._sections[name]
+        if not 0 <= number < section["count"]:
+            raise IndexError(number)
+        offset, key_size, value_size = ENTRY.unpack_from(
+            self._buffer, section["index"] + number * ENTRY.size
+        )
+        return self._data + offset, key_size, value_size
+
+    def key(self, name: str, number: int) -> str:
+        """
+        Key of a record, without decoding its value.
+        """
+        offset, key_size, _ = self._entry(name, number)
+        return self._buffer[offset : offset + key_size].decode()
+
+    def decode(self, name: str, number: int) -> Any:
+        """
+        Decode a record, bypassing the cache; every call returns a new object.
+        """
+        offset, key_size, value_size = self._entry(name, number)
+        start = offset + key_size
+        return json.loads(self._buffer[start : start + value_size])
+
+    def read(self, name: str, number: int) -> Any:
+        """
+        Read a record through the LRU cache.
+
+        The returned object is shared with later reads, so it must not be
+        modified; use :meth:`decode` for a private copy.
+        """
+        cache_key = (name, number)
+        value = self._cache.get(cache_key)
+        if value is not None:
+            self.hits += 1
+            self._cache.move_to_end(cache_key)
+            return value
+        self.misses += 1
+        value = self.decode(name, number)
+        self._cache[cache_key] = value
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return value
+
+    def find(self, name: str, key: str) -> Optional[int]:
+        """
+        Number of the record with a key, with a binary search of the key hashes.
+
+        Returns
+        -------
+        int or None
+            The record number, or None if no record has that key.
+        """
+        section = self._sections[name]
+        start, count = section["hashes"], section["count"]
+        key_bytes = key.encode()
+        key_hash = _key_hash(key_bytes)
+
+        def hash_at(position: int) -> int:
+            return HASH.unpack_from(self._buffer, start + position * HASH.size)[0]
+
+        position = bisect_left(range(count), key_hash, key=hash_at)
+        while position < count:
+            entry_hash, number = HASH.unpack_from(
+                self._buffer, start + position * HASH.size
+            )
+            if entry_hash != key_hash:
+                break
+            if self.key(name, number) == key:
+                return number
+            position += 1
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Size of the pack and efficiency of the cache.
+
+        Returns
+        -------
+        dict
+            ``bytes``, ``cached``, ``hits``, ``misses`` and ``hit_rate``.
+        """
+        reads = self.hits + self.misses
+        return {
+            "bytes": len(self._buffer),
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / reads if reads else 0.0,
+        }
+
+    def close(self) -> None:
+        """
+        Unmap the file.
+        """
+        self._cache.clear()
+        self._buffer.close()
+
+
+def open_pack(path: str = PACK_FILE) -> ContentPack:
+    """
+    Open a content pack, or return the already opened one for the same path.
+
+    Sharing one :class:`ContentPack` per file keeps a single mapping and cache
+    however many games and sessions read from it.
+    """
+    path = os.path.abspath(path)
+    pack = _packs.get(path)
+    if pack is None:
+        pack = _packs[path] = ContentPack(path)
+    return pack
+
+
+class _Section:
+    def __init__(self, pack: ContentPack, name: str):
+        self.pack = pack
+        self.name = name
+
+    def __len__(self) -> int:
+        return self.pack.count(self.name)
+
+    def __reduce__(self):
+        return _open_section, (self.pack.path, self.name)
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.name} of {self.pack.path}>"
+
+
+class Records(_Section, Sequence):
+    """
+    Read-only list view of a section of a content pack.
+
+    Items are read through the cache of the pack. Iterating decodes every
+    record without caching it, so a full scan does not evict the hot records.
+    A deep copy is a plain list of freshly decoded records, and pickling keeps
+    only the path of the pack and the name of the section.
+    """
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[number] for number in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return self.pack.read(self.name, index)
+
+    def __iter__(self) -> Iterator[Any]:
+        for number in range(len(self)):
+            yield self.pack.decode(self.name, number)
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> List[Any]:
+        return list(self)
+
+
+class KeyedRecords(_Section, Mapping):
+    """
+    Read-only dict view of a keyed section of a content pack.
+
+    Keys are read without decoding the records, and a lookup by key is a binary
+    search over the sorted key hashes. A deep copy is a plain dict of freshly
+    decoded records, and pickling keeps only the path of the pack and the name
+    of the section.
+    """
+
+    def __getitem__(self, key: str) -> Any:
+        number = self.pack.find(self.name, key)
+        if number is None:
+            raise KeyError(key)
+        return self.pack.read(self.name, number)
+
+    def __iter__(self) -> Iterator[str]:
+        for number in range(len(self)):
+            yield self.pack.key(self.name, number)
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self.pack.find(self.name, key) is not None
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> Dict[str, Any]:
+        return {
+            self.pack.key(self.name, number): self.pack.decode(self.name, number)
+            for number in range(len(self))
+        }
+
+
+def _open_section(path: str, name: str) -> _Section:
+    return open_pack(path)[name]
+
+
+def pack_catalog(pack: ContentPack) -> Catalog:
+    """
+    Build a catalog whose locations, quests, items and phrases stay in a pack.
+
+    Parameters
+    ----------
+    pack : ContentPack
+        The opened pack.
+
+    Returns
+    -------
+    Catalog
+        The catalog.
+    """
+    prefix = "phrases."
+    return Catalog(
+        {
+            **pack.meta,
+            "locations": pack["locations"],
+            "quests": pack["quests"],
+            "items": pack["items"],
+            "phrases": {
+                name[len(prefix) :]: pack[name]
+                for name in pack.sections()
+                if name.startswith(prefix)
+            },
+        }
+    )
+
+
+def load_pack_catalog(pack_file: str = PACK_FILE, info_dir: str = INFO_DIR) -> Catalog:
+    """
+    Load the catalog from a content pack, rebuilding the pack if it is stale.
+
+    A pack written by another format version is rebuilt too.
+
+    Parameters
+    ----------
+    pack_file : str
+        Path of the pack.
+    info_dir : str
+        Directory with the source JSON files.
+
+    Returns
+    -------
+    Catalog
+        The catalog, see :func:`pack_catalog`.
+    """
+    if not _is_stale(pack_file, info_dir):
+        try:
+            return pack_catalog(open_pack(pack_file))
+        except ValueError:
+            pass  # Written by another format version.
+    build_pack(compile_catalog(info_dir), pack_file)
+    return pack_catalog(open_pack(pack_file))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Build or inspect content packs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Compile content into a pack.")
+    build_parser.add_argument("--info-dir", default=INFO_DIR, help="content directory")
+    build_parser.add_argument("-o", "--output", default=PACK_FILE, help="pack path")
+    stats_parser = subparsers.add_parser("stats", help="Describe a pack.")
+    stats_parser.add_argument("pack", nargs="?", default=PACK_FILE)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        data = compile_catalog(args.info_dir)
+        build_pack(data, args.output)
+        print(
+            f"Content pack {data['version']} written to {args.output}: "
+            f"{os.path.getsize(args.output)} bytes."
+        )
+        return 0
+
+    pack = ContentPack(args.pack)
+    print(f"Content pack {pack.meta['version']}, {pack.stats()['bytes']} bytes:")
+    for name in pack.sections():
+        print(f"  {name}: {pack.count(name)} records")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
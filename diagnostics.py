@@ -0,0 +1,370 @@
+"""
+Module with memory diagnostics: what a game costs, and where memory grows.
+
+:func:`session_footprint` estimates the deep size of one session by
+component: the quest dicts of the game, the sampled inventories, the phrase
+lists of the NPCs, and the rest of the protagonist, the NPCs and the verters.
+Objects reachable from the catalog are shared by every game and are not
+counted, so the figures are the cost of one more game. :func:`account_sessions`
+sums the footprints of a sample of the sessions in memory, for capacity
+planning, and :func:`session_sizer` measures whole sessions for the memory
+budget of the session store.
+
+:class:`AllocationTracker` wraps :mod:`tracemalloc`: it takes snapshots of the
+live allocations on demand and reports the allocation sites that grew the most
+between two snapshots, to find leaks. Tracing slows the bot down, so it only
+runs between ``/memory start`` and ``/memory stop``.
+"""
+
+import gc
+import sys
+import tracemalloc
+from types import BuiltinFunctionType, FunctionType, ModuleType
+from typing import AbstractSet, Any, Callable, Dict, Iterable, List, Optional, Set
+
+from catalog import Catalog
+from dialogue import DEFAULT_DIALOGUE
+from session import Session
+
+# Referents that belong to the program rather than to the data.
+SKIPPED_TYPES = (type, ModuleType, FunctionType, BuiltinFunctionType)
+
+COMPONENTS = (
+    "quests",
+    "inventories",
+    "npc_phrases",
+    "player",
+    "npcs",
+    "verters",
+    "session",
+)
+
+
+def deep_size(obj: Any, seen: Set[int], shared: AbstractSet[int] = frozenset()) -> int:
+    """
+    Size of an object and of everything it references that is not in ``seen``.
+
+    Parameters
+    ----------
+    obj : Any
+        The object to measure.
+    seen : Set[int]
+        IDs of the objects already counted; updated with the objects counted now.
+    shared : AbstractSet[int]
+        IDs of objects that are not counted either, left unchanged.
+
+    Returns
+    -------
+    int
+        The size in bytes, as reported by :func:`sys.getsizeof`.
+    """
+    size = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if (
+            id(current) in seen
+            or id(current) in shared
+            or isinstance(current, SKIPPED_TYPES)
+        ):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        stack.extend(gc.get_referents(current))
+    return size
+
+
+def shared_ids(catalog: Catalog) -> Set[int]:
+    """
+    IDs of the objects reachable from the catalog, and of the default dialogue, shared by every game.
+
+    Parameters
+    ----------
+    catalog : Catalog
+        The game content.
+
+    Returns
+    -------
+    Set[int]
+        The object IDs.
+    """
+    seen: Set[int] = set()
+    deep_size(catalog, seen)
+    deep_size(DEFAULT_DIALOGUE, seen)
+    return seen
+
+
+def session_footprint(session: Session, shared: Set[int]) -> Dict[str, int]:
+    """
+    Deep size of a session by component, without the objects shared with the catalog.
+
+    The components are measured in the order of ``COMPONENTS``, and an object is
+    counted in the first one that reaches it: a quest dict held by a verter
+    counts as ``quests``, and the verter around it as ``verters``.
+
+    Parameters
+    ----------
+    session : Session
+        The session to measure.
+    shared : Set[int]
+        IDs of the shared objects, see :func:`shared_ids`.
+
+    Returns
+    -------
+    Dict[str, int]
+        Bytes by component of ``COMPONENTS``.
+    """
+    seen = set(shared)
+    player = session.player
+    npcs = session.npcs or []
+    verters = session.verters or []
+    parts = {
+        "quests": [player.quests if player else None]
+        + [npc.quest for npc in npcs]
+        + [verter.quest for verter in verters],
+        "inventories": [player.inventory if player else None]
+        + [npc.inventory for npc in npcs],
+        "npc_phrases": [npc.phrases for npc in npcs],
+        "player": [player],
+        "npcs": [npcs],
+        "verters": [verters],
+        "session": [session],
+    }
+    return {
+        component: sum(
+            deep_size(obj, seen) for obj in parts[component] if obj is not None
+        )
+        for component in COMPONENTS
+    }
+
+
+def session_sizer(catalog: Catalog) -> Callable[[Session], int]:
+    """
+    Function measuring the deep size of a session without the shared objects.
+
+    The shared objects are collected on the first call, not at startup.
+
+    Parameters
+    ----------
+    catalog : Catalog
+        The game content, whose objects are not counted.
+
+    Returns
+    -------
+    Callable
+        Returns the size in bytes of a session.
+    """
+    shared: Optional[Set[int]] = None
+
+    def measure(session: Session) -> int:
+        nonlocal shared
+        if shared is None:
+            shared = shared_ids(catalog)
+        return deep_size(session, set(), shared)
+
+    return measure
+
+
+def account_sessions(
+    sessions: Iterable[Session], catalog: Catalog, limit: int = 200
+) -> Dict[str, Any]:
+    """
+    Memory of the sessions in memory by component, measured on a sample.
+
+    Parameters
+    ----------
+    sessions : Iterable[Session]
+        The sessions in memory.
+    catalog : Catalog
+        The game content, whose objects are not counted.
+    limit : int
+        Maximum number of sessions measured.
+
+    Returns
+    -------
+    dict
+        The number of ``sessions`` and ``games`` in memory, the number
+        ``measured``, the mean bytes per session and per game by component
+        (``per_session`` and ``per_game``), the largest session (``max``) and
+        the ``estimated_total`` of all sessions in memory.
+    """
+    sessions = list(sessions)
+    games = sum(1 for session in sessions if session.in_game)
+    sample = sessions[-limit:]
+    shared = shared_ids(catalog)
+    totals = dict.fromkeys(COMPONENTS, 0)
+    game_totals = dict.fromkeys(COMPONENTS, 0)
+    measured_games = 0
+    largest = 0
+    for session in sample:
+        footprint = session_footprint(session, shared)
+        largest = max(largest, sum(footprint.values()))
+        for component, size in footprint.items():
+            totals[component] += size
+            if session.in_game:
+                game_totals[component] += size
+        measured_games += session.in_game
+    per_session = {
+        component: size // len(sample) if sample else 0
+        for component, size in totals.items()
+    }
+    return {
+        "sessions": len(sessions),
+        "games": games,
+        "measured": len(sample),
+        "per_session": per_session,
+        "per_game": {
+            component: size // measured_games if measured_games else 0
+            for component, size in game_totals.items()
+        },
+        "max": largest,
+        "estimated_total": sum(per_session.values()) * len(sessions),
+    }
+
+
+class AllocationTracker:
+    """
+    Takes :mod:`tracemalloc` snapshots on demand and diffs them.
+
+    Attributes
+    ----------
+    frames : int
+        Frames kept per allocation traceback.
+    snapshots : List[tracemalloc.Snapshot]
+        Snapshots since tracing started, oldest first; the first is the baseline.
+    max_snapshots : int
+        Snapshots kept besides the baseline.
+    """
+
+    def __init__(self, frames: int = 1, max_snapshots: int = 3):
+        """
+        Parameters
+        ----------
+        frames : int
+            Frames kept per allocation traceback; more frames cost more memory.
+        max_snapshots : int
+            Snapshots kept besides the baseline.
+        """
+        self.frames = frames
+        self.max_snapshots = max_snapshots
+        self.snapshots: List[tracemalloc.Snapshot] = []
+
+    @property
+    def active(self) -> bool:
+        """
+        Whether allocations are being traced.
+        """
+        return tracemalloc.is_tracing()
+
+    def start(self) -> None:
+        """
+        Start tracing and take the baseline snapshot.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.snapshots = []
+        self.snapshot()
+
+    def stop(self) -> None:
+        """
+        Stop tracing and drop the snapshots.
+        """
+        tracemalloc.stop()
+        self.snapshots = []
+
+    def snapshot(self) -> tracemalloc.Snapshot:
+        """
+        Take a snapshot of the live allocations, without the tracer's own.
+
+        Returns
+        -------
+        tracemalloc.Snapshot
+            The snapshot, also kept in ``snapshots``.
+
+        Raises
+        ------
+        RuntimeError
+            If tracing is not running.
+        """
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("Allocation tracing is not running.")
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<unknown>"),
+            )
+        )
+        self.snapshots.append(snapshot)
+        if len(self.snapshots) > self.max_snapshots + 1:
+            del self.snapshots[1]
+        return snapshot
+
+    def top_growth(
+        self, limit: int = 10, since_baseline: bool = False
+    ) -> List[tracemalloc.StatisticDiff]:
+        """
+        The allocation sites that grew the most between two snapshots.
+
+        Parameters
+        ----------
+        limit : int
+            Maximum number of sites.
+        since_baseline : bool
+            Compare the last snapshot with the baseline instead of the one before.
+
+        Returns
+        -------
+        List[tracemalloc.StatisticDiff]
+            The sites by line, largest growth first, only those that grew.
+
+        Raises
+        ------
+        RuntimeError
+            If fewer than two snapshots were taken.
+        """
+        if len(self.snapshots) < 2:
+            raise RuntimeError("Take another snapshot to compare with.")
+        before = self.snapshots[0] if since_baseline else self.snapshots[-2]
+        diffs = self.snapshots[-1].compare_to(before, "lineno")
+        return [diff for diff in diffs if diff.size_diff > 0][:limit]
+
+    def report(self, limit: int = 10, since_baseline: bool = False) -> str:
+        """
+        Text report of :meth:`top_growth` and of the traced memory.
+
+        Returns
+        -------
+        str
+            One line per growing site, with the growth in KiB and in blocks.
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"Traced {current / 1024:.0f} KiB (peak {peak / 1024:.0f} KiB), "
+            f"{len(self.snapshots)} snapshots."
+        ]
+        for diff in self.top_growth(limit, since_baseline):
+            frame = diff.traceback[0]
+            lines.append(
+                f"+{diff.size_diff / 1024:.1f} KiB "
+                f"+{diff.count_diff} blocks  {frame.filename}:{frame.lineno}"
+            )
+        return "\n".join(lines)
+
+
+def format_footprint(report: Dict[str, Any]) -> str:
+    """
+    Text version of :func:`account_sessions` for the ``/memory`` command.
+    """
+    per_game = report["per_game"]
+    lines = [
+        f"🧠 {report['sessions']} sessions in memory, {report['games']} games; "
+        f"{report['measured']} measured.",
+        f"Per game: {sum(per_game.values()) / 1024:.1f} KiB"
+        f" (largest session {report['max'] / 1024:.1f} KiB)",
+    ]
+    lines += [
+        f"  {component}: {size / 1024:.1f} KiB" for component, size in per_game.items()
+    ]
+    lines.append(f"All sessions: ~{report['estimated_total'] / 1024 ** 2:.1f} MiB")
+    return "\n".join(lines)
@@ -0,0 +1,196 @@
+"""
+Module with the compiled dialogue engine of the NPCs.
+
+Dialogues are written per NPC type in ``info/dialogues.json`` as a graph of
+named nodes. A node says a line and may have effects. It then moves to one of
+its ``next`` nodes, drawn at random by weight::
+
+    "Peer": {
+        "start": "chat",
+        "nodes": {
+            "chat": {"say": "{phrase}", "next": {"chat": 5, "quest": 1}},
+            "quest": {"say": "{quest}", "effects": ["quest"], "next": {"chat": 1}}
+        }
+    }
+
+A line is either plain text or one of the placeholders ``{phrase}`` (a phrase
+of the NPC), ``{quest}`` (the phrase of the NPC's quest) and ``{item}`` (the
+phrase of an item of the NPC). The effects are ``quest`` (the NPC gives its
+quest), ``item`` (the NPC gives the item it spoke of and the protagonist
+recovers its mental health) and ``heal`` (the protagonist recovers the
+``heal`` HP of the node).
+
+The graphs are compiled once, with the catalog, into integer tables indexed by
+node number. Where a conversation stands is then a single int per NPC of a
+game, and a talk step is a few table lookups, without comparing any strings.
+"""
+
+from typing import Any, Dict, List, Tuple
+
+SAY_TEXT = 0
+SAY_PHRASE = 1
+SAY_QUEST = 2
+SAY_ITEM = 3
+PLACEHOLDERS = {"{phrase}": SAY_PHRASE, "{quest}": SAY_QUEST, "{item}": SAY_ITEM}
+
+GIVE_QUEST = 1
+GIVE_ITEM = 2
+HEAL = 4
+EFFECTS = {"quest": GIVE_QUEST, "item": GIVE_ITEM, "heal": HEAL}
+
+
+def validate_dialogues(dialogues: Dict[str, Dict[str, Any]]) -> List[str]:
+    """
+    Check dialogue graphs for consistency.
+
+    Parameters
+    ----------
+    dialogues : Dict[str, Dict[str, Any]]
+        Contents of ``dialogues.json``: graphs keyed by NPC type.
+
+    Returns
+    -------
+    list
+        Human-readable error messages; empty if the graphs are consistent.
+    """
+    errors = []
+    for npc_type, graph in dialogues.items():
+        nodes = graph.get("nodes", {})
+        if not nodes:
+            errors.append(f"dialogue '{npc_type}' has no nodes")
+        if graph.get("start") not in nodes:
+            errors.append(
+                f"dialogue '{npc_type}' starts at missing node '{graph.get('start')}'"
+            )
+        for name, node in nodes.items():
+            where = f"dialogue '{npc_type}' node '{name}'"
+            if not isinstance(node.get("say"), str):
+                errors.append(f"{where} has no 'say' line")
+            for effect in node.get("effects", []):
+                if effect not in EFFECTS:
+                    errors.append(f"{where} has unknown effect '{effect}'")
+            if "item" in node.get("effects", []) and node.get("say") != "{item}":
+                errors.append(f"{where} gives an item without saying '{{item}}'")
+            if "heal" in node.get("effects", []) and not node.get("heal"):
+                errors.append(f"{where} heals without a 'heal' amount")
+            if not node.get("next"):
+                errors.append(f"{where} has no 'next' nodes")
+            for target, weight in node.get("next", {}).items():
+                if target not in nodes:
+                    errors.append(f"{where} leads to missing node '{target}'")
+                if not isinstance(weight, int) or weight < 1:
+                    errors.append(
+                        f"{where} has invalid weight {weight!r} for '{target}'"
+                    )
+    return errors
+
+
+def compile_dialogues(dialogues: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Compile validated dialogue graphs into serializable tables.
+
+    Node names become node numbers, lines become ``(kind, text)`` pairs,
+    effects become bit masks, and the weighted ``next`` nodes become tuples in
+    which every node is repeated by its weight, so a uniform draw is a
+    weighted one.
+
+    Parameters
+    ----------
+    dialogues : Dict[str, Dict[str, Any]]
+        Contents of ``dialogues.json``, see :func:`validate_dialogues`.
+
+    Returns
+    -------
+    dict
+        Tables keyed by NPC type, see :class:`Dialogue`.
+    """
+    compiled = {}
+    for npc_type, graph in dialogues.items():
+        names = list(graph["nodes"])
+        numbers = {name: number for number, name in enumerate(names)}
+        nodes = [graph["nodes"][name] for name in names]
+        compiled[npc_type] = {
+            "start": numbers[graph["start"]],
+            "nodes": names,
+            "say": [
+                [PLACEHOLDERS.get(node["say"], SAY_TEXT), node["say"]] for node in nodes
+            ],
+            "effects": [
+                sum(EFFECTS[effect] for effect in set(node.get("effects", [])))
+                for node in nodes
+            ],
+            "heal": [node.get("heal", 0) for node in nodes],
+            "next": [
+                [
+                    numbers[target]
+                    for target, weight in node["next"].items()
+                    for _ in range(weight)
+                ]
+                for node in nodes
+            ],
+        }
+    return compiled
+
+
+class Dialogue:
+    """
+    State-transition tables of the dialogue of one NPC type.
+
+    Attributes
+    ----------
+    start : int
+        Node where every conversation starts.
+    nodes : Tuple[str, ...]
+        Node names, by node number, for debugging.
+    say : Tuple[Tuple[int, str], ...]
+        Kind of line (``SAY_*``) and its text, by node number.
+    effects : Tuple[int, ...]
+        Bit mask of effects (``GIVE_QUEST``, ``GIVE_ITEM``, ``HEAL``), by node number.
+    heal : Tuple[int, ...]
+        HP recovered with the ``HEAL`` effect, by node number.
+    next : Tuple[Tuple[int, ...], ...]
+        Following nodes, repeated by weight, by node number.
+    """
+
+    def __init__(self, data: Dict[str, Any]):
+        """
+        Parameters
+        ----------
+        data : Dict[str, Any]
+            Tables of one NPC type, as returned by :func:`compile_dialogues`.
+        """
+        self.start: int = data["start"]
+        self.nodes: Tuple[str, ...] = tuple(data["nodes"])
+        self.say: Tuple[Tuple[int, str], ...] = tuple(map(tuple, data["say"]))
+        self.effects: Tuple[int, ...] = tuple(data["effects"])
+        self.heal: Tuple[int, ...] = tuple(data["heal"])
+        self.next: Tuple[Tuple[int, ...], ...] = tuple(map(tuple, data["next"]))
+
+
+# Dialogue of NPCs without one of their own: a phrase, the quest or an item at
+# every step, with the odds of an NPC's five phrases, one quest and two items.
+DEFAULT_DIALOGUE = Dialogue(
+    compile_dialogues(
+        {
+            "default": {
+                "start": "chat",
+                "nodes": {
+                    "chat": {
+                        "say": "{phrase}",
+                        "next": {"chat": 5, "quest": 1, "item": 2},
+                    },
+                    "quest": {
+                        "say": "{quest}",
+                        "effects": ["quest"],
+                        "next": {"chat": 5, "quest": 1, "item": 2},
+                    },
+                    "item": {
+                        "say": "{item}",
+                        "effects": ["item"],
+                        "next": {"chat": 5, "quest": 1, "item": 2},
+                    },
+                },
+            }
+        }
+    )["default"]
+)
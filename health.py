@@ -0,0 +1,374 @@
+"""
+Module with the event-loop lag monitor and the liveness and readiness endpoints.
+
+Every handler of every user runs on one event loop, so a synchronous call that
+takes a while, such as reading JSON from disk or a long fight, delays all other
+updates. A :class:`LagMonitor` sleeps for ``interval`` seconds over and over and
+records how late it wakes up in a histogram. A watchdog thread watches the
+heartbeat of the monitor: when the loop has not come back for ``threshold``
+seconds, it logs the stack of the loop thread, which shows the blocking call,
+and the asyncio task that is running it.
+
+:class:`HealthServer` serves two endpoints for the orchestrator over HTTP:
+
+``/livez``
+    200 while the loop answers and the monitor runs; a stuck process does not
+    answer at all and is restarted.
+``/readyz``
+    200 while the process is not shutting down, the recent loop lag is below
+    ``ready_lag`` and the Bot API answers; 503 otherwise, to drain the replica.
+
+Both report the loop lag, the Bot API reachability and the catalog version as
+JSON.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Sequence
+
+from aiogram import Bot
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the lag histogram buckets, in milliseconds.
+BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LagMonitor:
+    """
+    Measures how late the event loop runs a timer, and dumps stacks of stalls.
+
+    Attributes
+    ----------
+    interval : float
+        Seconds between measurements.
+    threshold : float
+        Seconds without a measurement after which the loop counts as stalled.
+    samples : int
+        Number of measurements.
+    histogram : List[int]
+        Measurements by bucket of ``BUCKETS_MS``, the last bucket for longer lags.
+    last : float
+        The last lag, in seconds.
+    max : float
+        The longest lag, in seconds.
+    stalls : int
+        Number of stalls detected by the watchdog.
+    last_stall : str or None
+        Stack dump of the last stall.
+    """
+
+    def __init__(self, interval: float = 0.5, threshold: float = 1.0):
+        """
+        Parameters
+        ----------
+        interval : float
+            Seconds between measurements.
+        threshold : float
+            Seconds without a measurement after which the loop counts as stalled.
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = 0
+        self.histogram: List[int] = [0] * (len(BUCKETS_MS) + 1)
+        self.last = 0.0
+        self.max = 0.0
+        self.stalls = 0
+        self.last_stall: Optional[str] = None
+        self._heartbeat = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        """
+        Whether the monitor task is measuring.
+        """
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        """
+        Start measuring on the running loop and start the watchdog thread.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._measure())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        """
+        Stop measuring and stop the watchdog thread.
+        """
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._watchdog is not None:
+            self._watchdog.join()
+
+    def record(self, lag: float) -> None:
+        """
+        Add a measured lag, in seconds, to the histogram.
+        """
+        self.samples += 1
+        self.last = lag
+        self.max = max(self.max, lag)
+        self.histogram[bisect_left(BUCKETS_MS, lag * 1000)] += 1
+
+    def percentile(self, share: float) -> float:
+        """
+        Upper bound of the bucket holding a percentile of the lags, in milliseconds.
+
+        Parameters
+        ----------
+        share : float
+            The percentile, e.g. 0.99.
+
+        Returns
+        -------
+        float
+            The bound; the longest lag for the last bucket, 0 without measurements.
+        """
+        rank = share * self.samples
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= rank:
+                return (
+                    BUCKETS_MS[bucket] if bucket < len(BUCKETS_MS) else self.max * 1000
+                )
+        return 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Summary of the lags.
+
+        Returns
+        -------
+        dict
+            ``samples``, ``last_ms``, ``p50_ms``, ``p99_ms`` and ``max_ms``, the
+            number of ``stalls`` and the ``histogram`` by bucket bound.
+        """
+        labels = [f"<={bound}ms" for bound in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}ms"]
+        return {
+            "samples": self.samples,
+            "last_ms": round(self.last * 1000, 2),
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max * 1000, 2),
+            "stalls": self.stalls,
+            "histogram": dict(zip(labels, self.histogram)),
+        }
+
+    async def _measure(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            self.record(max(0.0, now - expected))
+
+    def _watch(self) -> None:
+        stalled = False
+        while not self._stop.wait(self.threshold / 4):
+            silent = time.monotonic() - self._heartbeat
+            if silent < self.interval + self.threshold:
+                stalled = False
+            elif not stalled:
+                stalled = True
+                self.stalls += 1
+                self.last_stall = self._dump()
+                logger.warning(
+                    f"Event loop stalled for {silent:.2f}s:\n{self.last_stall}"
+                )
+
+    def _dump(self) -> str:
+        frame = sys._current_frames().get(self._loop_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame else "(no frame)\n"
+        task = asyncio.current_task(self._loop)
+        return f"Running task: {task!r}\n{stack}"
+
+
+class HealthServer:
+    """
+    Serves ``/livez`` and ``/readyz`` for the bots of the process.
+
+    Attributes
+    ----------
+    monitor : LagMonitor
+        The loop lag monitor.
+    bots : Sequence[Bot]
+        The bots whose Bot API reachability is checked.
+    catalog_version : str
+        Version of the game content.
+    ready_lag : float
+        Longest recent loop lag, in seconds, of a ready process.
+    probe_ttl : float
+        Seconds a Bot API probe result is reused.
+    draining : bool
+        Whether the process is shutting down; set by :meth:`drain`.
+    """
+
+    def __init__(
+        self,
+        monitor: LagMonitor,
+        bots: Sequence[Bot],
+        catalog_version: str,
+        ready_lag: float = 1.0,
+        probe_ttl: float = 5.0,
+        probe_timeout: float = 3.0,
+    ):
+        """
+        Parameters
+        ----------
+        monitor : LagMonitor
+            The loop lag monitor.
+        bots : Sequence[Bot]
+            The bots whose Bot API reachability is checked.
+        catalog_version : str
+            Version of the game content.
+        ready_lag : float
+            Longest recent loop lag, in seconds, of a ready process.
+        probe_ttl : float
+            Seconds a Bot API probe result is reused.
+        probe_timeout : float
+            Seconds a Bot API probe may take.
+        """
+        self.monitor = monitor
+        self.bots = list(bots)
+        self.catalog_version = catalog_version
+        self.ready_lag = ready_lag
+        self.probe_ttl = probe_ttl
+        self.probe_timeout = probe_timeout
+        self.draining = False
+        self._probed = 0.0
+        self._reachable: Dict[str, Any] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    async def bot_api(self) -> Dict[str, Any]:
+        """
+        Whether each bot can reach the Bot API, probed with ``getMe``.
+
+        Returns
+        -------
+        dict
+            ``True``, or the error, by bot ID.
+        """
+        if time.monotonic() - self._probed < self.probe_ttl:
+            return self._reachable
+
+        async def probe(bot: Bot) -> Any:
+            try:
+                await asyncio.wait_for(bot.get_me(), self.probe_timeout)
+            except Exception as error:
+                return f"{type(error).__name__}: {error}"
+            return True
+
+        results = await asyncio.gather(*(probe(bot) for bot in self.bots))
+        self._reachable = {
+            str(bot.id): result for bot, result in zip(self.bots, results)
+        }
+        self._probed = time.monotonic()
+        return self._reachable
+
+    def drain(self) -> None:
+        """
+        Report the process as not ready from now on.
+        """
+        self.draining = True
+
+    async def livez(self, request: web.Request) -> web.Response:
+        """
+        Liveness: the loop answered, and 503 if the lag monitor died.
+        """
+        alive = self.monitor.running
+        return web.json_response(
+            {
+                "status": "ok" if alive else "monitor stopped",
+                "catalog": self.catalog_version,
+                "lag": self.monitor.stats(),
+            },
+            status=200 if alive else 503,
+        )
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        """
+        Readiness: 503 while draining, lagging or without the Bot API.
+        """
+        bot_api = await self.bot_api()
+        if self.draining:
+            status = "draining"
+        elif self.monitor.last > self.ready_lag:
+            status = "lagging"
+        elif not all(result is True for result in bot_api.values()):
+            status = "bot api unreachable"
+        else:
+            status = "ok"
+        return web.json_response(
+            {
+                "status": status,
+                "catalog": self.catalog_version,
+                "bot_api": bot_api,
+                "lag": self.monitor.stats(),
+            },
+            status=200 if status == "ok" else 503,
+        )
+
+    def create_app(self) -> web.Application:
+        """
+        The aiohttp application serving ``/livez`` and ``/readyz``.
+        """
+        app = web.Application()
+        app.router.add_get("/livez", self.livez)
+        app.router.add_get("/readyz", self.readyz)
+        return app
+
+    async def start(self, host: str = "0.0.0.0", port: int = 8080) -> str:
+        """
+        Start the lag monitor and the HTTP server.
+
+        Parameters
+        ----------
+        host : str
+            Address to listen on.
+        port : int
+            Port to listen on; 0 picks a free one.
+
+        Returns
+        -------
+        str
+            The base URL of the server.
+        """
+        self.monitor.start()
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        logger.info(f"Health endpoints listening on http://{host}:{port}.")
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        """
+        Stop the HTTP server and the lag monitor.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+        await self.monitor.stop()
@@ -0,0 +1,343 @@
+"""
+Module with the inline-mode search over projects and locations.
+
+Typing ``@bot_name calc`` in any chat looks up the projects and locations of
+the catalog whose name has a word starting with ``calc``. A
+:class:`SearchIndex` is built once from the catalog: every document is indexed
+by the trigrams of its normalized name, and by the prefixes of its words for
+queries too short to have trigrams. A query then intersects the postings of
+its trigrams, starting with the shortest one, and only the few remaining
+candidates are checked by substring.
+
+Inline queries arrive on every keystroke, and players type the same few
+names, so :class:`InlineSearch` keeps the ready-made
+``InlineQueryResultArticle`` lists of recent queries in an LRU cache keyed by
+the normalized query. Telegram also caches the answers for ``cache_time``
+seconds on its side, since results only change with the content.
+"""
+
+import re
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from aiogram.types import InlineQueryResultArticle, InputTextMessageContent
+
+from catalog import Catalog
+
+SHORT_QUERY = 3
+PAGE_SIZE = 50
+MAX_RESULTS = 200
+
+
+def normalize(text: str) -> str:
+    """
+    Lowercase text, drop punctuation and emoji and collapse whitespace.
+    """
+    return " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split())
+
+
+def trigrams(text: str) -> Set[str]:
+    """
+    Trigrams of normalized text, with word boundaries marked by spaces.
+    """
+    padded = f" {text} "
+    return {padded[index : index + 3] for index in range(len(padded) - 2)}
+
+
+class Document(NamedTuple):
+    """
+    One searchable project or location.
+    """
+
+    kind: str
+    key: str
+    title: str
+    description: str
+    text: str
+    normalized: str
+
+
+def catalog_documents(catalog: Catalog) -> List[Document]:
+    """
+    Build the searchable documents of a catalog: projects first, then locations.
+
+    Parameters
+    ----------
+    catalog : Catalog
+        The game content.
+
+    Returns
+    -------
+    List[Document]
+        The documents.
+    """
+    documents = []
+    for name in catalog.projects:
+        quest = catalog.quests[name]
+        where = catalog.locations[quest["location"]]["name"]
+        documents.append(
+            Document(
+                kind="project",
+                key=f"p{quest['id']}",
+                title=f"📚 {name}",
+                description=(
+                    f"❤️ {quest['health']} · ⭐ {quest['level_points']} · 📍 {where}"
+                ),
+                text=(
+                    f"📚 Project: {name}\n\n{quest['description']}\n\n"
+                    f"❤️ Health: {quest['health']}\n"
+                    f"⭐ Level points: {quest['level_points']}\n"
+                    f"📍 Location: {where}"
+                ),
+                normalized=normalize(name),
+            )
+        )
+    for location in catalog.locations:
+        exits = ", ".join(
+            f"{direction}: {catalog.locations[target]['name']}"
+            for direction, target in location["connections"].items()
+        )
+        universe = location.get("universe")
+        documents.append(
+            Document(
+                kind="location",
+                key=f"l{location['id']}",
+                title=f"📍 {location['name']}",
+                description=location["description"],
+                text=(
+                    f"📍 Location: {location['name']}"
+                    + (f" ({universe})" if universe else "")
+                    + f"\n\n{location['description']}\n\n🧭 Exits: {exits or '-'}"
+                ),
+                normalized=normalize(location["name"]),
+            )
+        )
+    return documents
+
+
+class SearchIndex:
+    """
+    Trigram and word-prefix index over document names.
+
+    Attributes
+    ----------
+    documents : List[Document]
+        The indexed documents, by document number.
+    """
+
+    def __init__(self, documents: List[Document]):
+        """
+        Parameters
+        ----------
+        documents : List[Document]
+            The documents to index.
+        """
+        self.documents = documents
+        trigram_postings = defaultdict(list)
+        prefix_postings = defaultdict(list)
+        for number, document in enumerate(documents):
+            for trigram in trigrams(document.normalized):
+                trigram_postings[trigram].append(number)
+            prefixes = {
+                word[:length]
+                for word in document.normalized.split()
+                for length in range(1, SHORT_QUERY)
+            }
+            for prefix in prefixes:
+                prefix_postings[prefix].append(number)
+        self._trigrams: Dict[str, List[int]] = dict(trigram_postings)
+        self._prefixes: Dict[str, List[int]] = dict(prefix_postings)
+
+    def _candidates(self, query: str) -> List[int]:
+        if len(query) < SHORT_QUERY:
+            return self._prefixes.get(query, [])
+        postings = []
+        for trigram in self._query_trigrams(query):
+            posting = self._trigrams.get(trigram)
+            if posting is None:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                break
+        return sorted(candidates)
+
+    @staticmethod
+    def _query_trigrams(query: str) -> Set[str]:
+        # The query may end in the middle of a word, so its trailing boundary
+        # is not a trigram of the matching names.
+        return trigrams(query) - {f"{query[-2:]} "}
+
+    def search(self, query: str, limit: int = MAX_RESULTS) -> List[Document]:
+        """
+        Find the documents with a name in which a word starts with the query.
+
+        Names that start with the query come first; projects come before
+        locations.
+
+        Parameters
+        ----------
+        query : str
+            Normalized query; an empty one matches everything.
+        limit : int
+            Maximum number of documents.
+
+        Returns
+        -------
+        List[Document]
+            The matching documents, best first.
+        """
+        if not query:
+            return self.documents[:limit]
+        matches = []
+        for number in self._candidates(query):
+            name = self.documents[number].normalized
+            if name.startswith(query):
+                matches.append((0, number))
+            elif f" {query}" in name:
+                matches.append((1, number))
+        matches.sort()
+        return [self.documents[number] for _, number in matches[:limit]]
+
+
+class ResultCache:
+    """
+    LRU cache of ready-made inline results, keyed by normalized query.
+
+    Attributes
+    ----------
+    size : int
+        Maximum number of cached queries.
+    hits : int
+        Lookups answered from the cache.
+    misses : int
+        Lookups of queries not in the cache.
+    """
+
+    def __init__(self, size: int = 256):
+        """
+        Parameters
+        ----------
+        size : int
+            Maximum number of cached queries.
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._results: "OrderedDict[str, List[InlineQueryResultArticle]]" = (
+            OrderedDict()
+        )
+
+    def get(self, query: str) -> Optional[List[InlineQueryResultArticle]]:
+        """
+        Cached results of a query, or None.
+        """
+        results = self._results.get(query)
+        if results is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._results.move_to_end(query)
+        return results
+
+    def put(self, query: str, results: List[InlineQueryResultArticle]) -> None:
+        """
+        Cache the results of a query, evicting the least recently used ones.
+        """
+        self._results[query] = results
+        self._results.move_to_end(query)
+        while len(self._results) > self.size:
+            self._results.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Size and efficiency of the cache.
+
+        Returns
+        -------
+        dict
+            ``cached``, ``hits``, ``misses`` and ``hit_rate``.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "cached": len(self._results),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class InlineSearch:
+    """
+    Answers inline queries from a search index, through a result cache.
+
+    Attributes
+    ----------
+    index : SearchIndex
+        The index over the catalog.
+    cache : ResultCache
+        Results of recent queries.
+    cache_time : int
+        Seconds Telegram may cache an answer on its side.
+    """
+
+    def __init__(self, catalog: Catalog, cache_size: int = 256, cache_time: int = 300):
+        """
+        Parameters
+        ----------
+        catalog : Catalog
+            The game content.
+        cache_size : int
+            Maximum number of cached queries.
+        cache_time : int
+            Seconds Telegram may cache an answer on its side.
+        """
+        self.index = SearchIndex(catalog_documents(catalog))
+        self.cache = ResultCache(cache_size)
+        self.cache_time = cache_time
+
+    def results(self, query: str) -> List[InlineQueryResultArticle]:
+        """
+        All results of a query, at most ``MAX_RESULTS``, best first.
+        """
+        query = normalize(query)
+        results = self.cache.get(query)
+        if results is None:
+            results = [
+                InlineQueryResultArticle(
+                    id=document.key,
+                    title=document.title,
+                    description=document.description,
+                    input_message_content=InputTextMessageContent(
+                        message_text=document.text
+                    ),
+                )
+                for document in self.index.search(query)
+            ]
+            self.cache.put(query, results)
+        return results
+
+    def page(self, query: str, offset: str = "") -> Tuple[List[Any], str]:
+        """
+        One page of results of a query, for ``answerInlineQuery``.
+
+        Parameters
+        ----------
+        query : str
+            Text of the inline query.
+        offset : str
+            Offset sent by Telegram; empty for the first page.
+
+        Returns
+        -------
+        tuple
+            The results of the page and the offset of the next page, empty if
+            there is none.
+        """
+        start = int(offset) if offset.isdigit() else 0
+        results = self.results(query)
+        end = start + PAGE_SIZE
+        return results[start:end], str(end) if end < len(results) else ""
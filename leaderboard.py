@@ -0,0 +1,352 @@
+"""
+Module with the global leaderboard.
+
+Players are ranked by level, then by level points. The ranking is kept in an
+indexable skip list, so recording a new score, finding the rank of a player
+and reading the entry at a given rank all take O(log n), however many players
+there are. Scores are recorded incrementally: the protagonist flags every
+score change (see :attr:`roles.Protagonist.score_changed`) and
+:class:`LeaderboardMiddleware` records the flagged scores after each update.
+The leaderboard is marked dirty on every recorded score, so that the periodic
+checkpoints of :mod:`lifecycle` write it only when it changed.
+"""
+
+import os
+import pickle
+import random
+import zlib
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from middlewares import Handler, event_session
+
+Key = Tuple[int, int, int]
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key: Optional[Key], height: int):
+        self.key = key
+        self.next: List[Optional["_Node"]] = [None] * height
+        self.width: List[int] = [1] * height
+
+
+class IndexableSkipList:
+    """
+    Sorted collection of unique keys with O(log n) access by position.
+
+    Every link of the skip list also stores its width, the number of positions
+    it skips, so the position of a key is the sum of the widths on its search
+    path.
+    """
+
+    MAX_HEIGHT = 32
+
+    def __init__(self):
+        self._head = _Node(None, self.MAX_HEIGHT)
+        self._size = 0
+        self._random = random.Random()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[Key]:
+        node = self._head.next[0]
+        while node is not None:
+            yield node.key
+            node = node.next[0]
+
+    def _search(self, key: Key) -> Tuple[List[_Node], List[int]]:
+        update = [self._head] * self.MAX_HEIGHT
+        positions = [0] * self.MAX_HEIGHT
+        node, position = self._head, 0
+        for level in reversed(range(self.MAX_HEIGHT)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+            update[level] = node
+            positions[level] = position
+        return update, positions
+
+    def insert(self, key: Key) -> None:
+        """
+        Add a key that is not in the list yet.
+        """
+        height = 1
+        while height < self.MAX_HEIGHT and self._random.getrandbits(1):
+            height += 1
+        update, positions = self._search(key)
+        position = positions[0] + 1
+        node = _Node(key, height)
+        for level in range(self.MAX_HEIGHT):
+            previous = update[level]
+            if level < height:
+                node.next[level] = previous.next[level]
+                previous.next[level] = node
+                node.width[level] = (
+                    previous.width[level] - (position - positions[level]) + 1
+                )
+                previous.width[level] = position - positions[level]
+            else:
+                previous.width[level] += 1
+        self._size += 1
+
+    def remove(self, key: Key) -> None:
+        """
+        Remove a key.
+
+        Raises
+        ------
+        KeyError
+            If the key is not in the list.
+        """
+        update, _ = self._search(key)
+        node = update[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for level in range(self.MAX_HEIGHT):
+            previous = update[level]
+            if previous.next[level] is node:
+                previous.width[level] += node.width[level] - 1
+                previous.next[level] = node.next[level]
+            else:
+                previous.width[level] -= 1
+        self._size -= 1
+
+    def index(self, key: Key) -> int:
+        """
+        Position of a key, starting from 0.
+
+        Raises
+        ------
+        KeyError
+            If the key is not in the list.
+        """
+        update, positions = self._search(key)
+        node = update[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        return positions[0]
+
+    def __getitem__(self, index: int) -> Key:
+        if not 0 <= index < self._size:
+            raise IndexError(index)
+        node, position = self._head, 0
+        for level in reversed(range(self.MAX_HEIGHT)):
+            while (
+                node.next[level] is not None
+                and position + node.width[level] <= index + 1
+            ):
+                position += node.width[level]
+                node = node.next[level]
+        return node.key
+
+
+class Standing(NamedTuple):
+    """
+    One row of the leaderboard.
+    """
+
+    rank: int
+    user_id: int
+    name: str
+    level: int
+    level_points: int
+
+
+class Leaderboard:
+    """
+    Best score of every player, ranked by level and then by level points.
+
+    The first ``cache_size`` rows are cached and the cache is dropped only when
+    a recorded score enters or changes the cached top.
+
+    Attributes
+    ----------
+    path : str or None
+        File the leaderboard is persisted to.
+    cache_size : int
+        Number of top rows kept cached.
+    dirty : bool
+        Whether a score was recorded since the last save or load.
+    """
+
+    def __init__(self, path: Optional[str] = None, cache_size: int = 10):
+        """
+        Parameters
+        ----------
+        path : str, optional
+            File the leaderboard is persisted to; loaded if it exists.
+        cache_size : int
+            Number of top rows kept cached.
+        """
+        self.path = path
+        self.cache_size = cache_size
+        self._scores: Dict[int, Tuple[str, int, int]] = {}
+        self._index = IndexableSkipList()
+        self._top: Optional[List[Standing]] = None
+        self.dirty = False
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def _key(user_id: int, level: int, level_points: int) -> Key:
+        return (-level, -level_points, user_id)
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def record(self, user_id: int, name: str, level: int, level_points: int) -> bool:
+        """
+        Record the score of a player, if it beats the best one recorded so far.
+
+        Parameters
+        ----------
+        user_id : int
+            Telegram ID of the player.
+        name : str
+            Name shown on the leaderboard.
+        level : int
+            Level of the player.
+        level_points : int
+            Level points of the player.
+
+        Returns
+        -------
+        bool
+            True if the score was recorded.
+        """
+        key = self._key(user_id, level, level_points)
+        old = self._scores.get(user_id)
+        old_key = old and self._key(user_id, old[1], old[2])
+        if old_key is not None and old_key <= key:
+            return False
+        if old_key is not None:
+            self._index.remove(old_key)
+        self._index.insert(key)
+        self._scores[user_id] = (name, level, level_points)
+        self.dirty = True
+        if self._top is not None:
+            last = self._top[-1] if self._top else None
+            if (
+                len(self._top) < self.cache_size
+                or key < self._key(last.user_id, last.level, last.level_points)
+                or any(row.user_id == user_id for row in self._top)
+            ):
+                self._top = None
+        return True
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """
+        Rank of a player, starting from 1.
+
+        Returns
+        -------
+        int or None
+            The rank, or None if the player has no score yet.
+        """
+        score = self._scores.get(user_id)
+        if score is None:
+            return None
+        return self._index.index(self._key(user_id, score[1], score[2])) + 1
+
+    def standing(self, rank: int) -> Standing:
+        """
+        The row at a rank, starting from 1.
+
+        Raises
+        ------
+        IndexError
+            If nobody has that rank.
+        """
+        user_id = self._index[rank - 1][2]
+        return Standing(rank, user_id, *self._scores[user_id])
+
+    def _rows(self, limit: int) -> List[Standing]:
+        rows = []
+        for rank, key in enumerate(self._index, start=1):
+            if rank > limit:
+                break
+            rows.append(Standing(rank, key[2], *self._scores[key[2]]))
+        return rows
+
+    def top(self, limit: Optional[int] = None) -> List[Standing]:
+        """
+        The best players.
+
+        Parameters
+        ----------
+        limit : int, optional
+            Number of rows; ``cache_size`` by default.
+
+        Returns
+        -------
+        List[Standing]
+            The rows, best first.
+        """
+        if limit is None:
+            limit = self.cache_size
+        if limit > self.cache_size:
+            return self._rows(limit)
+        if self._top is None:
+            self._top = self._rows(self.cache_size)
+        return self._top[:limit]
+
+    def save(self) -> None:
+        """
+        Write the scores to ``path``.
+        """
+        data = zlib.compress(
+            pickle.dumps(self._scores, protocol=pickle.HIGHEST_PROTOCOL)
+        )
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def load(self) -> None:
+        """
+        Replace the scores with the ones saved in ``path``.
+        """
+        with open(self.path, "rb") as file:
+            self._scores = pickle.loads(zlib.decompress(file.read()))
+        self._index = IndexableSkipList()
+        for user_id, (_, level, level_points) in self._scores.items():
+            self._index.insert(self._key(user_id, level, level_points))
+        self._top = None
+        self.dirty = False
+
+
+class LeaderboardMiddleware(BaseMiddleware):
+    """
+    Records the score of the session's player after a handler changed it.
+
+    Registered as an inner middleware of messages and callback queries, so the
+    session injected by the :class:`bot.InGame` filter is available even if the
+    handler ended the game; message handlers get theirs from the store, see
+    :func:`middlewares.event_session`.
+    """
+
+    def __init__(self, leaderboard: Leaderboard):
+        self.leaderboard = leaderboard
+
+    async def __call__(
+        self, handler: Handler, event: TelegramObject, data: Dict[str, Any]
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            session = event_session(data)
+            player = session and session.player
+            if player is not None and getattr(player, "score_changed", False):
+                player.score_changed = False
+                self.leaderboard.record(
+                    session.user_id,
+                    data["event_from_user"].full_name,
+                    player.level,
+                    player.level_points,
+                )
@@ -0,0 +1,228 @@
+"""
+Module for graceful shutdown and session handoff between bot processes.
+
+On SIGTERM aiogram stops polling, so no new updates are taken. The drain hook
+of :func:`setup_drain` then waits, up to a deadline, for the handlers that are
+still running (and therefore for their outgoing Bot API calls) to finish. It
+must be the first shutdown hook of the dispatcher, so that the subsystems those
+handlers use (the chat registry, the map renderer, the timers) are torn down
+only after it. The last hook, registered by :func:`setup_lifecycle`, writes the
+in-memory sessions to a snapshot file. The next process loads that snapshot on
+startup and serves the sessions straight from memory. Other state kept next to
+the sessions, such as the leaderboard and the game statistics, is saved and
+reloaded along with them. So that a crash loses at most a few minutes of it,
+the objects with a ``dirty`` flag are also saved every ``checkpoint_interval``
+seconds while it is set.
+
+A new process may start while the old one is still draining, e.g. during a
+rolling restart. Each process therefore holds an exclusive lock on
+``<handoff file>.lock`` from startup until its snapshot is written. A starting
+process waits up to ``handoff_wait`` seconds for that lock before it restores
+anything, so it never starts polling without the sessions of a predecessor that
+is still shutting down. The kernel releases the lock of a process that died, so
+a crash costs no wait. If the predecessor outlives ``handoff_wait``, the new
+process starts empty and a warning is logged; its own snapshot later replaces
+the stale one.
+"""
+
+import asyncio
+import contextlib
+import fcntl
+import logging
+import os
+import time
+from typing import IO, Any, Dict, Optional, Sequence
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject
+
+from middlewares import Handler
+from session import SessionStore
+
+logger = logging.getLogger(__name__)
+
+
+class InFlightTracker(BaseMiddleware):
+    """
+    Counts the updates that are being processed.
+
+    Attributes
+    ----------
+    in_flight : int
+        Number of updates currently being processed.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(
+        self, handler: Handler, event: TelegramObject, data: Dict[str, Any]
+    ) -> Any:
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Wait until no update is being processed.
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum number of seconds to wait.
+
+        Returns
+        -------
+        bool
+            True if everything finished in time, False if updates are still running.
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+def setup_drain(
+    dp: Dispatcher, tracker: InFlightTracker, timeout: float = 10.0
+) -> None:
+    """
+    Register the hook that waits for running updates on shutdown.
+
+    Register it before any other shutdown hook of ``dp``.
+
+    Parameters
+    ----------
+    dp : Dispatcher
+        The dispatcher to manage.
+    tracker : InFlightTracker
+        The outermost update middleware of ``dp``, so that updates waiting for
+        a per-user lock are counted as running too.
+    timeout : float
+        Seconds to wait for running handlers.
+    """
+
+    async def drain():
+        if not await tracker.drain(timeout):
+            logger.warning(
+                f"{tracker.in_flight} updates still running after {timeout}s."
+            )
+
+    dp.shutdown.register(drain)
+
+
+async def acquire_handoff_lock(path: str, timeout: float) -> Optional[IO]:
+    """
+    Take the exclusive lock held by a running process, waiting for its holder.
+
+    Parameters
+    ----------
+    path : str
+        The lock file; created if missing.
+    timeout : float
+        Maximum number of seconds to wait.
+
+    Returns
+    -------
+    file or None
+        The open lock file, to be closed to release the lock; None if another
+        process still held it after ``timeout`` seconds.
+    """
+    lock = open(path, "a")
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                lock.close()
+                return None
+            await asyncio.sleep(0.1)
+
+
+def setup_lifecycle(
+    dp: Dispatcher,
+    sessions: SessionStore,
+    handoff_file: str,
+    handoff_wait: float = 30.0,
+    saved: Sequence[Any] = (),
+    checkpoint_interval: float = 0.0,
+) -> None:
+    """
+    Register the handoff hooks on a dispatcher.
+
+    Register them after the other hooks of ``dp``: the state is saved once its
+    subsystems have stopped.
+
+    Parameters
+    ----------
+    dp : Dispatcher
+        The dispatcher to manage.
+    sessions : SessionStore
+        The sessions to hand off.
+    handoff_file : str
+        Snapshot file shared by the old and the new process.
+    handoff_wait : float
+        Seconds a starting process waits for a predecessor that is still
+        running to write its snapshot.
+    saved : Sequence
+        Objects with a ``path`` and ``save()`` / ``load()`` methods, e.g. the
+        :class:`leaderboard.Leaderboard`; saved before the sessions on shutdown
+        and reloaded on startup.
+    checkpoint_interval : float
+        Seconds between checkpoints of the ``saved`` objects whose ``dirty``
+        attribute is set; 0 disables checkpoints.
+    """
+
+    lock: Optional[IO] = None
+    checkpoints: Optional[asyncio.Task] = None
+
+    async def checkpoint():
+        while True:
+            await asyncio.sleep(checkpoint_interval)
+            for state in saved:
+                if not getattr(state, "dirty", False):
+                    continue
+                try:
+                    state.save()
+                except Exception:
+                    logger.exception(f"Checkpoint of {state.path} failed.")
+
+    async def take_over():
+        nonlocal lock, checkpoints
+        lock = await acquire_handoff_lock(handoff_file + ".lock", handoff_wait)
+        if lock is None:
+            logger.warning(
+                f"Previous process still running after {handoff_wait}s, starting without its snapshot."
+            )
+        for state in saved:
+            if os.path.exists(state.path):
+                state.load()
+        if os.path.exists(handoff_file):
+            restored = sessions.restore(handoff_file)
+            logger.info(f"Took over {restored} sessions from the previous process.")
+        if checkpoint_interval > 0:
+            checkpoints = asyncio.create_task(checkpoint())
+
+    async def hand_off():
+        if checkpoints is not None:
+            checkpoints.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await checkpoints
+        for state in saved:
+            state.save()
+        written = sessions.snapshot(handoff_file)
+        logger.info(f"Handed off {written} sessions to {handoff_file}.")
+        if lock is not None:
+            lock.close()
+
+    dp.startup.register(take_over)
+    dp.shutdown.register(hand_off)
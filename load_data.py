@@ -2,10 +2,13 @@
 Module for initialization start state for other roles.
 """
 
+import copy
 import json
 import random
+from catalog import Catalog, load_catalog
+from dialogue import Dialogue
 from roles import Protagonist, NPC, Verter
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 
 
 def load_json(file_name: str) -> Dict:
@@ -37,7 +40,7 @@ def initialize_player(
     Protagonist
         The initialized protagonist object.
     """
-    return Protagonist(name, item, id)
+    return Protagonist(name, id, item)
 
 
 def initialize_npcs(
@@ -47,6 +50,7 @@ def initialize_npcs(
     locations: List[Dict[str, Any]],
     phrases: List[str],
     items: List[Dict[str, Any]],
+    dialogues: Optional[Dict[str, Dialogue]] = None,
 ) -> List[NPC]:
     """
     Initialize a list of NPCs, distributed across all locations.
@@ -67,6 +71,8 @@ def initialize_npcs(
         List of phrases that NPCs can say.
     items: list
         Items that are in NPC's inventory.
+    dialogues: dict, optional
+        Compiled dialogues by NPC type; NPCs of other types get the default one.
 
     Returns
     -------
@@ -75,19 +81,21 @@ def initialize_npcs(
     """
     npcs = []
 
-    for _, loc_details in locations.items():
+    for loc_details in locations:
         loc_name = loc_details["name"]
         num_npcs_for_location = random.randint(1, 3)
 
         for _ in range(num_npcs_for_location):
+            npc_type = random.choice(types_npcs)
             npcs.append(
                 NPC(
                     name=random.choice(name_npcs),
-                    type=random.choice(types_npcs),
+                    type=npc_type,
                     quests=quests,
                     location=loc_name,
                     phrases=phrases,
                     inventory=items,
+                    dialogue=dialogues and dialogues.get(npc_type),
                 )
             )
 
@@ -97,7 +105,7 @@ def initialize_npcs(
 def initialize_verters(
     projects: Dict[str, Dict[str, Any]],
     verter_phrases: List[str],
-    locations: Dict[str, Dict[Any, Any]],
+    locations: List[Dict[str, Any]],
 ) -> List["Verter"]:
     """
     Initialize a list of Verter enemies based on the projects.
@@ -109,7 +117,7 @@ def initialize_verters(
     verter_phrases : list
         List of phrases that the Verters can say.
     locations : list
-        List of available locations with their IDs.
+        List of available locations indexed by their IDs.
 
     Returns
     -------
@@ -119,7 +127,7 @@ def initialize_verters(
     return [
         Verter(
             {**project, "name": key},
-            locations.get(project["location_id"], {}).get("name", "WTF Location"),
+            locations[project["location"]]["name"],
             verter_phrases,
         )
         for key, project in projects.items()
@@ -127,58 +135,46 @@ def initialize_verters(
 
 
 def init_game_elements(
-    name_player: str = "CatPlayer", item: str = "Head & Shoulders"
+    name_player: str = "CatPlayer",
+    item: str = "Head & Shoulders",
+    catalog: Optional[Catalog] = None,
+    player_id: str = "001",
 ) -> None:
     """
     Main function to initialize the game state.
 
     Parameters
     ----------
-    num_npcs : int
-        Number of npcs to initialize.
+    name_player : str
+        Name of the chosen player.
+    item : str
+        The first item of the player.
+    catalog : Catalog, optional
+        Prebuilt game content; loaded from disk if not given.
+    player_id : str
+        Unique identifier of the player.
     """
-    global items, quests, projects, locations
-    items = load_json("info/items.json")
-    phrases = load_json("info/phrases.json")
-    quests = load_json("info/quests.json")
-    projects = {
-        key: value
-        for key, value in quests.items()
-        if "type" in value and value["type"] == "project"
-    }
-    locations = load_json("info/locations.json")
-    name_npcs = [
-        "Meow, Booba",
-        "Odsi Whish",
-        "Ymir Fritz",
-        "Mario",
-        "Bowser",
-        "Sakura",
-        "Nana",
-        "Karnaks Puck",
-        "Fry",
-        "Basic",
-        "Johnny Silverhand",
-        "V",
-        "Bender Rodriges",
-        "Sif",
-        "Belmont",
-    ]
-    types_npcs = ["Peer", "ADM", "Other"]
+    if catalog is None:
+        catalog = load_catalog()
+    # Roles mutate quests and items during the game, so every game gets its own copy.
+    quests = copy.deepcopy(catalog.quests)
+    items = copy.deepcopy(catalog.items)
+    projects = {key: quests[key] for key in catalog.projects}
 
-    player: Protagonist = initialize_player(name_player, item)
+    player: Protagonist = initialize_player(name_player, item, player_id)
 
     verters: List[Verter] = initialize_verters(
-        projects, phrases["verter_phrases"], locations
+        projects, catalog.phrases["verter_phrases"], catalog.locations
     )
 
     npcs: List["NPC"] = initialize_npcs(
-        name_npcs,
-        types_npcs,
+        catalog.npc_names,
+        catalog.npc_types,
         quests,
-        locations,
-        phrases["peer_phrases"],
-        items["items"],
+        catalog.locations,
+        catalog.phrases["peer_phrases"],
+        items,
+        catalog.dialogues,
     )
 
     return player, verters, npcs
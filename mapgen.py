@@ -0,0 +1,477 @@
+"""
+Procedural game content for scale tests.
+
+:func:`generate_content` grows a connected map of any size on a grid, so every
+connection is a North/South/East/West pair like in ``info/locations.json``,
+and populates it with quests in the same proportions as the hand-written
+content: about two projects per location and one interaction or item transfer
+quest per three locations. Names, descriptions, phrases, items and dialogues
+are taken from the real content files, so the generated content passes
+:func:`catalog.compile_catalog`. NPCs are placed by
+:func:`load_data.initialize_npcs` as in a real game, one to three per
+location.
+
+The ``bench`` command measures, for growing map sizes, the stages whose cost
+depends on the size of the map: loading the map, compiling the catalog (with
+its routing table), starting a game, showing a location and moving. Every size
+prints one JSON line; the last line has the log-log slope of every measure
+between consecutive sizes, where 1 is linear scaling and 2 quadratic.
+
+Usage::
+
+    python3 mapgen.py generate 5000 -o /tmp/big_map   # write the content files
+    python3 mapgen.py bench --sizes 100 300 1000 3000  # measure the stages
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from catalog import INFO_DIR, Catalog, compile_catalog
+from load_data import init_game_elements, load_json
+from load_map import load_map
+
+STEPS = {"North": (0, 1), "South": (0, -1), "East": (1, 0), "West": (-1, 0)}
+OPPOSITES = {"North": "South", "South": "North", "East": "West", "West": "East"}
+
+BENCH_TOKEN = "42:map-benchmark"
+BENCH_USER = {"id": 1, "is_bot": False, "first_name": "Bench"}
+BENCH_CHAT = {"id": 1, "type": "private"}
+
+
+def generate_map(
+    size: int, templates: List[Dict[str, Any]], rng: random.Random, loops: float = 0.1
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Grow a connected map on a grid.
+
+    Every new location is attached to a random location of the map that still
+    has a free side, which gives a compact map with a diameter of the order of
+    ``sqrt(size)``. Afterwards, a share of the neighbouring locations that are
+    not connected yet get connected, so the map has cycles.
+
+    Parameters
+    ----------
+    size : int
+        Number of locations.
+    templates : List[Dict[str, Any]]
+        Locations to copy names, descriptions and universes from.
+    rng : random.Random
+        Source of randomness.
+    loops : float
+        Share of the extra connections between neighbours.
+
+    Returns
+    -------
+    dict
+        Locations keyed by ``"1"`` to ``str(size)``, in the format of ``locations.json``.
+    """
+    cells = {(0, 0): "1"}
+    frontier = [(0, 0)]
+    locations: Dict[str, Dict[str, Any]] = {}
+
+    def add(key: str) -> None:
+        index = int(key) - 1
+        template = templates[index % len(templates)]
+        round_ = index // len(templates)
+        locations[key] = {
+            "name": template["name"] + (f" {round_ + 1}" if round_ else ""),
+            "description": template["description"],
+            "universe": template.get("universe", ""),
+            "connections": {},
+        }
+
+    def connect(key: str, direction: str, target: str) -> None:
+        locations[key]["connections"][direction] = target
+        locations[target]["connections"][OPPOSITES[direction]] = key
+
+    add("1")
+    while len(cells) < size:
+        index = rng.randrange(len(frontier))
+        x, y = frontier[index]
+        free = [
+            (direction, (x + dx, y + dy))
+            for direction, (dx, dy) in STEPS.items()
+            if (x + dx, y + dy) not in cells
+        ]
+        if not free:
+            frontier[index] = frontier[-1]
+            frontier.pop()
+            continue
+        direction, cell = rng.choice(free)
+        key = str(len(cells) + 1)
+        cells[cell] = key
+        frontier.append(cell)
+        add(key)
+        connect(cells[(x, y)], direction, key)
+
+    for (x, y), key in cells.items():
+        for direction in ("North", "East"):
+            dx, dy = STEPS[direction]
+            target = cells.get((x + dx, y + dy))
+            if (
+                target is not None
+                and direction not in locations[key]["connections"]
+                and rng.random() < loops
+            ):
+                connect(key, direction, target)
+    return locations
+
+
+def generate_quests(
+    locations: Dict[str, Dict[str, Any]],
+    templates: Dict[str, Dict[str, Any]],
+    rng: random.Random,
+    projects_per_location: float = 1.9,
+    other_per_location: float = 0.36,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Place copies of the real quests on a map.
+
+    Parameters
+    ----------
+    locations : Dict[str, Dict[str, Any]]
+        The map, as returned by :func:`generate_map`.
+    templates : Dict[str, Dict[str, Any]]
+        Quests to copy, in the format of ``quests.json``.
+    rng : random.Random
+        Source of randomness.
+    projects_per_location : float
+        Average number of projects per location.
+    other_per_location : float
+        Average number of interaction and item transfer quests per location.
+
+    Returns
+    -------
+    dict
+        Quests keyed by name, in the format of ``quests.json``.
+    """
+    projects = [quest for quest in templates.values() if quest["type"] == "project"]
+    others = [quest for quest in templates.values() if quest["type"] != "project"]
+    keys = list(locations)
+    quests = {}
+    for pool, per_location in (
+        (projects, projects_per_location),
+        (others, other_per_location),
+    ):
+        for index in range(round(per_location * len(keys))):
+            template = pool[index % len(pool)]
+            round_ = index // len(pool)
+            name = template["name"] + (f" {round_ + 1}" if round_ else "")
+            quests[name] = {
+                **template,
+                "name": name,
+                "done": False,
+                "location_id": rng.choice(keys),
+            }
+    return quests
+
+
+def generate_content(
+    size: int, seed: Optional[int] = None, info_dir: str = INFO_DIR, **kwargs: Any
+) -> Dict[str, Any]:
+    """
+    Generate the content files for a map of ``size`` locations.
+
+    Parameters
+    ----------
+    size : int
+        Number of locations.
+    seed : int, optional
+        Seed of the generator, for reproducible content.
+    info_dir : str
+        Directory of the real content files used as templates.
+    **kwargs
+        Passed on to :func:`generate_quests`.
+
+    Returns
+    -------
+    dict
+        Contents keyed by file name, see :data:`catalog.SOURCE_FILES`.
+    """
+    rng = random.Random(seed)
+    real_locations = load_json(os.path.join(info_dir, "locations.json"))
+    real_quests = load_json(os.path.join(info_dir, "quests.json"))
+    locations = generate_map(size, list(real_locations.values()), rng)
+    return {
+        "dialogues.json": load_json(os.path.join(info_dir, "dialogues.json")),
+        "items.json": load_json(os.path.join(info_dir, "items.json")),
+        "locations.json": locations,
+        "phrases.json": load_json(os.path.join(info_dir, "phrases.json")),
+        "quests.json": generate_quests(locations, real_quests, rng, **kwargs),
+    }
+
+
+def write_content(content: Dict[str, Any], output_dir: str) -> None:
+    """
+    Write generated content files to ``output_dir``, creating it if needed.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for file_name, data in content.items():
+        with open(os.path.join(output_dir, file_name), "w") as file:
+            json.dump(data, file, ensure_ascii=False, indent=4)
+
+
+def _measure(function: Callable[[], Any]) -> Tuple[Any, float]:
+    started = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - started
+
+
+def _peak_memory(function: Callable[[], Any]) -> Tuple[int, int]:
+    """
+    Memory still allocated by the result of ``function`` and the peak while it ran.
+    """
+    tracemalloc.start()
+    try:
+        result = function()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return retained, peak
+
+
+def _stub_session():
+    from aiogram.client.session.base import BaseSession
+
+    class StubSession(BaseSession):
+        """Answers every Bot API call without touching the network."""
+
+        async def make_request(self, bot, method, timeout=None):
+            return None
+
+        async def stream_content(
+            self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True
+        ):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return StubSession()
+
+
+def _message(update_id: int, text: str) -> Dict[str, Any]:
+    return {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": BENCH_CHAT,
+        "from": BENCH_USER,
+        "text": text,
+    }
+
+
+async def _play(catalog: Catalog, moves: int, rng: random.Random) -> Dict[str, Any]:
+    from aiogram.types import Update
+
+    import bot as bot_module
+    from session import SessionStore
+
+    bot = bot_module.create_bot(BENCH_TOKEN, session=_stub_session())
+    cold_dir = tempfile.mkdtemp()
+    dp = bot_module.create_dispatcher(
+        catalog,
+        tap_window=0,
+        sessions=SessionStore(cold_dir=cold_dir),
+        throttle_rate=0,
+    )
+    update_id = 0
+
+    async def feed(**payload: Any) -> float:
+        nonlocal update_id
+        update_id += 1
+        update = Update.model_validate({"update_id": update_id, **payload})
+        started = time.perf_counter()
+        await dp.feed_update(bot, update)
+        return time.perf_counter() - started
+
+    for text in ("/start", "🐱 Karnaks Puck", "☕ Thermomug"):
+        await feed(message=_message(update_id + 1, text))
+    start_game = await feed(message=_message(update_id + 1, "🎮 Start Game"))
+    session = dp["sessions"][BENCH_USER["id"]]
+
+    message = Update.model_validate(
+        {"update_id": 0, "message": _message(0, "bench")}
+    ).message.as_(bot)
+    show_location = []
+    for _ in range(moves):
+        session.player.current_location = rng.randrange(len(catalog.locations))
+        started = time.perf_counter()
+        await bot_module.show_location_info(message, session, catalog)
+        show_location.append(time.perf_counter() - started)
+
+    session.player.current_location = catalog.start_location
+    move = []
+    for _ in range(moves):
+        location = catalog.locations[session.player.current_location]
+        direction = rng.choice(list(location["connections"]))
+        move.append(
+            await feed(
+                callback_query={
+                    "id": str(update_id + 1),
+                    "from": BENCH_USER,
+                    "chat_instance": "bench",
+                    "data": f"move_{direction}",
+                    "message": {**_message(update_id + 1, "bench"), "from": None},
+                }
+            )
+        )
+        if session.player.current_location != location["connections"][direction]:
+            raise RuntimeError("The benchmark move was not handled.")
+
+    shutil.rmtree(cold_dir, ignore_errors=True)
+    return {
+        "start_game_ms": 1000 * start_game,
+        "show_location_ms": 1000 * statistics.median(show_location),
+        "move_ms": 1000 * statistics.median(move),
+        "move_p99_ms": 1000 * sorted(move)[max(0, math.ceil(0.99 * len(move)) - 1)],
+    }
+
+
+def bench_size(size: int, games: int, moves: int, seed: int) -> Dict[str, Any]:
+    """
+    Measure every stage for a generated map of ``size`` locations.
+
+    Parameters
+    ----------
+    size : int
+        Number of locations.
+    games : int
+        Number of games started to time :func:`load_data.init_game_elements`.
+    moves : int
+        Number of locations shown and of moves made.
+    seed : int
+        Seed of the content generator and of the moves.
+
+    Returns
+    -------
+    dict
+        Seconds, milliseconds and bytes by measure.
+    """
+    info_dir = tempfile.mkdtemp()
+    try:
+        write_content(generate_content(size, seed), info_dir)
+        locations_file = os.path.join(info_dir, "locations.json")
+        _, load_seconds = _measure(lambda: load_map(locations_file))
+        data, compile_seconds = _measure(lambda: compile_catalog(info_dir))
+        catalog, catalog_seconds = _measure(lambda: Catalog(data))
+        catalog_bytes, catalog_peak = _peak_memory(lambda: Catalog(data))
+        _, game_seconds = _measure(
+            lambda: [
+                init_game_elements(catalog=catalog, player_id=str(game))
+                for game in range(games)
+            ]
+        )
+        game_bytes, _ = _peak_memory(lambda: init_game_elements(catalog=catalog))
+        played = asyncio.run(_play(catalog, moves, random.Random(seed)))
+    finally:
+        shutil.rmtree(info_dir, ignore_errors=True)
+
+    result = {
+        "locations": size,
+        "quests": len(data["quests"]),
+        "load_map_s": load_seconds,
+        "compile_s": compile_seconds,
+        "catalog_s": catalog_seconds,
+        "catalog_mb": catalog_bytes / 2**20,
+        "catalog_peak_mb": catalog_peak / 2**20,
+        "init_game_ms": 1000 * game_seconds / games,
+        "game_kb": game_bytes / 2**10,
+        **played,
+    }
+    return {
+        name: round(value, 4) if isinstance(value, float) else value
+        for name, value in result.items()
+    }
+
+
+def scaling(results: List[Dict[str, Any]]) -> Dict[str, List[float]]:
+    """
+    Log-log slope of every measure between consecutive map sizes.
+
+    A slope of about 1 means the measure grows linearly with the number of
+    locations, about 2 quadratically and about 0 not at all.
+
+    Parameters
+    ----------
+    results : List[Dict[str, Any]]
+        Results of :func:`bench_size`, by increasing size.
+
+    Returns
+    -------
+    dict
+        Slopes by measure, one per pair of consecutive sizes.
+    """
+    slopes: Dict[str, List[float]] = {}
+    for smaller, larger in zip(results, results[1:]):
+        ratio = math.log(larger["locations"] / smaller["locations"])
+        for name, value in larger.items():
+            if name in ("locations", "quests"):
+                continue
+            if value > 0 and smaller[name] > 0:
+                slope = round(math.log(value / smaller[name]) / ratio, 2)
+                slopes.setdefault(name, []).append(slope)
+    return slopes
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    generate_parser = subparsers.add_parser(
+        "generate", help="Write generated content files."
+    )
+    generate_parser.add_argument("size", type=int, help="number of locations")
+    generate_parser.add_argument("-o", "--output", required=True, help="directory")
+    generate_parser.add_argument("--seed", type=int)
+    bench_parser = subparsers.add_parser(
+        "bench", help="Measure the game stages on growing maps."
+    )
+    bench_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 300, 1000, 3000]
+    )
+    bench_parser.add_argument("--games", type=int, default=5)
+    bench_parser.add_argument("--moves", type=int, default=200)
+    bench_parser.add_argument("--seed", type=int, default=21)
+    bench_parser.add_argument(
+        "--output", help="append the results as JSON lines to this file"
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        content = generate_content(args.size, args.seed)
+        write_content(content, args.output)
+        print(
+            f"{len(content['locations.json'])} locations and "
+            f"{len(content['quests.json'])} quests written to {args.output}."
+        )
+        return 0
+
+    logging.disable(logging.INFO)
+    results = []
+    lines = []
+    for size in sorted(args.sizes):
+        results.append(bench_size(size, args.games, args.moves, args.seed))
+        lines.append(json.dumps(results[-1]))
+        print(lines[-1], flush=True)
+    lines.append(json.dumps({"scaling": scaling(results)}))
+    print(lines[-1])
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write("\n".join(lines) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
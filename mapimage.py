@@ -0,0 +1,453 @@
+"""
+Module with rendered images of the game map.
+
+The map is drawn as a grid of locations joined by their connections, with
+the locations the player has explored and the current one highlighted. The
+grid positions follow the North/South/East/West directions of the connections
+and are laid out once per catalog version.
+
+An image depends only on the map version, the set of explored locations and
+the current location, so a hash of the three is the key of two caches:
+
+* rendered PNG files on disk, shared by every player with the same map, and
+* the Telegram ``file_id`` of every image already uploaded, so an identical map
+  is sent again by id instead of uploading the file.
+
+Rendering is plain Python (the PNG encoder only needs :mod:`zlib`), so it runs
+in an executor, by default a pool of worker processes, off the event loop; the
+layout of a new map version is computed once in a thread. Concurrent requests
+for the same image share a single rendering. Serving a PNG file from disk
+refreshes its modification time, so pruning the oldest files never removes one
+that was just handed out for upload.
+"""
+
+import asyncio
+import hashlib
+import os
+import pickle
+import struct
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Executor
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from catalog import Catalog
+
+STEPS = {"North": (0, 1), "South": (0, -1), "East": (1, 0), "West": (-1, 0)}
+MAX_SIZE = 2048
+MAX_CELL = 32
+MARGIN = 1
+
+BACKGROUND = bytes((24, 26, 33))
+PATH = bytes((60, 64, 72))
+EXPLORED_PATH = bytes((120, 132, 150))
+LOCATION = bytes((74, 78, 88))
+EXPLORED = bytes((86, 156, 214))
+CURRENT = bytes((255, 140, 0))
+
+
+class MapLayout(NamedTuple):
+    """
+    Grid positions of the locations of a map.
+    """
+
+    version: str
+    width: int
+    height: int
+    positions: Tuple[Tuple[int, int], ...]
+    edges: Tuple[Tuple[int, int], ...]
+
+
+class MapPicture(NamedTuple):
+    """
+    A rendered map: its cache key, its PNG file and its Telegram ``file_id``, if known.
+    """
+
+    key: str
+    path: str
+    file_id: Optional[str]
+
+
+def _free_cell(taken: Dict[Tuple[int, int], int], x: int, y: int) -> Tuple[int, int]:
+    radius = 0
+    while True:
+        for dx in range(-radius, radius + 1):
+            for dy in (-radius + abs(dx), radius - abs(dx)):
+                if (x + dx, y + dy) not in taken:
+                    return x + dx, y + dy
+        radius += 1
+
+
+def grid_layout(catalog: Catalog) -> MapLayout:
+    """
+    Place every location of a catalog on a grid.
+
+    Locations are placed breadth-first from the start location, one step from
+    their neighbour in the direction of the connection. If that cell is taken,
+    because the map is not a perfect grid, the nearest free cell is used.
+
+    Parameters
+    ----------
+    catalog : Catalog
+        The game content.
+
+    Returns
+    -------
+    MapLayout
+        Positions with the north at the top, starting at ``(0, 0)``.
+    """
+    size = len(catalog.locations)
+    positions: List[Optional[Tuple[int, int]]] = [None] * size
+    taken: Dict[Tuple[int, int], int] = {}
+    connections = [location["connections"] for location in catalog.locations]
+    for root in [catalog.start_location, *range(size)]:
+        if positions[root] is not None:
+            continue
+        # Further components of the map go to the right of what is drawn.
+        right = max((x for x, _ in taken), default=-2) + 2
+        positions[root] = _free_cell(taken, right, 0)
+        taken[positions[root]] = root
+        queue = deque([root])
+        while queue:
+            current = queue.popleft()
+            x, y = positions[current]
+            for direction, neighbour in connections[current].items():
+                if positions[neighbour] is None:
+                    dx, dy = STEPS.get(direction, (0, 0))
+                    positions[neighbour] = _free_cell(taken, x + dx, y + dy)
+                    taken[positions[neighbour]] = neighbour
+                    queue.append(neighbour)
+
+    min_x = min(x for x, _ in taken)
+    max_y = max(y for _, y in taken)
+    placed = tuple((x - min_x, max_y - y) for x, y in positions)
+    edges = {
+        (min(source, target), max(source, target))
+        for source, targets in enumerate(connections)
+        for target in targets.values()
+    }
+    return MapLayout(
+        version=catalog.version,
+        width=max(x for x, _ in placed) + 1,
+        height=max(y for _, y in placed) + 1,
+        positions=placed,
+        edges=tuple(sorted(edges)),
+    )
+
+
+def encode_png(width: int, height: int, pixels: bytes) -> bytes:
+    """
+    Encode RGB pixels as a PNG image.
+
+    Parameters
+    ----------
+    width : int
+        Width in pixels.
+    height : int
+        Height in pixels.
+    pixels : bytes
+        ``width * height`` RGB triplets, row by row.
+
+    Returns
+    -------
+    bytes
+        The PNG file.
+    """
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    stride = width * 3
+    raw = b"".join(
+        b"\x00" + pixels[row * stride : (row + 1) * stride] for row in range(height)
+    )
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def render_map(layout: MapLayout, visited: Iterable[int], current: int) -> bytes:
+    """
+    Draw a map as a PNG image.
+
+    Parameters
+    ----------
+    layout : MapLayout
+        Positions of the locations.
+    visited : Iterable[int]
+        IDs of the explored locations.
+    current : int
+        ID of the location of the player.
+
+    Returns
+    -------
+    bytes
+        The PNG file.
+    """
+    visited = set(visited)
+    cell = max(4, min(MAX_CELL, MAX_SIZE // (max(layout.width, layout.height) + 2)))
+    width = (layout.width + 2 * MARGIN) * cell
+    height = (layout.height + 2 * MARGIN) * cell
+    pixels = bytearray(BACKGROUND * (width * height))
+
+    def fill(left: int, top: int, right: int, bottom: int, color: bytes) -> None:
+        row = color * (right - left)
+        for y in range(max(top, 0), min(bottom, height)):
+            start = (y * width + left) * 3
+            pixels[start : start + len(row)] = row
+
+    def center(location: int) -> Tuple[int, int]:
+        x, y = layout.positions[location]
+        return (x + MARGIN) * cell + cell // 2, (y + MARGIN) * cell + cell // 2
+
+    thickness = max(1, cell // 8)
+    for source, target in layout.edges:
+        color = EXPLORED_PATH if source in visited and target in visited else PATH
+        (x1, y1), (x2, y2) = center(source), center(target)
+        steps = max(abs(x2 - x1), abs(y2 - y1), 1)
+        for step in range(0, steps + 1, thickness):
+            x = x1 + (x2 - x1) * step // steps - thickness // 2
+            y = y1 + (y2 - y1) * step // steps - thickness // 2
+            fill(x, y, x + thickness, y + thickness, color)
+
+    half = max(1, cell * 3 // 10)
+    for location in range(len(layout.positions)):
+        x, y = center(location)
+        if location == current:
+            fill(x - half - 2, y - half - 2, x + half + 2, y + half + 2, CURRENT)
+            continue
+        color = EXPLORED if location in visited else LOCATION
+        fill(x - half, y - half, x + half, y + half, color)
+    return encode_png(width, height, bytes(pixels))
+
+
+def render_to_file(
+    layout: MapLayout, visited: Iterable[int], current: int, path: str
+) -> None:
+    """
+    Draw a map and write it to ``path`` atomically; run in the executor.
+    """
+    data = render_map(layout, visited, current)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+class MapRenderer:
+    """
+    Renders maps off the event loop, with PNG and ``file_id`` caches.
+
+    Attributes
+    ----------
+    cache_dir : str
+        Directory of the rendered PNG files.
+    path : str or None
+        File the known ``file_id`` values are persisted to.
+    max_files : int
+        Number of PNG files kept; the oldest are removed beyond it.
+    max_file_ids : int
+        Number of ``file_id`` values kept.
+    counters : Dict[str, int]
+        Maps sent by ``file_id``, read from disk and rendered.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        executor: Optional[Executor] = None,
+        path: Optional[str] = None,
+        max_files: int = 2000,
+        max_file_ids: int = 10000,
+    ):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            Directory of the rendered PNG files; created if needed.
+        executor : Executor, optional
+            Where maps are rendered; the event loop's default thread pool if not given.
+        path : str, optional
+            File the known ``file_id`` values are persisted to; loaded if it exists.
+        max_files : int
+            Number of PNG files kept.
+        max_file_ids : int
+            Number of ``file_id`` values kept.
+        """
+        self.cache_dir = cache_dir
+        self.executor = executor
+        self.path = path
+        self.max_files = max_files
+        self.max_file_ids = max_file_ids
+        self.counters: Dict[str, int] = {"file_id": 0, "disk": 0, "rendered": 0}
+        self._file_ids: "OrderedDict[str, str]" = OrderedDict()
+        self._layouts: Dict[str, asyncio.Future] = {}
+        self._rendering: Dict[str, asyncio.Future] = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._files = sum(1 for name in os.listdir(cache_dir) if name.endswith(".png"))
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    async def layout(self, catalog: Catalog) -> MapLayout:
+        """
+        Grid layout of a catalog, computed once per catalog version in a thread.
+        """
+        version = catalog.version
+        layout = self._layouts.get(version)
+        if layout is None:
+            layout = asyncio.ensure_future(asyncio.to_thread(grid_layout, catalog))
+            self._layouts[version] = layout
+
+            def forget_failed(done: asyncio.Future) -> None:
+                if done.cancelled() or done.exception() is not None:
+                    self._layouts.pop(version, None)
+
+            layout.add_done_callback(forget_failed)
+        return await asyncio.shield(layout)
+
+    @staticmethod
+    def key(version: str, visited: Iterable[int], current: int) -> str:
+        """
+        Cache key of a map: a hash of the map version, the explored locations and
+        the current location.
+        """
+        explored = ",".join(map(str, sorted(visited)))
+        return hashlib.blake2b(
+            f"{version}|{current}|{explored}".encode(), digest_size=16
+        ).hexdigest()
+
+    async def render(
+        self, catalog: Catalog, visited: Iterable[int], current: int
+    ) -> MapPicture:
+        """
+        The map of a player, from a cache or rendered in the executor.
+
+        Parameters
+        ----------
+        catalog : Catalog
+            The game content.
+        visited : Iterable[int]
+            IDs of the explored locations.
+        current : int
+            ID of the location of the player.
+
+        Returns
+        -------
+        MapPicture
+            The map; with a ``file_id`` if it was uploaded before.
+        """
+        visited = frozenset(visited)
+        key = self.key(catalog.version, visited, current)
+        path = os.path.join(self.cache_dir, f"{key}.png")
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+            self.counters["file_id"] += 1
+            return MapPicture(key, path, file_id)
+        rendering = self._rendering.get(key)
+        if rendering is None:
+            try:
+                # The newest files are the last ones pruned.
+                os.utime(path)
+                self.counters["disk"] += 1
+                return MapPicture(key, path, None)
+            except FileNotFoundError:
+                pass
+            rendering = asyncio.ensure_future(
+                self._render(catalog, visited, current, path)
+            )
+            self._rendering[key] = rendering
+            rendering.add_done_callback(lambda _: self._rendering.pop(key, None))
+            self.counters["rendered"] += 1
+            self._files += 1
+            if self._files > self.max_files:
+                self._prune()
+        await asyncio.shield(rendering)
+        return MapPicture(key, path, None)
+
+    async def _render(
+        self, catalog: Catalog, visited: frozenset, current: int, path: str
+    ) -> None:
+        layout = await self.layout(catalog)
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, render_to_file, layout, visited, current, path
+        )
+
+    def _prune(self) -> None:
+        entries = sorted(
+            (entry.stat().st_mtime, entry.path)
+            for entry in os.scandir(self.cache_dir)
+            if entry.name.endswith(".png")
+        )
+        # Keep some headroom, so the directory is not scanned on every render.
+        excess = len(entries) - self.max_files * 9 // 10
+        for _, path in entries[: max(excess, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._files = len(entries) - max(excess, 0)
+
+    def remember(self, key: str, file_id: str) -> None:
+        """
+        Note the ``file_id`` Telegram gave to an uploaded map.
+        """
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.max_file_ids:
+            self._file_ids.popitem(last=False)
+
+    def forget(self, key: str) -> None:
+        """
+        Drop a ``file_id`` that Telegram no longer accepts.
+        """
+        self._file_ids.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        How maps were served, and the cache sizes.
+
+        Returns
+        -------
+        dict
+            The counters plus ``files`` and ``file_ids``.
+        """
+        return {
+            **self.counters,
+            "files": self._files,
+            "file_ids": len(self._file_ids),
+        }
+
+    def save(self) -> None:
+        """
+        Write the known ``file_id`` values to ``path``.
+        """
+        data = zlib.compress(
+            pickle.dumps(dict(self._file_ids), protocol=pickle.HIGHEST_PROTOCOL)
+        )
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, self.path)
+
+    def load(self) -> None:
+        """
+        Replace the known ``file_id`` values with the ones saved in ``path``.
+        """
+        with open(self.path, "rb") as file:
+            self._file_ids = OrderedDict(pickle.loads(zlib.decompress(file.read())))
+
+    def close(self) -> None:
+        """
+        Shut the executor down, if one was given.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,609 @@
+"""
+Module with dispatcher middlewares.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from collections import OrderedDict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, InlineQuery, Message, TelegramObject, Update
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+
+class KeyedLocks:
+    """
+    Per-key asyncio locks that exist only while someone holds or waits for them.
+
+    Each entry keeps a count of its holders and waiters; the lock is dropped as
+    soon as the count falls back to zero, so idle users cost no memory.
+    """
+
+    def __init__(self):
+        self._locks: Dict[Hashable, List[Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run ``func`` while holding the lock of ``key``.
+
+        Parameters
+        ----------
+        key : Hashable
+            The key to serialize on.
+        func : Callable
+            Coroutine function to call under the lock.
+
+        Returns
+        -------
+        Any
+            Whatever ``func`` returns.
+        """
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await func()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+class UserSerializationMiddleware(BaseMiddleware):
+    """
+    Processes the updates of each user one at a time and drops repeated taps.
+
+    Updates from different users still run concurrently. A callback query with
+    the same data as one of the same user that is still waiting or running is
+    answered and dropped, so spam-tapping a button does the work only once. Taps
+    that come after the first one finished go through: moving or attacking twice
+    in a row is a legitimate game move. A ``window`` extends the duplicates to
+    the taps that come less than that many seconds after the first one finished.
+
+    Attributes
+    ----------
+    window : float
+        Seconds after an update finished during which an identical callback
+        query still counts as a duplicate; 0 to only drop taps in flight.
+    dropped : int
+        Number of duplicate callback queries dropped so far.
+    """
+
+    def __init__(self, window: float = 0.0):
+        """
+        Parameters
+        ----------
+        window : float
+            Seconds after an update finished during which an identical callback
+            query still counts as a duplicate; 0 to only drop taps in flight.
+        """
+        self.window = window
+        self.dropped = 0
+        self._locks = KeyedLocks()
+        self._pending: Set[Tuple[int, str]] = set()
+        self._recent: "OrderedDict[Tuple[int, str], float]" = OrderedDict()
+
+    def _forget_old_taps(self, now: float) -> None:
+        while self._recent:
+            key, finished = next(iter(self._recent.items()))
+            if now - finished < self.window:
+                break
+            del self._recent[key]
+
+    async def __call__(
+        self, handler: Handler, event: Update, data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        query = event.callback_query
+        if query is None:
+            return await self._locks.run(user.id, lambda: handler(event, data))
+
+        tap = (user.id, query.data)
+        now = time.monotonic()
+        self._forget_old_taps(now)
+        if tap in self._pending or tap in self._recent:
+            self.dropped += 1
+            logger.debug(f"Dropped repeated tap {query.data!r} from user {user.id}.")
+            await query.answer()
+            return None
+
+        self._pending.add(tap)
+        try:
+            return await self._locks.run(user.id, lambda: handler(event, data))
+        finally:
+            self._pending.discard(tap)
+            if self.window > 0:
+                self._recent[tap] = time.monotonic()
+                self._recent.move_to_end(tap)
+
+
+class SessionPinMiddleware(BaseMiddleware):
+    """
+    Pins the session of the user while an update is processed.
+
+    While pinned, the session store will not demote the session to its cold tier,
+    so the handler never works on a copy that has already been written to disk.
+    """
+
+    async def __call__(
+        self, handler: Handler, event: Update, data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        sessions = data.get("sessions")
+        if user is None or sessions is None:
+            return await handler(event, data)
+        sessions.pin(user.id)
+        try:
+            return await handler(event, data)
+        finally:
+            sessions.unpin(user.id)
+
+
+def event_session(data: Dict[str, Any]) -> Any:
+    """
+    The session of the user of an event, for middlewares running after its handler.
+
+    The session injected by the :class:`bot.InGame` filter if there is one;
+    otherwise the user's session is looked up in the store, which is how the
+    handlers of messages reach it. Users without a session are not counted as
+    a store miss.
+
+    Parameters
+    ----------
+    data : Dict[str, Any]
+        The middleware data of the event.
+
+    Returns
+    -------
+    Session or None
+        The session, or None if the user has none.
+    """
+    session = data.get("session")
+    if session is not None:
+        return session
+    user = data.get("event_from_user")
+    sessions = data.get("sessions")
+    if user is None or sessions is None or user.id not in sessions:
+        return None
+    return sessions.get(user.id)
+
+
+class ConcurrencyLimiter(BaseMiddleware):
+    """
+    Bounds the number of handlers running at the same time.
+
+    Registered as an inner middleware, a handler takes a slot only after its
+    update got the per-user lock and passed the filters, so updates queued behind
+    another update of the same user do not hold slots. Besides the global limit,
+    handlers can be grouped into classes with the ``concurrency`` flag, e.g.
+    ``flags={"concurrency": "game"}``, and each class can have its own limit;
+    handlers without the flag are in the ``default`` class.
+
+    Waiting updates are the backpressure signal: once ``high_water`` of them are
+    queued, new updates of the low-priority classes in ``shed`` are rejected
+    with ``text`` instead of queuing behind them, so the queue drains and the
+    other classes keep their latency.
+
+    Attributes
+    ----------
+    limit : int
+        Maximum number of handlers running at the same time.
+    class_limits : Dict[str, int]
+        Maximum number of running handlers by class.
+    high_water : int or None
+        Number of waiting updates from which the ``shed`` classes are rejected.
+    shed : Set[str]
+        Classes rejected at the high-water mark.
+    rejected : int
+        Number of updates rejected at the high-water mark.
+    running : int
+        Number of handlers running.
+    waiting : int
+        Number of updates waiting for a slot.
+    max_waiting : int
+        Highest number of updates that waited for a slot at the same time.
+    """
+
+    def __init__(
+        self,
+        limit: int = 64,
+        class_limits: Optional[Dict[str, int]] = None,
+        high_water: Optional[int] = None,
+        shed: Iterable[str] = (),
+        text: str = "🚦 The bot is busy right now. Try again in a moment.",
+    ):
+        """
+        Parameters
+        ----------
+        limit : int
+            Maximum number of handlers running at the same time.
+        class_limits : Dict[str, int], optional
+            Maximum number of running handlers by class.
+        high_water : int, optional
+            Number of waiting updates from which the ``shed`` classes are
+            rejected; never if not given.
+        shed : Iterable[str]
+            Classes rejected at the high-water mark.
+        text : str
+            Reply to a rejected update.
+        """
+        self.limit = limit
+        self.class_limits = dict(class_limits or {})
+        self.high_water = high_water
+        self.shed = set(shed)
+        self.text = text
+        self.rejected = 0
+        self.running = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self._slots = asyncio.Semaphore(limit)
+        self._class_slots = {
+            name: asyncio.Semaphore(value) for name, value in self.class_limits.items()
+        }
+        self._waits = 0
+        self._delayed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    async def __call__(
+        self, handler: Handler, event: TelegramObject, data: Dict[str, Any]
+    ) -> Any:
+        name = get_flag(data, "concurrency", default="default")
+        if (
+            self.high_water is not None
+            and self.waiting >= self.high_water
+            and name in self.shed
+        ):
+            self.rejected += 1
+            if isinstance(event, (CallbackQuery, Message)):
+                await event.answer(self.text)
+            return None
+        class_slots = self._class_slots.get(name)
+        started = time.perf_counter()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        async with contextlib.AsyncExitStack() as stack:
+            try:
+                if class_slots is not None:
+                    await stack.enter_async_context(class_slots)
+                await stack.enter_async_context(self._slots)
+            finally:
+                self.waiting -= 1
+            waited = time.perf_counter() - started
+            self._waits += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            if waited > 0.001:
+                self._delayed += 1
+            self.running += 1
+            try:
+                return await handler(event, data)
+            finally:
+                self.running -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Queue depth and time spent waiting for a slot.
+
+        Returns
+        -------
+        dict
+            Running and waiting handlers, the highest queue depth, the number of
+            updates rejected at the high-water mark and of those that had to
+            wait, and the mean and maximum wait in milliseconds.
+        """
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "rejected": self.rejected,
+            "delayed": self._delayed,
+            "wait_avg_ms": (
+                1000 * self._wait_total / self._waits if self._waits else 0.0
+            ),
+            "wait_max_ms": 1000 * self._wait_max,
+        }
+
+
+class TokenBuckets:
+    """
+    Token buckets of the same capacity and refill rate, one per key.
+
+    A bucket is stored as a ``[tokens, updated, flag]`` list in an ordered dict,
+    most recently used last. A bucket left alone for ``capacity / rate`` seconds
+    is full again, which is the state of a new bucket, so such buckets are
+    dropped whenever a bucket is used and idle keys cost no memory.
+
+    Attributes
+    ----------
+    capacity : float
+        Tokens in a full bucket, i.e. the largest burst.
+    rate : float
+        Tokens added to a bucket per second.
+    """
+
+    def __init__(self, capacity: float, rate: float):
+        """
+        Parameters
+        ----------
+        capacity : float
+            Tokens in a full bucket, i.e. the largest burst.
+        rate : float
+            Tokens added to a bucket per second.
+
+        Raises
+        ------
+        ValueError
+            If the capacity or the rate is not positive.
+        """
+        if capacity <= 0 or rate <= 0:
+            raise ValueError("Token bucket capacity and rate must be positive.")
+        self.capacity = capacity
+        self.rate = rate
+        self._idle = capacity / rate
+        self._buckets: "OrderedDict[Hashable, List[float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def get(self, key: Hashable, now: Optional[float] = None) -> List[float]:
+        """
+        The bucket of a key, refilled up to now.
+
+        Parameters
+        ----------
+        key : Hashable
+            The key of the bucket.
+        now : float, optional
+            Current ``time.monotonic()``.
+
+        Returns
+        -------
+        list
+            ``[tokens, updated, flag]``; the caller may spend tokens and set the
+            flag, which is reset when the bucket is dropped.
+        """
+        if now is None:
+            now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.capacity, now, 0]
+        else:
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        while True:
+            oldest = next(iter(self._buckets.values()))
+            if now - oldest[1] < self._idle:
+                break
+            self._buckets.popitem(last=False)
+        return bucket
+
+    def take(self, key: Hashable, cost: float = 1, now: Optional[float] = None) -> bool:
+        """
+        Spend tokens of a bucket if it has enough.
+
+        Parameters
+        ----------
+        key : Hashable
+            The key of the bucket.
+        cost : float
+            Tokens to spend.
+        now : float, optional
+            Current ``time.monotonic()``.
+
+        Returns
+        -------
+        bool
+            Whether the tokens were spent.
+        """
+        bucket = self.get(key, now)
+        if bucket[0] < cost:
+            return False
+        bucket[0] -= cost
+        return True
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Rate-limits the handlers of each user with token buckets.
+
+    Every user has a bucket of ``burst`` tokens refilled at ``rate`` tokens per
+    second, and each handler spends the cost of its action from it. The action
+    of a handler is its ``throttle`` flag, e.g. ``flags={"throttle": "start"}``,
+    and costs 1 unless ``costs`` says otherwise, so expensive handlers drain the
+    bucket faster than menu navigation. Actions listed in ``action_limits`` are
+    also limited to that many uses per user every ``action_period`` seconds.
+
+    An update over a limit is shed before its handler runs: the user is told to
+    slow down once, and further updates are ignored without a reply until one is
+    let through again.
+
+    Inline queries arrive on every keystroke, so they spend from a bucket of
+    their own, of ``inline_burst`` tokens refilled at ``inline_rate``, and
+    typing a search never costs game moves. A shed inline query is answered
+    with no results, or the client would wait for an answer until it times out.
+
+    The middleware is registered twice. As an outer update middleware ahead of
+    :class:`UserSerializationMiddleware`, it charges every update one token
+    before the update waits for its user's lock, so a flood is shed without
+    queuing behind that lock. As an inner middleware before
+    :class:`ConcurrencyLimiter`, once the filters picked the handler and its
+    flags are known, it charges the rest of the action's cost and the action
+    limits; shed updates never take a handler slot.
+
+    Attributes
+    ----------
+    costs : Dict[str, float]
+        Tokens spent by the handlers of an action.
+    passed : int
+        Number of updates let through.
+    shed : int
+        Number of updates shed with a reply.
+    ignored : int
+        Number of updates shed silently.
+    """
+
+    def __init__(
+        self,
+        rate: float = 1.0,
+        burst: float = 10.0,
+        costs: Optional[Dict[str, float]] = None,
+        action_limits: Optional[Dict[str, int]] = None,
+        action_period: float = 60.0,
+        inline_rate: float = 5.0,
+        inline_burst: float = 20.0,
+        text: str = "⏳ Too many requests. Slow down a little and try again.",
+    ):
+        """
+        Parameters
+        ----------
+        rate : float
+            Tokens added to the bucket of a user per second.
+        burst : float
+            Tokens in a full bucket of a user.
+        costs : Dict[str, float], optional
+            Tokens spent by the handlers of an action; 1 for other actions.
+        action_limits : Dict[str, int], optional
+            Uses of an action allowed per user every ``action_period`` seconds.
+        action_period : float
+            Seconds over which ``action_limits`` are counted.
+        inline_rate : float
+            Inline queries allowed per user and second.
+        inline_burst : float
+            Inline queries a user may send in a burst.
+        text : str
+            Reply to the first shed update.
+        """
+        self.costs = dict(costs or {})
+        self.text = text
+        self.passed = 0
+        self.shed = 0
+        self.ignored = 0
+        self._users = TokenBuckets(burst, rate)
+        self._inline = TokenBuckets(inline_burst, inline_rate)
+        self._actions = {
+            action: TokenBuckets(limit, limit / action_period)
+            for action, limit in (action_limits or {}).items()
+        }
+
+    async def __call__(
+        self, handler: Handler, event: TelegramObject, data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        now = time.monotonic()
+        if isinstance(event, Update):
+            # Outer: the first token of every update, before the per-user lock.
+            inline = event.inline_query is not None
+            bucket = (self._inline if inline else self._users).get(user.id, now)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                bucket[2] = 0
+                self.passed += 1
+                return await handler(event, data)
+            action = "inline" if inline else "update"
+            return await self._shed(bucket, user.id, action, event.event)
+
+        bucket = self._users.get(user.id, now)
+        action = get_flag(data, "throttle", default="default")
+        cost = min(self.costs.get(action, 1), self._users.capacity) - 1
+        actions = self._actions.get(action)
+        action_bucket = actions.get(user.id, now) if actions is not None else None
+        if bucket[0] >= cost and (action_bucket is None or action_bucket[0] >= 1):
+            bucket[0] -= cost
+            if action_bucket is not None:
+                action_bucket[0] -= 1
+            return await handler(event, data)
+        return await self._shed(bucket, user.id, action, event)
+
+    async def _shed(
+        self, bucket: List[float], user_id: int, action: str, event: TelegramObject
+    ) -> None:
+        if isinstance(event, InlineQuery):
+            await event.answer([], cache_time=0, is_personal=True)
+        if bucket[2]:
+            self.ignored += 1
+            return None
+        bucket[2] = 1
+        self.shed += 1
+        logger.info(f"Throttled user {user_id} on {action!r}.")
+        if isinstance(event, (CallbackQuery, Message)):
+            await event.answer(self.text)
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Counts of throttled updates and of buckets in memory.
+
+        Returns
+        -------
+        dict
+            ``passed``, ``shed`` and ``ignored`` updates, and the number of
+            user and action ``buckets``.
+        """
+        return {
+            "passed": self.passed,
+            "shed": self.shed,
+            "ignored": self.ignored,
+            "buckets": len(self._users)
+            + len(self._inline)
+            + sum(len(buckets) for buckets in self._actions.values()),
+        }
+
+
+def parse_limits(value: str) -> Dict[str, int]:
+    """
+    Parse per-class limits written as ``game=16,admin=1``.
+
+    Also used for the per-action costs and limits of :class:`ThrottlingMiddleware`.
+
+    Parameters
+    ----------
+    value : str
+        Comma-separated ``class=limit`` pairs.
+
+    Returns
+    -------
+    Dict[str, int]
+        Limits by class.
+
+    Raises
+    ------
+    ValueError
+        If a pair is malformed or a limit is not a positive integer.
+    """
+    limits = {}
+    for pair in filter(None, (part.strip() for part in value.split(","))):
+        name, _, limit = pair.partition("=")
+        if not name or int(limit) <= 0:
+            raise ValueError(f"Invalid limit {pair!r}.")
+        limits[name.strip()] = int(limit)
+    return limits
@@ -0,0 +1,244 @@
+"""
+Module for on-demand CPU profiling of a live bot.
+
+A profiling window is opened for a number of seconds or a number of updates,
+either by an admin with the ``/profile`` command or at startup with the
+``PROFILE_UPDATES`` / ``PROFILE_SECONDS`` environment variables. While the
+window is open, ``cProfile`` records everything that runs on the event loop
+thread; when it closes, the stats are written to a ``.pstats`` file and a
+summary of the top functions is returned.
+
+When no window is open, the middleware costs one attribute check per update.
+"""
+
+import asyncio
+import cProfile
+import io
+import logging
+import math
+import os
+import pstats
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from middlewares import Handler
+
+logger = logging.getLogger(__name__)
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Profiler:
+    """
+    A profiling window over the dispatcher's handlers.
+
+    Attributes
+    ----------
+    active : bool
+        Whether a profiling window is open.
+    output_dir : str
+        Directory for the ``.pstats`` files.
+    top : int
+        Number of functions in the summary.
+    """
+
+    def __init__(self, output_dir: str = "profiles", top: int = 10):
+        """
+        Parameters
+        ----------
+        output_dir : str
+            Directory for the ``.pstats`` files.
+        top : int
+            Number of functions in the summary.
+        """
+        self.active = False
+        self.output_dir = output_dir
+        self.top = top
+        self._profile: Optional[cProfile.Profile] = None
+        self._updates_left: Optional[int] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._on_done: Optional[Callable[[str], Awaitable[Any]]] = None
+        self._started = 0.0
+        self._updates = 0
+
+    def start(
+        self,
+        seconds: Optional[float] = None,
+        updates: Optional[int] = None,
+        on_done: Optional[Callable[[str], Awaitable[Any]]] = None,
+    ) -> None:
+        """
+        Open a profiling window.
+
+        Parameters
+        ----------
+        seconds : float, optional
+            Close the window after this many seconds.
+        updates : int, optional
+            Close the window after this many updates.
+        on_done : Callable, optional
+            Coroutine function called with the summary when the window closes.
+
+        Raises
+        ------
+        RuntimeError
+            If a window is already open.
+        """
+        if self.active:
+            raise RuntimeError("Profiling is already running.")
+        self._updates_left = updates
+        self._on_done = on_done
+        self._updates = 0
+        self._started = time.perf_counter()
+        if seconds is not None:
+            self._timer = asyncio.get_running_loop().call_later(seconds, self._expire)
+        self._profile = cProfile.Profile()
+        self.active = True
+        self._profile.enable()
+        logger.info(
+            f"Profiling started for {seconds or '-'}s / {updates or '-'} updates."
+        )
+
+    def _expire(self) -> None:
+        self._timer = None
+        asyncio.get_running_loop().create_task(self.stop())
+
+    async def stop(self) -> Optional[str]:
+        """
+        Close the profiling window, write the stats file and report the top functions.
+
+        Returns
+        -------
+        str or None
+            The summary, or None if no window was open.
+        """
+        if not self.active:
+            return None
+        self._profile.disable()
+        self.active = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(
+            self.output_dir,
+            f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{id(self._profile):x}.pstats",
+        )
+        self._profile.dump_stats(path)
+        summary = self.summarize(self._profile, path)
+        self._profile = None
+        logger.info(f"Profiling stopped, stats written to {path}.")
+
+        on_done, self._on_done = self._on_done, None
+        if on_done is not None:
+            await on_done(summary)
+        return summary
+
+    def summarize(self, profile: cProfile.Profile, path: str) -> str:
+        """
+        Format the functions that took the most time.
+
+        Two lists are reported: the bot's own functions by cumulative time, which
+        shows how a handler's time splits between e.g. ``show_location_info`` and
+        ``Protagonist.attack``, and all functions by self time, which shows the
+        library hot spots such as ``InlineKeyboardBuilder``.
+
+        Parameters
+        ----------
+        profile : cProfile.Profile
+            The finished profile.
+        path : str
+            Where the stats were written.
+
+        Returns
+        -------
+        str
+            A short plain-text report.
+        """
+        stats = pstats.Stats(profile, stream=io.StringIO()).stats
+        own = [row for row in stats.items() if row[0][0].startswith(PROJECT_DIR)]
+        elapsed = time.perf_counter() - self._started
+        lines = [f"Profiled {self._updates} updates in {elapsed:.1f}s, stats in {path}"]
+        for title, rows, column in (
+            ("Bot functions by cumulative time", own, 3),
+            ("All functions by self time", stats.items(), 2),
+        ):
+            lines += ["", title, "cumtime  tottime  calls  function"]
+            for (file_name, line, function), (_, calls, tottime, cumtime, _) in sorted(
+                rows, key=lambda row: row[1][column], reverse=True
+            )[: self.top]:
+                where = f"{os.path.basename(file_name)}:{line}" if line else file_name
+                lines.append(
+                    f"{cumtime:7.3f}  {tottime:7.3f}  {calls:5d}  {function} ({where})"
+                )
+        return "\n".join(lines)
+
+    def count_update(self) -> bool:
+        """
+        Count one finished update inside the window.
+
+        Returns
+        -------
+        bool
+            True if the update limit of the window has been reached.
+        """
+        self._updates += 1
+        if self._updates_left is None:
+            return False
+        self._updates_left -= 1
+        return self._updates_left <= 0
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    """
+    Counts updates for the profiler and closes update-limited windows.
+    """
+
+    def __init__(self, profiler: Profiler):
+        self.profiler = profiler
+
+    async def __call__(
+        self, handler: Handler, event: TelegramObject, data: Dict[str, Any]
+    ) -> Any:
+        if not self.profiler.active:
+            return await handler(event, data)
+        try:
+            return await handler(event, data)
+        finally:
+            if self.profiler.active and self.profiler.count_update():
+                await self.profiler.stop()
+
+
+def parse_window(argument: str) -> Dict[str, float]:
+    """
+    Parse the argument of ``/profile``: ``30s`` for seconds, ``100`` for updates.
+
+    Parameters
+    ----------
+    argument : str
+        The command argument.
+
+    Returns
+    -------
+    dict
+        ``{"seconds": ...}`` or ``{"updates": ...}``.
+
+    Raises
+    ------
+    ValueError
+        If the argument is not a positive finite number.
+    """
+    argument = argument.strip().lower()
+    if argument.endswith("s"):
+        seconds = float(argument[:-1])
+        # ``nan`` and ``inf`` parse as floats but would never close the window.
+        if not math.isfinite(seconds) or seconds <= 0:
+            raise ValueError("The profiling window must be positive and finite.")
+        return {"seconds": seconds}
+    updates = int(argument)
+    if updates <= 0:
+        raise ValueError("The profiling window must be positive.")
+    return {"updates": updates}
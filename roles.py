@@ -10,8 +10,20 @@ The protagonist interacts with NPCs, completes projects, and their knowledge and
 """
 
 import random
+import time
 from collections import defaultdict
-from typing import Dict, DefaultDict, List, Any
+from collections.abc import Sequence
+from typing import Dict, DefaultDict, List, Any, Optional, Set, Tuple
+
+from dialogue import (
+    DEFAULT_DIALOGUE, GIVE_ITEM, GIVE_QUEST, HEAL, SAY_ITEM, SAY_PHRASE, SAY_QUEST, Dialogue
+)
+
+# Nerve cells regenerate over real time, one every 10 minutes, up to the starting 100.
+HP_REGEN_RATE = 1 / 600
+HP_REGEN_CAP = 100
+# Share of the level points of a quest lost when its deadline passes.
+DEADLINE_PENALTY = 0.25
 
 
 class Protagonist:
@@ -25,7 +37,11 @@ class Protagonist:
         name: str
             Name of the player.
         hp: int
-            Number of "nerve cells" (life points) of the player.
+            Number of "nerve cells" (life points) of the player, regenerated over time.
+        hp_updated: float
+            Time (``time.time()``) at which the stored nerve cells were last brought up to date.
+        regen_rate: float
+            Nerve cells regenerated per second, up to ``HP_REGEN_CAP``.
         level_points: int
             Experience points used for leveling up.
         level: int
@@ -34,6 +50,12 @@ class Protagonist:
             Inventory of the player.
         quests: Dict[str, Dict[str, Union[int, bool]]]
             Active quests of the player.
+        score_changed: bool
+            Whether the level or the level points changed since the leaderboard last recorded them.
+        events: List[Tuple[Any, ...]]
+            Game events not yet collected by the statistics, e.g. ``("project_failed", name)``.
+        visited: Set[int]
+            IDs of the locations the player has been to.
     """
 
     def __init__(self, name: str, id: str, item: str = "Head & Shoulders"):
@@ -49,13 +71,50 @@ class Protagonist:
         """
         self.id = id
         self.name: str = name
-        self.hp: int = 100
+        self.regen_rate: float = HP_REGEN_RATE
+        self._hp: float = 100.0
+        self.hp_updated: float = time.time()
         self.level_points: int = 10
         self.level: int = 1
         self.inventory: DefaultDict[str, int] = defaultdict(int)
         self.inventory[item] += 1
         self.quests: Dict[Any, Any] = {}
         self.current_location = 1
+        self.score_changed: bool = False
+        self.events: List[Tuple[Any, ...]] = []
+        self.visited: Set[int] = set()
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        # Sessions saved before regeneration store a plain ``hp``.
+        if "hp" in state:
+            state["_hp"] = float(state.pop("hp"))
+            state.setdefault("hp_updated", time.time())
+            state.setdefault("regen_rate", HP_REGEN_RATE)
+        self.__dict__.update(state)
+
+    def _current_hp(self, now: float) -> float:
+        if self._hp >= HP_REGEN_CAP:
+            return self._hp
+        return min(HP_REGEN_CAP, self._hp + (now - self.hp_updated) * self.regen_rate)
+
+    @property
+    def hp(self) -> int:
+        """
+        Nerve cells, with the regeneration since the last update, in closed form.
+
+        Nothing runs while the player is idle: the stored value and its timestamp
+        are only brought up to date when the nerve cells change.
+        """
+        return int(self._current_hp(time.time()))
+
+    @hp.setter
+    def hp(self, value: int) -> None:
+        # Keep the fraction regenerated toward the next nerve cell, so that
+        # ``hp += 1`` does not throw away regeneration in progress.
+        now = time.time()
+        current = self._current_hp(now)
+        self._hp = current + (value - int(current))
+        self.hp_updated = now
 
     def talk_to(self, npc: "NPC") -> None:
         """
@@ -114,6 +173,7 @@ class Protagonist:
                 self.heal(1)
             if enemy_rand > 80:
                 print(f"You successfully completed the project {enemy.name}!\n")
+                self.events.append(("project_passed", enemy.name))
                 self.advance_knowledge(enemy.points)
                 self.advance_level()
                 self.check_quests("project", enemy.name)
@@ -121,6 +181,7 @@ class Protagonist:
                 print(
                     f"The project '{enemy.name}' was too difficult. , Verter rated your project: {enemy_rand}. You lost 10% of your nerve cells.\n"
                 )
+                self.events.append(("project_failed", enemy.name))
                 self.take_hit()
         else:
             print("~~You have alredy defeated this Verter.~~")
@@ -140,6 +201,7 @@ class Protagonist:
             print(
                 "####You have been expelled. You are given a certificate to visit a therapist.####"
             )
+            self.events.append(("expelled",))
 
     def heal(self, value: int = 10) -> None:
         """
@@ -162,6 +224,7 @@ class Protagonist:
                 The amount of knowledge gained (default is 1).
         """
         self.level_points += value
+        self.score_changed = True
         print(f"Your knowledge increased! You now have "
               f"{self.level_points} points.\n")
 
@@ -176,6 +239,7 @@ class Protagonist:
         - And so on up to level 9.
         """
 
+        old_level = self.level
         match self.level_points:
             case points if points > 7000:
                 self.level = 9
@@ -196,6 +260,9 @@ class Protagonist:
             case _:
                 self.level = 1
 
+        self.score_changed = True
+        if self.level != old_level:
+            self.events.append(("level", old_level, self.level))
         print(f"Your level: {self.level}\n")
 
     def take(self, item: str) -> None:
@@ -254,6 +321,38 @@ class Protagonist:
             print(f"You accepted the quest: {quest_name}")
             desc = quest["description"]
             print(f"{desc}\n")
+            if quest.get("deadline_minutes"):
+                quest["due"] = time.time() + 60 * quest["deadline_minutes"]
+                self.events.append(("quest_accepted", quest_name, quest["due"]))
+                print(f"Deadline: {quest['deadline_minutes']} minutes.\n")
+
+    def miss_deadline(self, quest_name: str, due: float) -> bool:
+        """
+        Fails a quest whose deadline passed and takes the penalty.
+
+        Parameters:
+            ----------
+            quest_name: str
+                The name of the quest.
+            due: float
+                The deadline the quest was accepted with; a quest accepted again
+                since then has another one and is left alone.
+
+        Returns:
+        -------
+            bool
+                Whether the quest was failed.
+        """
+        quest = self.quests.get(quest_name)
+        if quest is None or quest.get("done") or quest.get("due") != due:
+            return False
+        del self.quests[quest_name]
+        penalty = int(quest.get("level_points", 0) * DEADLINE_PENALTY)
+        self.level_points = max(0, self.level_points - penalty)
+        self.events.append(("quest_expired", quest_name))
+        print(f"You missed the deadline of '{quest_name}' and lost {penalty} level points.\n")
+        self.advance_level()
+        return True
 
     def check_quests(self, action_type: str, action_value: str) -> None:
         """
@@ -273,6 +372,8 @@ class Protagonist:
             self.quests[action_value]["done"] = True
             self.hp += quest.get("health", 0)
             self.level_points += quest.get("level_points", 0)
+            self.score_changed = True
+            self.events.append(("quest_done", action_value))
             print(f"Quest '{action_value}' completed! You gained {self.hp} HP and {self.level_points} level points.\n")
             self.quests[action_value] = {"done": True}
 
@@ -327,8 +428,12 @@ class NPC():
         The current quest assigned to the Peer, selected randomly from the provided list of quests.
     inventory : Dict[str, int]
         A  dictionary of items NPC has and it's amount.
+    dialogue : Dialogue
+        The compiled dialogue of the NPC's type.
+    dialogue_state : int
+        The dialogue node the conversation with the protagonist is at.
     """
-    def __init__(self, name: str, type: str, quests: Dict[str, Dict[Any, Any]], location: Dict[Any, Any], phrases: List[str], inventory: List[Dict[Any, Any]]):
+    def __init__(self, name: str, type: str, quests: Dict[str, Dict[Any, Any]], location: Dict[Any, Any], phrases: List[str], inventory: List[Dict[Any, Any]], dialogue: Optional[Dialogue] = None):
         """
         Initializes an NPC.
 
@@ -340,6 +445,8 @@ class NPC():
             A list of possible phrases that the NPC can say.
         quests : List[Dict[str, Dict[str, Any]]]
             A list of possible quests that the NPC can offer to protagonist.
+        dialogue : Dialogue, optional
+            The compiled dialogue of the NPC's type; a default one if not given.
         
         Raises
         ------
@@ -370,11 +477,14 @@ class NPC():
             raise ValueError("Quests are required for NPC initialization.")
         self.quest = self.select_random_quest(quests) if quests else None
 
+        self.dialogue: Dialogue = dialogue or DEFAULT_DIALOGUE
+        self.dialogue_state: int = self.dialogue.start
+
     def select_random_quest(
         self, quests_json: Dict[str, Dict[str, Any]]
     ) -> Dict[str, Any]:
         """
-        Selects a random quest from the given quests JSON and add phrase from quest to all pull phrases.
+        Selects a random quest from the given quests JSON.
 
         Parameters
         ----------
@@ -389,34 +499,45 @@ class NPC():
         quest_name = random.choice(list(quests_json.keys()))
         quest_details = quests_json[quest_name]
         quest_details["name"] = quest_name
-        self.phrases.append(quest_details["phrase"])
         return quest_details
 
     def talk(self, protagonist: "Protagonist") -> None:
         """
-        Communicate with the protagonist. If the NPC offers a quest or item, handle it.
+        Communicate with the protagonist: say the line of the current dialogue node,
+        apply its effects and move on to one of the following nodes.
 
         Parameters
         ----------
         protagonist : Protagonist
             The protagonist interacting with the NPC.
         """
-
-        selected_phrase = random.choice(self.phrases)
-        print(f"**{self.name}**: {selected_phrase}\n")
-
-        if self.quest and selected_phrase == self.quest["phrase"]:
+        dialogue = self.dialogue
+        state = self.dialogue_state
+        kind, line = dialogue.say[state]
+        effects = dialogue.effects[state]
+        item = None
+        if kind == SAY_PHRASE:
+            line = random.choice(self.phrases)
+        elif kind == SAY_QUEST:
+            line = self.quest["phrase"]
+        elif kind == SAY_ITEM:
+            item = random.choice(self.inventory)
+            line = item["phrase"]
+        self.dialogue_state = random.choice(dialogue.next[state])
+        print(f"**{self.name}**: {line}\n")
+
+        if effects & GIVE_QUEST:
             self.give_quest(protagonist, self.quest)
-            return
-
-        for item in self.inventory:
-            if selected_phrase == item.get("phrase"):
-                self.give(protagonist, item["name"])
-                item["amount"] -= 1
-                hp = item['mental_health']
-                protagonist.heal(hp)
-                print(f"You healed {hp} HP.\n")
-                return
+        if effects & GIVE_ITEM and item is not None and item["amount"] > 0:
+            self.give(protagonist, item["name"])
+            item["amount"] -= 1
+            hp = item['mental_health']
+            protagonist.heal(hp)
+            print(f"You healed {hp} HP.\n")
+        if effects & HEAL:
+            hp = dialogue.heal[state]
+            protagonist.heal(hp)
+            print(f"You healed {hp} HP.\n")
 
     def give_quest(self, protagonist: "Protagonist", quest: Dict[str, Any]) -> None:
         """
@@ -545,7 +666,7 @@ class Verter(Enemy):
             raise ValueError("A valid 'name' must be provided in the quest for Verter initialization.")
         self.name = quest["name"]
 
-        if not isinstance(phrases, list) or len(phrases) < 1:
+        if not isinstance(phrases, Sequence) or len(phrases) < 1:
             raise ValueError("A valid list of phrases is required for Verter initialization.")
         self.phrases = phrases
 
@@ -0,0 +1,166 @@
+"""
+Module for shortest-path routing over the game map.
+
+The map is unweighted, so the routes from a location to every other one come
+from a single breadth-first search, O(V + E). Searches run on demand, the
+first time a player asks for a route from a location, and their results are
+kept in an LRU cache of ``cache_size`` source locations. Players gather in a
+few places, so most lookups are answered from the cache, while memory stays
+O(cache_size * V) instead of the O(V²) of all-pairs tables on generated maps
+with thousands of locations.
+"""
+
+from array import array
+from collections import OrderedDict, deque
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+UNREACHABLE = -1
+
+
+class RoutingTable:
+    """
+    Shortest-path distances and routes between locations, computed on demand.
+
+    Attributes
+    ----------
+    size : int
+        Number of locations.
+    cache_size : int
+        Maximum number of source locations whose searches are kept.
+    hits : int
+        Lookups answered from a cached search.
+    misses : int
+        Lookups that ran a search.
+    """
+
+    def __init__(self, locations: List[Dict[str, Any]], cache_size: int = 256):
+        """
+        Prepare the adjacency lists of compiled catalog locations.
+
+        Parameters
+        ----------
+        locations : List[Dict[str, Any]]
+            Locations indexed by ID, with ``connections`` mapping directions to IDs.
+        cache_size : int
+            Maximum number of source locations whose searches are kept.
+        """
+        self.size: int = len(locations)
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._neighbours = [
+            sorted(set(location["connections"].values())) for location in locations
+        ]
+        self._searches: "OrderedDict[int, Tuple[array, array]]" = OrderedDict()
+
+    def _search(self, source: int) -> Tuple[array, array]:
+        searched = self._searches.get(source)
+        if searched is not None:
+            self.hits += 1
+            self._searches.move_to_end(source)
+            return searched
+        self.misses += 1
+        distances = array("i", [UNREACHABLE]) * self.size
+        parents = array("i", [UNREACHABLE]) * self.size
+        distances[source] = 0
+        parents[source] = source
+        queue = deque([source])
+        while queue:
+            current = queue.popleft()
+            for neighbour in self._neighbours[current]:
+                if distances[neighbour] == UNREACHABLE:
+                    distances[neighbour] = distances[current] + 1
+                    parents[neighbour] = current
+                    queue.append(neighbour)
+        self._searches[source] = distances, parents
+        if len(self._searches) > self.cache_size:
+            self._searches.popitem(last=False)
+        return distances, parents
+
+    def distances_from(self, source: int) -> array:
+        """
+        Number of moves from a location to every location.
+
+        Returns
+        -------
+        array
+            Distances indexed by location ID, ``UNREACHABLE`` where there is no
+            route; shared with the cache, so it must not be modified.
+        """
+        return self._search(source)[0]
+
+    def distance(self, source: int, destination: int) -> int:
+        """
+        Number of moves between two locations.
+
+        Returns
+        -------
+        int
+            The distance, or ``UNREACHABLE`` if there is no route.
+        """
+        return self._search(source)[0][destination]
+
+    def path(self, source: int, destination: int) -> Optional[List[int]]:
+        """
+        Shortest route between two locations.
+
+        Parameters
+        ----------
+        source : int
+            ID of the starting location.
+        destination : int
+            ID of the target location.
+
+        Returns
+        -------
+        list or None
+            IDs of the locations visited after ``source``, ending with
+            ``destination``; None if the destination is unreachable.
+        """
+        distances, parents = self._search(source)
+        if distances[destination] == UNREACHABLE:
+            return None
+        path = []
+        current = destination
+        while current != source:
+            path.append(current)
+            current = parents[current]
+        path.reverse()
+        return path
+
+    def nearest(
+        self, source: int, destinations: Iterable[int]
+    ) -> Optional[Tuple[int, int]]:
+        """
+        Find the closest reachable location among ``destinations``.
+
+        Returns
+        -------
+        tuple or None
+            ``(location_id, distance)`` of the nearest destination, or None if
+            none of them is reachable.
+        """
+        row = self._search(source)[0]
+        best = None
+        for destination in destinations:
+            distance = row[destination]
+            if distance != UNREACHABLE and (best is None or distance < best[1]):
+                best = (destination, distance)
+        return best
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Size and efficiency of the search cache.
+
+        Returns
+        -------
+        dict
+            ``cached`` searches, ``hits``, ``misses`` and ``hit_rate``.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "cached": len(self._searches),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,534 @@
+"""
+Module with the timers of delayed game events, such as quest deadlines.
+
+Every timer of every player lives in one :class:`TimerWheel`, advanced by a
+single loop task of the :class:`Scheduler`, instead of an ``asyncio`` task or
+a loop callback per timer. The wheel is hierarchical: ``LEVELS`` rings of
+``SLOTS`` slots, where a slot of level 0 holds the timers of one tick, a slot
+of level 1 the timers of ``SLOTS`` ticks, and so on. A timer goes to the
+lowest level whose ring spans its delay, and is moved down a level when the
+wheel reaches its slot, so adding, cancelling and rescheduling a timer cost
+O(1) whatever the number of timers, and a tick only touches the timers due in
+it. Timers further away than the top ring wait in an overflow slot.
+
+Each tick, the timers that came due are handed to their handler in one batch
+per kind, so a thousand deadlines that expire in the same second cost one
+handler call. The pending timers are due at wall-clock times and are saved and
+reloaded across restarts like the leaderboard, and checkpointed while they
+change, see :func:`lifecycle.setup_lifecycle`; timers that came due while the
+bot was down fire on the first tick.
+
+:class:`DeadlineMiddleware` schedules a reminder and the expiry of the quests
+accepted with a deadline, and cancels them when the quest is done.
+"""
+
+import asyncio
+import logging
+import math
+import os
+import pickle
+import time
+import zlib
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterator, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from middlewares import Handler, event_session
+
+logger = logging.getLogger(__name__)
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+LEVELS = 4
+
+
+class Timer:
+    """
+    One delayed event.
+
+    Attributes
+    ----------
+    key : Hashable
+        Identifies the timer; scheduling another timer with the same key
+        replaces it.
+    due : float
+        Wall-clock time the timer fires at.
+    kind : str
+        Selects the handler of the timer.
+    payload : Any
+        Data for the handler.
+    """
+
+    __slots__ = ("key", "due", "kind", "payload", "tick", "slot")
+
+    def __init__(self, key: Hashable, due: float, kind: str, payload: Any = None):
+        self.key = key
+        self.due = due
+        self.kind = kind
+        self.payload = payload
+        self.tick = 0
+        self.slot: Optional[Dict[Hashable, "Timer"]] = None
+
+    def __repr__(self) -> str:
+        return f"Timer({self.key!r}, due={self.due:.3f}, kind={self.kind!r})"
+
+
+class TimerWheel:
+    """
+    Hierarchical timing wheel with O(1) add and cancel.
+
+    Attributes
+    ----------
+    resolution : float
+        Seconds per tick.
+    current : int
+        The last tick the wheel was advanced to.
+    """
+
+    def __init__(self, now: float, resolution: float = 1.0):
+        """
+        Parameters
+        ----------
+        now : float
+            Wall-clock time the wheel starts at.
+        resolution : float
+            Seconds per tick; timers fire at most this late.
+        """
+        self.resolution = resolution
+        self.current = int(now // resolution)
+        self._rings: List[List[Dict[Hashable, Timer]]] = [
+            [{} for _ in range(SLOTS)] for _ in range(LEVELS)
+        ]
+        self._overflow: Dict[Hashable, Timer] = {}
+        self._ready: Dict[Hashable, Timer] = {}
+        self._timers: Dict[Hashable, Timer] = {}
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._timers
+
+    def __iter__(self) -> Iterator[Timer]:
+        return iter(list(self._timers.values()))
+
+    def get(self, key: Hashable) -> Optional[Timer]:
+        """
+        The pending timer with a key, or None.
+        """
+        return self._timers.get(key)
+
+    def add(self, timer: Timer) -> None:
+        """
+        Add a timer, replacing the pending timer with the same key.
+        """
+        self.cancel(timer.key)
+        timer.tick = math.ceil(timer.due / self.resolution)
+        self._timers[timer.key] = timer
+        self._place(timer)
+
+    def cancel(self, key: Hashable) -> Optional[Timer]:
+        """
+        Remove a pending timer.
+
+        Returns
+        -------
+        Timer or None
+            The removed timer, or None if no timer had the key.
+        """
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            del timer.slot[key]
+            timer.slot = None
+        return timer
+
+    def advance(self, now: float) -> List[Timer]:
+        """
+        Move the wheel to a time and take the timers that came due.
+
+        Parameters
+        ----------
+        now : float
+            Wall-clock time to advance to.
+
+        Returns
+        -------
+        List[Timer]
+            The due timers, earliest first; they are no longer pending.
+        """
+        target = int(now // self.resolution)
+        expired: List[Timer] = []
+        if not self._timers:
+            self.current = max(self.current, target)
+            return expired
+        if target - self.current > SLOTS:
+            # Far behind, e.g. after the machine slept: sorting every timer
+            # once is cheaper than walking the missed ticks one by one.
+            return self._rebuild(target)
+        while self.current < target:
+            self.current += 1
+            self._cascade()
+            expired.extend(self._take(self._rings[0][self.current & (SLOTS - 1)]))
+        expired.extend(self._take(self._ready))
+        expired.sort(key=lambda timer: timer.due)
+        return expired
+
+    def _place(self, timer: Timer) -> None:
+        delay = timer.tick - self.current
+        if delay <= 0:
+            slot = self._ready
+        elif delay >= SLOTS**LEVELS:
+            slot = self._overflow
+        else:
+            level = (delay.bit_length() - 1) // SLOT_BITS
+            index = (timer.tick >> (level * SLOT_BITS)) & (SLOTS - 1)
+            slot = self._rings[level][index]
+        slot[timer.key] = timer
+        timer.slot = slot
+
+    def _cascade(self) -> None:
+        # Once the level below has gone round, the slot of the current tick
+        # on this level holds timers that are now close enough to move down.
+        for level in range(1, LEVELS):
+            shift = level * SLOT_BITS
+            if self.current & ((1 << shift) - 1):
+                return
+            slot = self._rings[level][(self.current >> shift) & (SLOTS - 1)]
+            timers = list(slot.values())
+            slot.clear()
+            for timer in timers:
+                self._place(timer)
+        for timer in list(self._overflow.values()):
+            if timer.tick - self.current < SLOTS**LEVELS:
+                del self._overflow[timer.key]
+                self._place(timer)
+
+    def _rebuild(self, target: int) -> List[Timer]:
+        timers = list(self._timers.values())
+        for ring in self._rings:
+            for slot in ring:
+                slot.clear()
+        self._overflow.clear()
+        self._ready.clear()
+        self._timers.clear()
+        self.current = target
+        expired = []
+        for timer in timers:
+            if timer.tick <= target:
+                timer.slot = None
+                expired.append(timer)
+            else:
+                self._timers[timer.key] = timer
+                self._place(timer)
+        expired.sort(key=lambda timer: timer.due)
+        return expired
+
+    def _take(self, slot: Dict[Hashable, Timer]) -> List[Timer]:
+        timers = list(slot.values())
+        slot.clear()
+        for timer in timers:
+            del self._timers[timer.key]
+            timer.slot = None
+        return timers
+
+
+class Scheduler:
+    """
+    Fires the timers of a :class:`TimerWheel` from one loop task, in batches by kind.
+
+    Attributes
+    ----------
+    path : str or None
+        File the pending timers are persisted to.
+    wheel : TimerWheel
+        The pending timers.
+    handlers : Dict[str, Callable]
+        Coroutine functions called with the list of due timers of a kind.
+    fired : int
+        Number of timers fired.
+    batches : int
+        Number of handler calls.
+    errors : int
+        Number of handler calls that raised.
+    max_late : float
+        Longest delay between the due time of a timer and its handler call, in seconds.
+    dirty : bool
+        Whether the pending timers changed since they were saved or loaded.
+    """
+
+    def __init__(self, path: Optional[str] = None, resolution: float = 1.0):
+        """
+        Parameters
+        ----------
+        path : str, optional
+            File the pending timers are persisted to; loaded with :meth:`load`
+            once the previous process saved them, see :mod:`lifecycle`.
+        resolution : float
+            Seconds between ticks.
+        """
+        self.path = path
+        self.wheel = TimerWheel(time.time(), resolution)
+        self.handlers: Dict[str, Callable[[List[Timer]], Awaitable[Any]]] = {}
+        self.fired = 0
+        self.batches = 0
+        self.errors = 0
+        self.max_late = 0.0
+        self.dirty = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        """
+        Whether the loop task is firing timers.
+        """
+        return self._task is not None and not self._task.done()
+
+    def register(
+        self, kind: str, handler: Callable[[List[Timer]], Awaitable[Any]]
+    ) -> None:
+        """
+        Set the handler of a kind of timers.
+
+        Parameters
+        ----------
+        kind : str
+            The kind of the timers.
+        handler : Callable
+            Coroutine function called with the due timers of the kind of one tick.
+        """
+        self.handlers[kind] = handler
+
+    def schedule(
+        self, key: Hashable, due: float, kind: str, payload: Any = None
+    ) -> Timer:
+        """
+        Schedule a timer, replacing the pending timer with the same key.
+
+        Parameters
+        ----------
+        key : Hashable
+            Identifies the timer, e.g. ``("quest_deadline", user_id, quest_name)``.
+        due : float
+            Wall-clock time to fire at; a time in the past fires on the next tick.
+        kind : str
+            Selects the handler.
+        payload : Any
+            Data for the handler; must be picklable.
+
+        Returns
+        -------
+        Timer
+            The scheduled timer.
+        """
+        timer = Timer(key, due, kind, payload)
+        self.wheel.add(timer)
+        self.dirty = True
+        return timer
+
+    def reschedule(self, key: Hashable, due: float) -> bool:
+        """
+        Move a pending timer to another time.
+
+        Returns
+        -------
+        bool
+            Whether a timer had the key.
+        """
+        timer = self.wheel.cancel(key)
+        if timer is None:
+            return False
+        timer.due = due
+        self.wheel.add(timer)
+        self.dirty = True
+        return True
+
+    def cancel(self, key: Hashable) -> bool:
+        """
+        Cancel a pending timer.
+
+        Returns
+        -------
+        bool
+            Whether a timer had the key.
+        """
+        if self.wheel.cancel(key) is None:
+            return False
+        self.dirty = True
+        return True
+
+    def start(self) -> None:
+        """
+        Start firing timers on the running loop.
+        """
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stop firing timers; the pending ones stay scheduled.
+        """
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def fire(self, now: Optional[float] = None) -> int:
+        """
+        Advance the wheel and call the handlers of the timers that came due.
+
+        Parameters
+        ----------
+        now : float, optional
+            Wall-clock time to advance to; the current time if not given.
+
+        Returns
+        -------
+        int
+            Number of timers fired.
+        """
+        if now is None:
+            now = time.time()
+        timers = self.wheel.advance(now)
+        if not timers:
+            return 0
+        self.dirty = True
+        by_kind: Dict[str, List[Timer]] = {}
+        for timer in timers:
+            by_kind.setdefault(timer.kind, []).append(timer)
+        self.fired += len(timers)
+        self.max_late = max(self.max_late, now - timers[0].due)
+        for kind, batch in by_kind.items():
+            handler = self.handlers.get(kind)
+            if handler is None:
+                logger.warning(
+                    f"Dropped {len(batch)} '{kind}' timers without a handler."
+                )
+                continue
+            self.batches += 1
+            try:
+                await handler(batch)
+            except Exception:
+                self.errors += 1
+                logger.exception(f"Handler of {len(batch)} '{kind}' timers failed.")
+        return len(timers)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Counters of the scheduler.
+
+        Returns
+        -------
+        dict
+            ``pending`` timers, ``fired`` timers, handler ``batches`` and
+            ``errors``, and ``max_late_ms``.
+        """
+        return {
+            "pending": len(self.wheel),
+            "fired": self.fired,
+            "batches": self.batches,
+            "errors": self.errors,
+            "max_late_ms": round(self.max_late * 1000, 1),
+        }
+
+    def save(self) -> None:
+        """
+        Write the pending timers to ``path``.
+        """
+        state = [
+            (timer.key, timer.due, timer.kind, timer.payload) for timer in self.wheel
+        ]
+        data = zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def load(self) -> None:
+        """
+        Replace the pending timers with the ones saved in ``path``.
+        """
+        with open(self.path, "rb") as file:
+            state = pickle.loads(zlib.decompress(file.read()))
+        self.wheel = TimerWheel(time.time(), self.wheel.resolution)
+        for key, due, kind, payload in state:
+            self.schedule(key, due, kind, payload)
+        self.dirty = False
+
+    async def _run(self) -> None:
+        resolution = self.wheel.resolution
+        while True:
+            await asyncio.sleep(resolution - time.time() % resolution)
+            await self.fire()
+
+
+class DeadlineMiddleware(BaseMiddleware):
+    """
+    Schedules the reminders and the expiry of quests accepted during an update.
+
+    Registered as an inner middleware of messages and callback queries after
+    :class:`stats.StatsMiddleware`, so it reads the ``quest_accepted`` and
+    ``quest_done`` events of the protagonist before they are cleared. The timers are keyed by user and quest, and carry
+    the deadline they were scheduled for, so that the handlers can ignore the
+    timers of a game that ended or of a quest accepted again.
+    """
+
+    def __init__(self, scheduler: Scheduler, remind_before: float = 600.0):
+        """
+        Parameters
+        ----------
+        scheduler : Scheduler
+            The scheduler of the bot.
+        remind_before : float
+            Seconds before a deadline the player is reminded; quests with a
+            shorter deadline get no reminder.
+        """
+        self.scheduler = scheduler
+        self.remind_before = remind_before
+
+    async def __call__(
+        self, handler: Handler, event: TelegramObject, data: Dict[str, Any]
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            session = event_session(data)
+            events = (
+                session and session.player and getattr(session.player, "events", None)
+            )
+            if events:
+                self.schedule_events(session.user_id, events)
+
+    def schedule_events(self, user_id: int, events: List[tuple]) -> None:
+        """
+        Schedule or cancel the timers of the quest events of a player.
+
+        Parameters
+        ----------
+        user_id : int
+            The player.
+        events : List[tuple]
+            Events of the protagonist, e.g. ``("quest_accepted", name, due)``.
+        """
+        for event in events:
+            if event[0] == "quest_accepted":
+                _, name, due = event
+                remind_at = due - self.remind_before
+                if remind_at > time.time():
+                    self.scheduler.schedule(
+                        ("quest_reminder", user_id, name),
+                        remind_at,
+                        "quest_reminder",
+                        (user_id, name, due),
+                    )
+                self.scheduler.schedule(
+                    ("quest_deadline", user_id, name),
+                    due,
+                    "quest_deadline",
+                    (user_id, name, due),
+                )
+            elif event[0] == "quest_done":
+                self.scheduler.cancel(("quest_reminder", user_id, event[1]))
+                self.scheduler.cancel(("quest_deadline", user_id, event[1]))
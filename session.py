@@ -0,0 +1,422 @@
+"""
+Module with the per-user game session and the store that keeps sessions.
+"""
+
+import logging
+import os
+import pickle
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from catalog import Catalog
+from load_data import init_game_elements
+from roles import NPC, Protagonist, Verter
+
+logger = logging.getLogger(__name__)
+
+# Resident size of a session with a game on the shipped map, as reported by
+# /memory; the size assumed for every session until one has been measured.
+SESSION_BYTES = 19 * 1024
+
+
+class Session:
+    """
+    Class representing the state of one user: menu choices and the running game.
+
+    Attributes
+    ----------
+    user_id : int
+        Telegram ID of the user.
+    player_name : str or None
+        The chosen player type.
+    item : str or None
+        The chosen first item.
+    player : Protagonist or None
+        The protagonist of the running game, None if no game is running.
+    verters : List[Verter]
+        Verters of the running game.
+    npcs : List[NPC]
+        NPCs of the running game.
+    """
+
+    def __init__(self, user_id: int):
+        """
+        Initialize an empty session.
+
+        Parameters
+        ----------
+        user_id : int
+            Telegram ID of the user.
+        """
+        self.user_id: int = user_id
+        self.player_name: Optional[str] = None
+        self.item: Optional[str] = None
+        self.player: Optional[Protagonist] = None
+        self.verters: List[Verter] = []
+        self.npcs: List[NPC] = []
+
+    @property
+    def in_game(self) -> bool:
+        """
+        Whether the user has a running game.
+        """
+        return self.player is not None
+
+    @property
+    def ready(self) -> bool:
+        """
+        Whether both a player and an item have been chosen.
+        """
+        return bool(self.player_name and self.item)
+
+    def start_game(self, catalog: Catalog, start_location: Optional[int] = None) -> None:
+        """
+        Start a new game with the chosen player and item.
+
+        Parameters
+        ----------
+        catalog : Catalog
+            The game content.
+        start_location : int, optional
+            Location where the game starts; the catalog's start location if not given.
+        """
+        if start_location is None:
+            start_location = catalog.start_location
+        self.player, self.verters, self.npcs = init_game_elements(
+            self.player_name, self.item, catalog, str(self.user_id)
+        )
+        self.player.current_location = start_location
+        self.player.visited.add(start_location)
+
+
+class SessionStore:
+    """
+    Two-tier store of sessions with a memory budget.
+
+    Recently used sessions stay in memory (the hot tier) in LRU order. Sessions
+    idle for longer than ``ttl`` seconds, or pushed out when the hot tier is over
+    its budget, are demoted to the cold tier: one compressed pickle per user in
+    ``cold_dir``. A cold session is promoted back transparently the next time it
+    is accessed. Demotion happens lazily on access, so no timer runs for idle
+    users. Sessions without a game and without any choice are simply dropped
+    instead of being written to disk. Sessions pinned by an update that is being
+    processed are never demoted, so a handler never mutates a stale copy.
+
+    The size of the hot tier is estimated as the number of sessions times the
+    mean resident size of a session. The mean starts at ``session_bytes``, so
+    ``max_bytes`` applies from the first session on, and is refined with the
+    sessions ``measure`` reports on demotion, when they are complete. A cold
+    file that cannot be read is logged and dropped, and its user starts over.
+
+    The store supports the dictionary operations the handlers use: ``get``,
+    ``[]``, ``in``, ``del``, ``pop`` and ``len``.
+
+    Attributes
+    ----------
+    max_hot : int
+        Maximum number of sessions kept in memory.
+    max_bytes : int or None
+        Maximum estimated size of the hot tier in memory, in bytes.
+    ttl : float
+        Seconds of inactivity after which a session is demoted.
+    cold_dir : str
+        Directory of the cold tier.
+    measure : Callable or None
+        Returns the resident size in bytes of a session; see
+        :func:`diagnostics.session_sizer`.
+    on_demote : Callable or None
+        Called with every session that leaves memory for the cold tier, or is
+        dropped because it is empty.
+    on_promote : Callable or None
+        Called with every session loaded into memory from the cold tier or from
+        a snapshot.
+    """
+
+    COLD_SUFFIX = ".session"
+
+    def __init__(
+        self,
+        max_hot: int = 10000,
+        max_bytes: Optional[int] = None,
+        ttl: float = 1800.0,
+        cold_dir: str = "sessions",
+        session_bytes: float = SESSION_BYTES,
+        measure: Optional[Callable[[Session], int]] = None,
+    ):
+        """
+        Parameters
+        ----------
+        max_hot : int
+            Maximum number of sessions kept in memory.
+        max_bytes : int, optional
+            Maximum estimated size of the hot tier in memory, in bytes.
+        ttl : float
+            Seconds of inactivity after which a session is demoted.
+        cold_dir : str
+            Directory of the cold tier; created if missing.
+        session_bytes : float
+            Resident size assumed for a session until one has been measured.
+        measure : Callable, optional
+            Returns the resident size in bytes of a session.
+        """
+        self.max_hot = max_hot
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cold_dir = cold_dir
+        self.measure = measure
+        self.on_demote: Optional[Callable[[Session], None]] = None
+        self.on_promote: Optional[Callable[[Session], None]] = None
+        os.makedirs(cold_dir, exist_ok=True)
+
+        self._hot: "OrderedDict[int, Session]" = OrderedDict()
+        self._last_access: Dict[int, float] = {}
+        self._pinned: Dict[int, int] = {}
+        self._cold: Set[int] = self._scan_cold()
+        self._session_bytes = float(session_bytes)
+        self._measured = 0
+        self._counters = {"hot_hits": 0, "cold_hits": 0, "misses": 0, "demotions": 0}
+
+    def _scan_cold(self) -> Set[int]:
+        return {
+            int(name[: -len(self.COLD_SUFFIX)])
+            for name in os.listdir(self.cold_dir)
+            if name.endswith(self.COLD_SUFFIX)
+        }
+
+    def _cold_path(self, user_id: int) -> str:
+        return os.path.join(self.cold_dir, f"{user_id}{self.COLD_SUFFIX}")
+
+    def _demote(self, user_id: int) -> None:
+        session = self._hot.pop(user_id)
+        del self._last_access[user_id]
+        self._counters["demotions"] += 1
+        if self.on_demote is not None:
+            self.on_demote(session)
+        if not (session.in_game or session.player_name or session.item):
+            return
+        if self.measure is not None:
+            size = self.measure(session)
+            self._measured += 1
+            if self._measured == 1:
+                self._session_bytes = float(size)
+            else:
+                self._session_bytes += (size - self._session_bytes) * 0.1
+        data = zlib.compress(pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL))
+        tmp_path = self._cold_path(user_id) + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, self._cold_path(user_id))
+        self._cold.add(user_id)
+
+    def _promote(self, user_id: int) -> Optional[Session]:
+        path = self._cold_path(user_id)
+        self._cold.discard(user_id)
+        try:
+            with open(path, "rb") as file:
+                session = pickle.loads(zlib.decompress(file.read()))
+        except Exception:
+            logger.exception(f"Dropped unreadable session file {path}.")
+            session = None
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return session
+
+    def _over_budget(self) -> bool:
+        if len(self._hot) > self.max_hot:
+            return True
+        return self.max_bytes is not None and self.hot_bytes > self.max_bytes
+
+    def _rebalance(self) -> None:
+        deadline = time.monotonic() - self.ttl
+        skipped = 0
+        while len(self._hot) > skipped:
+            oldest = next(iter(self._hot))
+            if self._last_access[oldest] > deadline and not self._over_budget():
+                break
+            if oldest in self._pinned:
+                self._hot.move_to_end(oldest)
+                skipped += 1
+                continue
+            self._demote(oldest)
+
+    def _touch(self, user_id: int, session: Session) -> None:
+        self._hot[user_id] = session
+        self._hot.move_to_end(user_id)
+        self._last_access[user_id] = time.monotonic()
+
+    def pin(self, user_id: int) -> None:
+        """
+        Keep the session of a user in memory until :meth:`unpin` is called.
+        """
+        self._pinned[user_id] = self._pinned.get(user_id, 0) + 1
+
+    def unpin(self, user_id: int) -> None:
+        """
+        Release a pin taken with :meth:`pin`.
+        """
+        count = self._pinned.pop(user_id) - 1
+        if count:
+            self._pinned[user_id] = count
+
+    @property
+    def hot_bytes(self) -> int:
+        """
+        Estimated resident size of the hot tier, in bytes.
+        """
+        return int(len(self._hot) * self._session_bytes)
+
+    def get(self, user_id: int, default: Any = None) -> Optional[Session]:
+        """
+        Return the session of a user, promoting it from the cold tier if needed.
+
+        Parameters
+        ----------
+        user_id : int
+            Telegram ID of the user.
+        default : Any
+            Returned if the user has no session.
+
+        Returns
+        -------
+        Session or None
+            The session, or ``default``.
+        """
+        session = self._hot.get(user_id)
+        if session is not None:
+            self._counters["hot_hits"] += 1
+        elif user_id in self._cold:
+            session = self._promote(user_id)
+            if session is not None:
+                self._counters["cold_hits"] += 1
+                if self.on_promote is not None:
+                    self.on_promote(session)
+        if session is None:
+            self._counters["misses"] += 1
+            self._rebalance()
+            return default
+        self._touch(user_id, session)
+        self._rebalance()
+        return session
+
+    def __getitem__(self, user_id: int) -> Session:
+        session = self.get(user_id)
+        if session is None:
+            raise KeyError(user_id)
+        return session
+
+    def __setitem__(self, user_id: int, session: Session) -> None:
+        if user_id in self._cold:
+            os.remove(self._cold_path(user_id))
+            self._cold.discard(user_id)
+        self._touch(user_id, session)
+        self._rebalance()
+
+    def __delitem__(self, user_id: int) -> None:
+        if user_id in self._hot:
+            del self._hot[user_id]
+            del self._last_access[user_id]
+        elif user_id in self._cold:
+            os.remove(self._cold_path(user_id))
+            self._cold.discard(user_id)
+        else:
+            raise KeyError(user_id)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._hot or user_id in self._cold
+
+    def __len__(self) -> int:
+        return len(self._hot) + len(self._cold)
+
+    def pop(self, user_id: int, default: Any = None) -> Optional[Session]:
+        """
+        Remove the session of a user from both tiers and return it.
+        """
+        session = self.get(user_id)
+        if session is None:
+            return default
+        del self[user_id]
+        return session
+
+    def hot_sessions(self) -> List[Session]:
+        """
+        The sessions held in memory, least recently used first, without touching them.
+        """
+        return list(self._hot.values())
+
+    def snapshot(self, path: str) -> int:
+        """
+        Write every in-memory session to one snapshot file for a successor process.
+
+        The cold tier is already on disk, so only the hot tier is written.
+
+        Parameters
+        ----------
+        path : str
+            Path of the snapshot file.
+
+        Returns
+        -------
+        int
+            Number of sessions written.
+        """
+        data = zlib.compress(
+            pickle.dumps(dict(self._hot), protocol=pickle.HIGHEST_PROTOCOL)
+        )
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        return len(self._hot)
+
+    def restore(self, path: str) -> int:
+        """
+        Load the sessions of a snapshot into the hot tier and remove the file.
+
+        The cold tier directory is rescanned as well, since the previous process
+        may have demoted sessions after this store was created.
+
+        Parameters
+        ----------
+        path : str
+            Path of the snapshot file.
+
+        Returns
+        -------
+        int
+            Number of sessions restored.
+        """
+        with open(path, "rb") as file:
+            sessions = pickle.loads(zlib.decompress(file.read()))
+        os.remove(path)
+        self._cold = self._scan_cold()
+        for user_id, session in sessions.items():
+            self[user_id] = session
+            if self.on_promote is not None:
+                self.on_promote(session)
+        return len(sessions)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Sizes of the tiers and hit rates of lookups.
+
+        Returns
+        -------
+        dict
+            Counts of hot and cold sessions, estimated hot bytes, lookup counters
+            and the share of lookups served by each tier.
+        """
+        lookups = sum(
+            self._counters[name] for name in ("hot_hits", "cold_hits", "misses")
+        )
+        return {
+            "hot": len(self._hot),
+            "cold": len(self._cold),
+            "hot_bytes": self.hot_bytes,
+            **self._counters,
+            "hot_hit_rate": self._counters["hot_hits"] / lookups if lookups else 0.0,
+            "cold_hit_rate": self._counters["cold_hits"] / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,325 @@
+"""
+Module with incremental game statistics for operators.
+
+Every statistic is a counter or a histogram updated as game events happen, so
+reading them never walks the sessions. Game logic in :mod:`roles` queues its
+events on the protagonist (:attr:`roles.Protagonist.events`) and
+:class:`StatsMiddleware` collects them after each update; game starts, game
+ends and moves are counted by the handlers directly.
+
+Counts over the last hour and the last day are kept in ring buffers of
+one-minute and one-hour buckets, so they cost a fixed amount of memory and time
+whatever the number of players.
+
+The running games are gauges of the games held in memory: the session store
+reports the sessions it moves to disk and back (see
+:attr:`session.SessionStore.on_demote`), so abandoned games stop counting once
+they are idle for the session TTL. Gauges are not persisted; the sessions
+handed off by the previous process are counted again as they are restored. The
+counters are marked dirty on every event, so that the periodic checkpoints of
+:mod:`lifecycle` keep them across a crash.
+"""
+
+import os
+import pickle
+import time
+import zlib
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from middlewares import Handler, event_session
+
+
+class RingCounter:
+    """
+    Counters over a sliding time window, kept in a ring of fixed-width buckets.
+
+    Attributes
+    ----------
+    slots : int
+        Number of buckets.
+    width : int
+        Width of a bucket, in seconds.
+    """
+
+    def __init__(self, slots: int, width: int):
+        """
+        Parameters
+        ----------
+        slots : int
+            Number of buckets; the window is ``slots * width`` seconds.
+        width : int
+            Width of a bucket, in seconds.
+        """
+        self.slots = slots
+        self.width = width
+        self._epochs: List[int] = [-1] * slots
+        self._buckets: List[Counter] = [Counter() for _ in range(slots)]
+
+    def add(self, name: str, value: int = 1, now: Optional[float] = None) -> None:
+        """
+        Add ``value`` to the counter ``name`` in the current bucket.
+        """
+        epoch = int((time.time() if now is None else now) // self.width)
+        slot = epoch % self.slots
+        if self._epochs[slot] != epoch:
+            self._epochs[slot] = epoch
+            self._buckets[slot].clear()
+        self._buckets[slot][name] += value
+
+    def total(self, now: Optional[float] = None) -> Counter:
+        """
+        Sum of the counters over the window.
+
+        Returns
+        -------
+        Counter
+            Counts by name.
+        """
+        epoch = int((time.time() if now is None else now) // self.width)
+        total = Counter()
+        for bucket_epoch, bucket in zip(self._epochs, self._buckets):
+            if epoch - self.slots < bucket_epoch <= epoch:
+                total.update(bucket)
+        return total
+
+
+class GameStats:
+    """
+    Counters and histograms of the game, all-time and over the last hour and day.
+
+    Attributes
+    ----------
+    path : str or None
+        File the statistics are persisted to.
+    dirty : bool
+        Whether an event was counted since the last save or load.
+    active : int
+        Number of running games in memory.
+    totals : Counter
+        All-time event counts: ``games_started``, ``games_completed``,
+        ``games_quit``, ``expulsions``, ``projects_passed``, ``projects_failed``,
+        ``quests_done``, ``quests_expired`` and ``visits``.
+    levels : Counter
+        Number of running games in memory by level of the player.
+    failures : Counter
+        Failed attempts by project name.
+    visits : Counter
+        Visits by location name.
+    last_hour : RingCounter
+        Event counts in one-minute buckets.
+    last_day : RingCounter
+        Event counts in one-hour buckets.
+    """
+
+    # Attributes of this process that are not persisted.
+    UNSAVED = ("path", "dirty", "active", "levels")
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Parameters
+        ----------
+        path : str, optional
+            File the statistics are persisted to; loaded if it exists.
+        """
+        self.path = path
+        self.dirty = False
+        self.active = 0
+        self.totals = Counter()
+        self.levels = Counter()
+        self.failures = Counter()
+        self.visits = Counter()
+        self.last_hour = RingCounter(60, 60)
+        self.last_day = RingCounter(24, 3600)
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def count(self, name: str, value: int = 1) -> None:
+        """
+        Count an event, all-time and in the time windows.
+        """
+        now = time.time()
+        self.dirty = True
+        self.totals[name] += value
+        self.last_hour.add(name, value, now)
+        self.last_day.add(name, value, now)
+
+    def game_started(self, level: int = 1) -> None:
+        """
+        Count a new game.
+        """
+        self.active += 1
+        self.levels[level] += 1
+        self.count("games_started")
+
+    def game_ended(self, level: int, reason: str) -> None:
+        """
+        Count the end of a game.
+
+        Parameters
+        ----------
+        level : int
+            Level of the player when the game ended.
+        reason : str
+            ``"completed"``, ``"expelled"`` or ``"quit"``; expulsions themselves
+            are counted from the game events.
+        """
+        self.active -= 1
+        self.levels[level] -= 1
+        if reason != "expelled":
+            self.count(f"games_{reason}")
+
+    def session_demoted(self, session: Any) -> None:
+        """
+        Stop counting the game of a session the session store moved to disk.
+        """
+        if session.in_game:
+            self.active -= 1
+            self.levels[session.player.level] -= 1
+
+    def session_promoted(self, session: Any) -> None:
+        """
+        Count again the game of a session the session store loaded into memory.
+        """
+        if session.in_game:
+            self.active += 1
+            self.levels[session.player.level] += 1
+
+    def visited(self, location_name: str) -> None:
+        """
+        Count a visit to a location, at the start of a game or after a move.
+        """
+        self.visits[location_name] += 1
+        self.count("visits")
+
+    def record_events(self, events: Iterable[Tuple[Any, ...]]) -> None:
+        """
+        Count the events queued by the protagonist.
+
+        Parameters
+        ----------
+        events : Iterable[Tuple[Any, ...]]
+            Events such as ``("project_failed", name)`` or ``("level", old, new)``.
+        """
+        for event in events:
+            kind = event[0]
+            if kind == "project_failed":
+                self.failures[event[1]] += 1
+                self.count("projects_failed")
+            elif kind == "project_passed":
+                self.count("projects_passed")
+            elif kind == "quest_done":
+                self.count("quests_done")
+            elif kind == "quest_expired":
+                self.count("quests_expired")
+            elif kind == "expelled":
+                self.count("expulsions")
+            elif kind == "level":
+                self.levels[event[1]] -= 1
+                self.levels[event[2]] += 1
+
+    def report(self, top: int = 5) -> str:
+        """
+        Format the statistics for the ``/stats`` command.
+
+        Parameters
+        ----------
+        top : int
+            Number of projects and locations listed.
+
+        Returns
+        -------
+        str
+            A plain-text report.
+        """
+        hour, day = self.last_hour.total(), self.last_day.total()
+        lines = [f"📊 Active games: {self.active}", "", "event: total / 24h / 1h"]
+        for name in (
+            "games_started",
+            "games_completed",
+            "games_quit",
+            "expulsions",
+            "projects_passed",
+            "projects_failed",
+            "quests_done",
+            "quests_expired",
+            "visits",
+        ):
+            lines.append(f"{name}: {self.totals[name]} / {day[name]} / {hour[name]}")
+        levels = ", ".join(
+            f"{level}: {count}"
+            for level, count in sorted(self.levels.items())
+            if count > 0
+        )
+        lines += ["", f"Levels of running games: {levels or '-'}", ""]
+        lines.append("Most failed projects:")
+        lines += [
+            f"{name}: {count}" for name, count in self.failures.most_common(top)
+        ] or ["-"]
+        lines += ["", "Most visited locations:"]
+        lines += [
+            f"{name}: {count}" for name, count in self.visits.most_common(top)
+        ] or ["-"]
+        return "\n".join(lines)
+
+    def save(self) -> None:
+        """
+        Write the statistics to ``path``.
+        """
+        data = zlib.compress(
+            pickle.dumps(self._state(), protocol=pickle.HIGHEST_PROTOCOL)
+        )
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def load(self) -> None:
+        """
+        Replace the counters with the ones saved in ``path``, keeping the gauges.
+        """
+        with open(self.path, "rb") as file:
+            state = pickle.loads(zlib.decompress(file.read()))
+        self.__dict__.update(
+            {name: value for name, value in state.items() if name not in self.UNSAVED}
+        )
+        self.dirty = False
+
+    def _state(self) -> Dict[str, Any]:
+        return {
+            name: value
+            for name, value in vars(self).items()
+            if name not in self.UNSAVED
+        }
+
+
+class StatsMiddleware(BaseMiddleware):
+    """
+    Counts the game events queued by the session's player during an update.
+
+    Registered as an inner middleware of messages and callback queries, so the
+    session injected by the :class:`bot.InGame` filter is available even if the
+    handler ended the game; message handlers get theirs from the store, see
+    :func:`middlewares.event_session`.
+    """
+
+    def __init__(self, stats: GameStats):
+        self.stats = stats
+
+    async def __call__(
+        self, handler: Handler, event: TelegramObject, data: Dict[str, Any]
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            session = event_session(data)
+            events = (
+                session and session.player and getattr(session.player, "events", None)
+            )
+            if events:
+                self.stats.record_events(events)
+                events.clear()
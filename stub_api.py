@@ -0,0 +1,296 @@
+"""
+Local stand-in for the Telegram Bot API, for testing the transport.
+
+The server answers the Bot API methods the bot uses with well-formed results.
+A share of the calls can be made slow or failing, to see how the transport of
+:mod:`transport` behaves when the API is degraded. It also counts the TCP
+connections it accepted, to check that connections are reused.
+
+Run a server for the bot (with ``BOT_API_URL=http://127.0.0.1:8081``)::
+
+    python3 stub_api.py serve --port 8081 --delay 0.02 --fail-rate 0.05
+
+or compare the tuned transport with the default aiogram session::
+
+    python3 stub_api.py bench --requests 2000 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+BOT_USER = {
+    "id": 42,
+    "is_bot": True,
+    "first_name": "Angry Verter",
+    "username": "stub_bot",
+}
+
+
+class StubApi:
+    """
+    Behaviour and counters of the stand-in server.
+
+    Attributes
+    ----------
+    delay : float
+        Seconds every call takes.
+    slow_rate : float
+        Share of the calls that take ``slow_delay`` seconds instead.
+    slow_delay : float
+        Seconds a slow call takes.
+    fail_rate : float
+        Share of the calls answered with ``502 Bad Gateway``.
+    flood_rate : float
+        Share of the calls answered with ``429 Too Many Requests``.
+    blocked_rate : float
+        Share of the messages answered with ``403 Forbidden``, as if the user
+        blocked the bot.
+    requests : int
+        Number of calls received.
+    connections : int
+        Number of TCP connections accepted.
+    """
+
+    def __init__(
+        self,
+        delay: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_delay: float = 2.0,
+        fail_rate: float = 0.0,
+        flood_rate: float = 0.0,
+        blocked_rate: float = 0.0,
+    ):
+        self.delay = delay
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.fail_rate = fail_rate
+        self.flood_rate = flood_rate
+        self.blocked_rate = blocked_rate
+        self.requests = 0
+        self.connections = 0
+        self._message_id = 0
+        self._transports = set()
+
+    def result(self, method: str, params: Dict[str, Any]) -> Any:
+        """
+        The result of a successful call of a Bot API method.
+        """
+        if method == "getme":
+            return BOT_USER
+        if method in ("sendmessage", "editmessagetext", "sendphoto"):
+            self._message_id += 1
+            chat_id = int(params.get("chat_id", 1))
+            return {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        if method == "getupdates":
+            return []
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if request.transport not in self._transports:
+            self._transports.add(request.transport)
+            self.connections += 1
+        self.requests += 1
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+
+        if method == "getupdates":
+            await asyncio.sleep(min(float(params.get("timeout", 0)), 1.0))
+        elif random.random() < self.slow_rate:
+            await asyncio.sleep(self.slow_delay)
+        elif self.delay:
+            await asyncio.sleep(self.delay)
+
+        if random.random() < self.fail_rate:
+            return web.json_response(
+                {"ok": False, "error_code": 502, "description": "Bad Gateway"},
+                status=502,
+            )
+        if random.random() < self.flood_rate:
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                },
+                status=429,
+            )
+        if method == "sendmessage" and random.random() < self.blocked_rate:
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 403,
+                    "description": "Forbidden: bot was blocked by the user",
+                },
+                status=403,
+            )
+        return web.json_response({"ok": True, "result": self.result(method, params)})
+
+    def create_app(self) -> web.Application:
+        """
+        The aiohttp application serving ``/bot<token>/<method>``.
+        """
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+async def start_server(api: StubApi, host: str = "127.0.0.1", port: int = 0):
+    """
+    Start the stand-in server.
+
+    Parameters
+    ----------
+    api : StubApi
+        The server behaviour.
+    host : str
+        Address to listen on.
+    port : int
+        Port to listen on; 0 picks a free one.
+
+    Returns
+    -------
+    tuple
+        The ``web.AppRunner`` to clean up and the base URL of the server.
+    """
+    runner = web.AppRunner(api.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://{host}:{port}"
+
+
+def percentile(values: List[float], share: float) -> float:
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    return values[max(0, math.ceil(share * len(values)) - 1)]
+
+
+async def bench(args: argparse.Namespace) -> None:
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.exceptions import TelegramAPIError
+
+    from transport import PooledSession
+
+    api = StubApi(
+        delay=args.delay,
+        slow_rate=args.slow_rate,
+        slow_delay=args.slow_delay,
+        fail_rate=args.fail_rate,
+    )
+    runner, url = await start_server(api)
+    server = TelegramAPIServer.from_base(url)
+    results = {}
+    for name, session in (
+        ("aiohttp", AiohttpSession(api=server)),
+        ("pooled", PooledSession(api=server, backoff=0.05, max_backoff=0.5)),
+    ):
+        bot = Bot(token="42:stub", session=session)
+        requests, connections = api.requests, api.connections
+        gate = asyncio.Semaphore(args.concurrency)
+        latencies, errors = [], 0
+
+        async def send(index: int):
+            nonlocal errors
+            async with gate:
+                started = time.perf_counter()
+                try:
+                    await bot.send_message(chat_id=index, text="ping")
+                except TelegramAPIError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(index) for index in range(args.requests)))
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        results[name] = {
+            "seconds": round(elapsed, 3),
+            "p50_ms": round(1000 * percentile(latencies, 0.5), 2),
+            "p99_ms": round(1000 * percentile(latencies, 0.99), 2),
+            "errors": errors,
+            "server_requests": api.requests - requests,
+            "server_connections": api.connections - connections,
+            **(session.stats() if isinstance(session, PooledSession) else {}),
+        }
+        await session.close()
+    await runner.cleanup()
+    print(json.dumps(results, indent=2))
+
+
+async def serve(args: argparse.Namespace) -> None:
+    api = StubApi(
+        delay=args.delay,
+        slow_rate=args.slow_rate,
+        slow_delay=args.slow_delay,
+        fail_rate=args.fail_rate,
+        flood_rate=args.flood_rate,
+        blocked_rate=args.blocked_rate,
+    )
+    runner, url = await start_server(api, args.host, args.port)
+    print(f"Stub Bot API listening on {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Run the stand-in server.")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8081)
+    serve_parser.add_argument(
+        "--flood-rate", type=float, default=0.0, help="Share of 429 answers."
+    )
+    serve_parser.add_argument(
+        "--blocked-rate",
+        type=float,
+        default=0.0,
+        help="Share of messages answered with 403, as if the user blocked the bot.",
+    )
+    bench_parser = subparsers.add_parser(
+        "bench", help="Compare the pooled transport with the default session."
+    )
+    bench_parser.add_argument("--requests", type=int, default=1000)
+    bench_parser.add_argument("--concurrency", type=int, default=50)
+    for subparser in (serve_parser, bench_parser):
+        subparser.add_argument(
+            "--delay", type=float, default=0.0, help="Seconds every call takes."
+        )
+        subparser.add_argument(
+            "--slow-rate", type=float, default=0.0, help="Share of slow calls."
+        )
+        subparser.add_argument(
+            "--slow-delay", type=float, default=2.0, help="Seconds a slow call takes."
+        )
+        subparser.add_argument(
+            "--fail-rate", type=float, default=0.0, help="Share of 502 answers."
+        )
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args) if args.command == "serve" else bench(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
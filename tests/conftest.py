@@ -0,0 +1,23 @@
+import os
+import shutil
+
+import pytest
+
+from catalog import Catalog, compile_catalog
+
+INFO_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "info")
+
+
+@pytest.fixture(scope="session")
+def catalog() -> Catalog:
+    return Catalog(compile_catalog(INFO_DIR))
+
+
+@pytest.fixture
+def info_dir(tmp_path):
+    """A copy of the content files that a test may edit."""
+    path = tmp_path / "info"
+    shutil.copytree(
+        INFO_DIR, path, ignore=shutil.ignore_patterns("catalog.json", "*.pack")
+    )
+    return str(path)
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import signal
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from session import Session, SessionStore
+from stats import GameStats
+from stub_api import StubApi, start_server
+
+bot_create_shared = bot.create_shared
+bot_create_dispatcher = bot.create_dispatcher
+
+
+class Chat:
+    def __init__(self):
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+def fight_setup(tmp_path, catalog, ratings, hp):
+    sessions = SessionStore(cold_dir=str(tmp_path))
+    session = sessions[1] = Session(1)
+    session.player_name = bot.valid_player_names[0]
+    session.item = bot.valid_items[0]
+    session.start_game(catalog)
+    session.player.hp = hp
+    here = catalog.locations[session.player.current_location]["name"]
+    for verter in session.verters:
+        verter.location = "elsewhere"
+    for verter, rating in zip(session.verters, ratings):
+        verter.location = here
+        verter.attack = lambda rating=rating: rating
+    query = Chat()
+    query.message = Chat()
+    query.from_user = SimpleNamespace(id=1)
+    return sessions, session, query
+
+
+def fight(query, session, sessions, catalog, stats):
+    return asyncio.run(
+        bot.fight_all_verters(
+            query, session, sessions, bot.get_keyboards(), catalog, stats
+        )
+    )
+
+
+@pytest.fixture
+def steady_peers(monkeypatch):
+    # Peers rate every project at the player's HP, so nobody heals by chance.
+    monkeypatch.setattr("roles.random.randint", lambda low, high: high)
+
+
+def test_fighting_every_project_reports_each_result(tmp_path, catalog, steady_peers):
+    sessions, session, query = fight_setup(tmp_path, catalog, [90, 75, 90], hp=100)
+    names = [verter.name for verter in session.verters[:3]]
+
+    fight(query, session, sessions, catalog, GameStats())
+
+    summary = query.message.answers[0]
+    lines = summary.splitlines()
+    assert lines[0].startswith(f"✅ {names[0]}: HP +0, level 1 → ")
+    assert lines[1] == f"❌ {names[1]}: HP -10"
+    assert lines[2].startswith(f"✅ {names[2]}: HP +0, level ")
+    assert "Total: HP 100 → 90" in summary and "Stopped early" not in summary
+    assert query.answers == ["You tried 3 project(s)."]
+    assert session.in_game
+
+
+def test_fighting_stops_when_the_player_is_expelled(tmp_path, catalog, steady_peers):
+    sessions, session, query = fight_setup(tmp_path, catalog, [75, 75, 95], hp=45)
+    stats = GameStats()
+    stats.game_started(session.player.level)
+
+    fight(query, session, sessions, catalog, stats)
+
+    summary = query.message.answers[0]
+    assert summary.split("\n\n")[0].splitlines() == [
+        f"❌ {verter.name}: HP -9" for verter in session.verters[:2]
+    ]
+    assert "Stopped early, 1 project(s) not tried." in summary
+    assert "expelled" in query.message.answers[1]
+    assert 1 not in sessions and stats.active == 0
+
+
+class RecordingApi(StubApi):
+    def __init__(self):
+        super().__init__()
+        self.polled = set()
+
+    async def handle(self, request):
+        if request.match_info["method"].lower() == "getupdates":
+            self.polled.add(request.match_info["token"])
+        return await super().handle(request)
+
+
+def test_hosted_bots_share_content_but_not_state(tmp_path, monkeypatch, catalog):
+    for name in ("HEALTH_PORT", "TRACE_FILE", "HANDOFF_FILE", "MAP_CACHE_DIR"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("SESSION_DIR", str(tmp_path))
+    monkeypatch.setenv("CHECKPOINT_INTERVAL", "0")
+    monkeypatch.setattr(bot, "create_shared", lambda: bot_create_shared(catalog))
+    dispatchers = []
+
+    def create_dispatcher(**kwargs):
+        dispatchers.append(bot_create_dispatcher(**kwargs))
+        return dispatchers[-1]
+
+    monkeypatch.setattr(bot, "create_dispatcher", create_dispatcher)
+    api = RecordingApi()
+
+    async def main():
+        runner, url = await start_server(api)
+        monkeypatch.setenv("BOT_API_URL", url)
+        settings = [
+            bot.BotSettings("kazan", token="1:kazan"),
+            bot.BotSettings("moscow", token="2:moscow"),
+        ]
+        hosting = asyncio.create_task(bot.host_bots(settings))
+        while len(api.polled) < 2:
+            await asyncio.sleep(0.05)
+        os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.wait_for(hosting, 10)
+        await runner.cleanup()
+
+    asyncio.run(main())
+
+    kazan, moscow = dispatchers
+    for shared in ("catalog", "inline_search", "maps"):
+        assert kazan[shared] is moscow[shared]
+    for own in ("sessions", "leaderboard", "stats", "scheduler"):
+        assert kazan[own] is not moscow[own]
+    assert api.polled == {"1:kazan", "2:moscow"}
+    for name in ("kazan", "moscow"):
+        assert os.path.exists(tmp_path / name / "handoff.snapshot")
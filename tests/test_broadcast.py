@@ -0,0 +1,149 @@
+import asyncio
+import sqlite3
+from types import SimpleNamespace
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramServerError,
+)
+from aiogram.methods import SendMessage
+
+from broadcast import FIRST_CHAT, Broadcaster, ChatRegistry, RegistryMiddleware
+from transport import CircuitOpenError
+
+
+class FakeBot:
+    def __init__(self, blocked=(), delay=0.0, outages=(), invalid=()):
+        self.blocked = set(blocked)
+        self.delay = delay
+        # Errors raised, one per call, before the API is reachable again.
+        self.outages = list(outages)
+        self.invalid = set(invalid)
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(self.delay)
+        method = SendMessage(chat_id=chat_id, text=text)
+        if self.outages:
+            raise self.outages.pop(0)(method=method, message="unavailable")
+        if chat_id in self.blocked:
+            raise TelegramForbiddenError(method=method, message="blocked")
+        if chat_id in self.invalid:
+            raise TelegramBadRequest(method=method, message="chat not found")
+        self.sent.append(chat_id)
+
+
+def registry_of(tmp_path, chats):
+    registry = ChatRegistry(str(tmp_path / "chats.sqlite"))
+    for chat_id in chats:
+        registry.add(chat_id)
+    return registry
+
+
+def test_registry_pages_chats_in_order_and_persists(tmp_path):
+    registry = registry_of(tmp_path, [5, 3, 9, 1])
+    assert not registry.add(3)
+    registry.remove(9)
+    assert registry.page(FIRST_CHAT, 2) == [1, 3]
+    assert registry.page(3, 2) == [5]
+    registry.close()
+
+    reopened = ChatRegistry(str(tmp_path / "chats.sqlite"))
+    assert len(reopened) == 3 and 5 in reopened and 9 not in reopened
+
+
+def test_broadcast_reaches_every_chat_and_prunes_blocked_ones(tmp_path):
+    registry = registry_of(tmp_path, range(1, 8))
+    broadcaster = Broadcaster(registry, rate=1000, page_size=3)
+    bot = FakeBot(blocked={4})
+
+    async def main():
+        broadcaster.start(bot, "Hello")
+        await broadcaster._task
+
+    asyncio.run(main())
+    assert bot.sent == [1, 2, 3, 5, 6, 7]
+    assert 4 not in registry
+    progress = broadcaster.progress()
+    assert progress["status"] == "finished"
+    assert (progress["sent"], progress["pruned"], progress["total"]) == (6, 1, 7)
+
+
+def test_broadcast_waits_out_an_open_breaker_instead_of_failing_chats(tmp_path):
+    registry = registry_of(tmp_path, range(1, 8))
+    broadcaster = Broadcaster(registry, rate=1000, page_size=3, backoff=0.001)
+    outages = [CircuitOpenError] * 5 + [TelegramServerError]
+    bot = FakeBot(outages=outages, invalid={6})
+
+    async def main():
+        broadcaster.start(bot, "Hello")
+        await broadcaster._task
+
+    asyncio.run(main())
+    assert bot.outages == [] and bot.sent == [1, 2, 3, 4, 5, 7]
+    progress = broadcaster.progress()
+    assert (progress["sent"], progress["failed"], progress["pruned"]) == (6, 1, 0)
+    assert progress["status"] == "finished"
+
+
+def test_stopped_broadcast_resumes_and_cancelled_one_does_not(tmp_path):
+    registry = registry_of(tmp_path, range(1, 11))
+    broadcaster = Broadcaster(registry, rate=1000, page_size=2)
+    bot = FakeBot(delay=0.01)
+
+    async def main():
+        broadcaster.start(bot, "Hello")
+        await asyncio.sleep(0.05)
+        await broadcaster.stop()
+        assert broadcaster.progress()["status"] == "interrupted"
+        assert broadcaster.resume(bot) is not None
+        await asyncio.sleep(0.01)
+        assert broadcaster.progress()["status"] == "running"
+        await broadcaster._task
+        assert broadcaster.progress()["status"] == "finished"
+
+        broadcaster.start(bot, "Again")
+        await asyncio.sleep(0.02)
+        assert await broadcaster.cancel()
+        assert broadcaster.resume(bot) is None
+
+    asyncio.run(main())
+    # At most the last page before the stop is sent twice.
+    assert bot.sent[: bot.sent.index(10) + 1].count(1) == 1
+    assert set(bot.sent[: bot.sent.index(10) + 1]) == set(range(1, 11))
+    assert broadcaster.progress()["status"] == "cancelled"
+
+
+def test_registry_adds_the_status_column_to_old_databases(tmp_path):
+    path = str(tmp_path / "chats.sqlite")
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE broadcasts (id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT"
+        " NOT NULL, cursor INTEGER NOT NULL, total INTEGER NOT NULL, sent INTEGER"
+        " NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, pruned INTEGER NOT"
+        " NULL DEFAULT 0, started REAL NOT NULL, finished REAL)"
+    )
+    db.execute(
+        "INSERT INTO broadcasts (text, cursor, total, started, finished)"
+        " VALUES ('Hi', 0, 0, 0, 1)"
+    )
+    db.commit()
+    db.close()
+
+    broadcaster = Broadcaster(ChatRegistry(path))
+    assert broadcaster.progress()["status"] == "finished"
+
+
+def test_middleware_registers_private_chats_only(tmp_path):
+    registry = registry_of(tmp_path, [])
+    middleware = RegistryMiddleware(registry)
+
+    async def handler(event, data):
+        return event.chat.id
+
+    for chat_id, chat_type in ((1, "private"), (-2, "group"), (1, "private")):
+        message = SimpleNamespace(chat=SimpleNamespace(id=chat_id, type=chat_type))
+        assert asyncio.run(middleware(handler, message, {})) == chat_id
+    assert len(registry) == 1 and 1 in registry and -2 not in registry
+    registry.close()
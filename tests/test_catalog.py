@@ -0,0 +1,84 @@
+import json
+import os
+
+import pytest
+
+from catalog import (
+    CATALOG_FORMAT,
+    START_LOCATION_KEY,
+    ContentError,
+    compile_catalog,
+    load_catalog,
+    validate_content,
+    write_catalog,
+)
+
+
+def read(info_dir, name):
+    with open(os.path.join(info_dir, name)) as file:
+        return json.load(file)
+
+
+def write(info_dir, name, data):
+    with open(os.path.join(info_dir, name), "w") as file:
+        json.dump(data, file)
+
+
+def test_shipped_content_compiles_with_resolved_ids(catalog):
+    assert catalog.locations[catalog.start_location]["key"] == START_LOCATION_KEY
+    for location in catalog.locations:
+        for target in location["connections"].values():
+            assert 0 <= target < len(catalog.locations)
+    for quest_id, name in enumerate(catalog.quest_keys):
+        quest = catalog.quests[name]
+        assert quest["id"] == quest_id
+        assert 0 <= quest["location"] < len(catalog.locations)
+    assert all(catalog.quests[name]["type"] == "project" for name in catalog.projects)
+
+
+def test_validation_reports_every_problem(info_dir):
+    items = read(info_dir, "items.json")
+    locations = read(info_dir, "locations.json")
+    phrases = read(info_dir, "phrases.json")
+    quests = read(info_dir, "quests.json")
+    assert validate_content(items, locations, phrases, quests) == []
+
+    del locations[START_LOCATION_KEY]["connections"]["East"]
+    quest = next(iter(quests.values()))
+    quest["location_id"] = "nowhere"
+    quest["item"] = "🦄 Unicorn"
+    quest["deadline_minutes"] = 0
+    errors = validate_content(items, locations, phrases, quests)
+
+    assert any("does not connect East back" in error for error in errors)
+    assert any("missing location 'nowhere'" in error for error in errors)
+    assert any("unknown item '🦄 Unicorn'" in error for error in errors)
+    assert any("invalid deadline '0'" in error for error in errors)
+
+
+def test_compile_raises_content_error(info_dir):
+    quests = read(info_dir, "quests.json")
+    next(iter(quests.values())).pop("description")
+    write(info_dir, "quests.json", quests)
+    with pytest.raises(ContentError) as raised:
+        compile_catalog(info_dir)
+    assert len(raised.value.errors) == 1
+
+
+def test_load_uses_fresh_artifact_and_rebuilds_stale_one(info_dir, tmp_path):
+    catalog_file = str(tmp_path / "catalog.json")
+    data = compile_catalog(info_dir)
+    data["version"] = "prebuilt"
+    write_catalog(data, catalog_file)
+    assert load_catalog(catalog_file, info_dir).version == "prebuilt"
+
+    data["format"] = CATALOG_FORMAT - 1
+    write_catalog(data, catalog_file)
+    assert load_catalog(catalog_file, info_dir).version != "prebuilt"
+
+    data["format"] = CATALOG_FORMAT
+    write_catalog(data, catalog_file)
+    source = os.path.join(info_dir, "quests.json")
+    built = os.stat(catalog_file).st_mtime
+    os.utime(source, (built + 10, built + 10))
+    assert load_catalog(catalog_file, info_dir).version != "prebuilt"
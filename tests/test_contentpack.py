@@ -0,0 +1,84 @@
+import copy
+import json
+import os
+import pickle
+
+import pytest
+
+from contentpack import ContentPack, load_pack_catalog, open_pack, write_pack
+
+
+def sample_pack(path):
+    write_pack(
+        {
+            "locations": [(None, {"name": f"Room {number}"}) for number in range(50)],
+            "quests": [(f"Quest {number}", {"points": number}) for number in range(50)],
+        },
+        {"version": "test"},
+        path,
+    )
+    return ContentPack(path, cache_size=4)
+
+
+def test_records_round_trip(tmp_path):
+    pack = sample_pack(str(tmp_path / "content.pack"))
+    assert pack.meta == {"version": "test"} and pack.sections() == [
+        "locations",
+        "quests",
+    ]
+    locations = pack["locations"]
+    assert len(locations) == 50
+    assert locations[0] == {"name": "Room 0"} and locations[-1] == {"name": "Room 49"}
+    assert [location["name"] for location in locations[10:12]] == ["Room 10", "Room 11"]
+    assert list(locations) == copy.deepcopy(locations)
+    with pytest.raises(IndexError):
+        locations[50]
+
+    for number in range(20, 26):
+        locations[number]
+    locations[25]
+    assert pack.stats()["cached"] == 4 and pack.hits == 1
+    assert os.listdir(tmp_path) == ["content.pack"]
+    pack.close()
+
+
+def test_keyed_records_find_every_key(tmp_path):
+    pack = sample_pack(str(tmp_path / "content.pack"))
+    quests = pack["quests"]
+    assert list(quests) == [f"Quest {number}" for number in range(50)]
+    for number in range(50):
+        assert quests[f"Quest {number}"] == {"points": number}
+    assert "Quest 7" in quests and "Quest 50" not in quests and 7 not in quests
+    with pytest.raises(KeyError):
+        quests["Quest 50"]
+    assert copy.deepcopy(quests)["Quest 3"] == {"points": 3}
+    pack.close()
+
+
+def test_stale_pack_is_rebuilt_and_reopened(info_dir, tmp_path):
+    packs = tmp_path / "packs"
+    packs.mkdir()
+    pack_file = str(packs / "content.pack")
+    catalog = load_pack_catalog(pack_file, info_dir)
+    old = open_pack(pack_file)
+    assert load_pack_catalog(pack_file, info_dir).version == catalog.version
+    assert open_pack(pack_file) is old
+
+    source = os.path.join(info_dir, "locations.json")
+    with open(source) as file:
+        locations = json.load(file)
+    first = next(iter(locations.values()))
+    first["description"] = "Freshly painted."
+    with open(source, "w") as file:
+        json.dump(locations, file)
+    built = os.stat(pack_file).st_mtime
+    os.utime(source, (built + 10, built + 10))
+
+    rebuilt = load_pack_catalog(pack_file, info_dir)
+    assert rebuilt.version != catalog.version
+    assert open_pack(pack_file) is not old and old._buffer.closed
+    descriptions = [location["description"] for location in rebuilt.locations]
+    assert "Freshly painted." in descriptions
+    section = pickle.loads(pickle.dumps(rebuilt.locations))
+    assert section.pack is open_pack(pack_file)
+    assert os.listdir(packs) == ["content.pack"]
@@ -0,0 +1,40 @@
+import bot
+from catalog import Catalog, compile_catalog
+from conftest import INFO_DIR
+from diagnostics import (
+    COMPONENTS,
+    deep_size,
+    session_footprint,
+    session_sizer,
+    shared_ids,
+)
+from session import Session
+
+
+def started(user_id, catalog):
+    session = Session(user_id)
+    session.player_name = bot.valid_player_names[0]
+    session.item = bot.valid_items[0]
+    session.start_game(catalog)
+    return session
+
+
+def test_footprint_leaves_out_the_catalog_records_sessions_share():
+    # A catalog of its own, as the test grows one of its records.
+    catalog = Catalog(compile_catalog(INFO_DIR))
+    first, second = started(1, catalog), started(2, catalog)
+    shared = shared_ids(catalog)
+    phrases = first.verters[0].phrases
+    assert id(phrases) in shared
+    assert all(verter.phrases is phrases for verter in first.verters + second.verters)
+
+    footprint = session_footprint(first, shared)
+    assert list(footprint) == list(COMPONENTS) and all(footprint.values())
+    assert sum(footprint.values()) == session_sizer(catalog)(first)
+    unshared = session_footprint(first, set())
+    assert unshared["verters"] - footprint["verters"] >= deep_size(phrases, set())
+
+    phrases.append("x" * 10_000)
+    assert session_footprint(first, shared_ids(catalog)) == footprint
+    grown = session_footprint(first, set())
+    assert grown["verters"] - unshared["verters"] >= 10_000
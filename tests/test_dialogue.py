@@ -0,0 +1,138 @@
+import json
+import os
+import random
+from collections import Counter
+
+from conftest import INFO_DIR
+from dialogue import (
+    DEFAULT_DIALOGUE,
+    EFFECTS,
+    Dialogue,
+    compile_dialogues,
+    validate_dialogues,
+)
+from roles import NPC, Protagonist
+
+GRAPH = {
+    "start": "greet",
+    "nodes": {
+        "greet": {"say": "Hi!", "next": {"quest": 1}},
+        "quest": {"say": "{quest}", "effects": ["quest"], "next": {"gift": 1}},
+        "gift": {"say": "{item}", "effects": ["item"], "next": {"coffee": 1}},
+        "coffee": {
+            "say": "Have a coffee.",
+            "effects": ["heal"],
+            "heal": 7,
+            "next": {"chat": 1},
+        },
+        "chat": {"say": "{phrase}", "next": {"chat": 3, "greet": 1}},
+    },
+}
+
+
+def npc(dialogue=None):
+    return NPC(
+        "Mira",
+        "Peer",
+        {"Pool": {"phrase": "Do the Pool.", "description": "Swim."}},
+        {"name": "Kazan"},
+        [f"Phrase {number}" for number in range(5)],
+        [
+            {"name": "Cookie", "phrase": "A cookie?", "amount": 1, "mental_health": 3},
+            {"name": "Cake", "phrase": "A cookie?", "amount": 1, "mental_health": 3},
+        ],
+        dialogue,
+    )
+
+
+def test_compiled_tables_match_the_shipped_graphs():
+    with open(os.path.join(INFO_DIR, "dialogues.json")) as file:
+        graphs = json.load(file)
+    assert validate_dialogues(graphs) == []
+    for npc_type, tables in compile_dialogues(graphs).items():
+        graph = graphs[npc_type]
+        dialogue = Dialogue(tables)
+        assert dialogue.nodes[dialogue.start] == graph["start"]
+        for number, name in enumerate(dialogue.nodes):
+            node = graph["nodes"][name]
+            assert dialogue.say[number][1] == node["say"]
+            for effect, bit in EFFECTS.items():
+                assert bool(dialogue.effects[number] & bit) == (
+                    effect in node.get("effects", [])
+                )
+            assert dialogue.heal[number] == node.get("heal", 0)
+            nexts = Counter(dialogue.nodes[target] for target in dialogue.next[number])
+            assert nexts == Counter(node["next"])
+
+
+def test_talk_says_lines_and_applies_effects_in_order(capsys):
+    speaker = npc(Dialogue(compile_dialogues({"Peer": GRAPH})["Peer"]))
+    player = Protagonist("Aboba", "1")
+    player.hp = 50
+
+    said = []
+    for _ in range(5):
+        speaker.talk(player)
+        said.append(capsys.readouterr().out.splitlines()[0])
+        assert speaker.dialogue.nodes[speaker.dialogue_state] in GRAPH["nodes"]
+
+    assert said[:4] == [
+        "**Mira**: Hi!",
+        "**Mira**: Do the Pool.",
+        "**Mira**: A cookie?",
+        "**Mira**: Have a coffee.",
+    ]
+    assert said[4][len("**Mira**: ") :] in speaker.phrases
+    assert "Pool" in player.quests
+    assert player.inventory["Cookie"] + player.inventory["Cake"] == 1
+    assert player.hp == 50 + 3 + 7
+
+
+def test_item_is_not_given_once_the_npc_ran_out(capsys):
+    graph = {
+        "start": "gift",
+        "nodes": {"gift": {"say": "{item}", "effects": ["item"], "next": {"gift": 1}}},
+    }
+    speaker = npc(Dialogue(compile_dialogues({"Peer": graph})["Peer"]))
+    player = Protagonist("Aboba", "1")
+    for _ in range(4):
+        speaker.talk(player)
+    capsys.readouterr()
+    assert player.inventory["Cookie"] + player.inventory["Cake"] == 2
+    assert all(item["amount"] == 0 for item in speaker.inventory)
+
+
+def test_next_nodes_are_drawn_by_weight(capsys):
+    random.seed(5)
+    speaker = npc()
+    player = Protagonist("Aboba", "1")
+    visits = Counter()
+    for _ in range(4000):
+        visits[speaker.dialogue.nodes[speaker.dialogue_state]] += 1
+        speaker.talk(player)
+    capsys.readouterr()
+    # The default dialogue keeps the odds of the uncompiled talk: five
+    # phrases, one quest and two items.
+    assert speaker.dialogue is DEFAULT_DIALOGUE
+    assert abs(visits["chat"] / 4000 - 5 / 8) < 0.03
+    assert abs(visits["quest"] / 4000 - 1 / 8) < 0.03
+    assert abs(visits["item"] / 4000 - 2 / 8) < 0.03
+
+
+def test_validation_reports_broken_graphs():
+    errors = validate_dialogues(
+        {
+            "Peer": {
+                "start": "nowhere",
+                "nodes": {
+                    "chat": {
+                        "say": "Hi",
+                        "effects": ["dance", "item", "heal"],
+                        "next": {"gone": 0},
+                    }
+                },
+            },
+            "ADM": {"start": "chat", "nodes": {}},
+        }
+    )
+    assert len(errors) == 8
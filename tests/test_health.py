@@ -0,0 +1,147 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import health
+from health import HealthServer, LagMonitor
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+def stub_clock(monkeypatch, lags):
+    """Monitor sleeps that wake up ``lags`` late on a stubbed clock, then hang."""
+    clock = Clock()
+    monkeypatch.setattr(health, "time", SimpleNamespace(monotonic=clock.monotonic))
+    sleep = asyncio.sleep
+    lags = list(lags)
+
+    async def late_sleep(seconds):
+        if not lags:
+            await sleep(3600)
+        clock.now += seconds + lags.pop(0)
+        await sleep(0)
+
+    monkeypatch.setattr(health.asyncio, "sleep", late_sleep)
+    return clock, sleep
+
+
+def test_monitor_records_how_late_the_loop_wakes_up(monkeypatch):
+    clock, sleep = stub_clock(monkeypatch, [0.003, 0.2, 0.04])
+    monitor = LagMonitor(interval=0.5, threshold=1.0)
+
+    async def main():
+        monitor.start()
+        while monitor.samples < 3:
+            await sleep(0)
+        await monitor.stop()
+
+    asyncio.run(main())
+    stats = monitor.stats()
+    assert monitor.last == pytest.approx(0.04) and monitor.max == pytest.approx(0.2)
+    assert monitor.stalls == 0
+    assert stats["p50_ms"] == 50 and stats["p99_ms"] == 250
+    histogram = stats["histogram"]
+    assert (histogram["<=5ms"], histogram["<=50ms"], histogram["<=250ms"]) == (1, 1, 1)
+    assert sum(histogram.values()) == 3
+
+
+def test_watchdog_dumps_the_stack_of_a_stalled_loop_once(monkeypatch):
+    clock, sleep = stub_clock(monkeypatch, [])
+    monitor = LagMonitor(interval=0.5, threshold=0.02)
+
+    async def main():
+        monitor.start()
+        clock.now += 0.5
+        await sleep(0.05)
+        assert monitor.stalls == 0
+        clock.now += 10
+        while monitor.stalls < 1:
+            await sleep(0.01)
+        await sleep(0.05)
+        await monitor.stop()
+
+    asyncio.run(main())
+    assert monitor.stalls == 1
+    assert "test_health.py" in monitor.last_stall
+
+
+class Bot:
+    def __init__(self, bot_id, error=None):
+        self.id = bot_id
+        self.error = error
+        self.probes = 0
+
+    async def get_me(self):
+        self.probes += 1
+        if self.error is not None:
+            raise self.error
+
+
+def lag_monitor(running=True, last=0.0):
+    return SimpleNamespace(running=running, last=last, stats=lambda: {"last": last})
+
+
+def query(server, *paths):
+    async def main():
+        client = TestClient(TestServer(server.create_app()))
+        await client.start_server()
+        try:
+            responses = []
+            for path in paths:
+                response = await client.get(path)
+                responses.append((response.status, await response.json()))
+            return responses
+        finally:
+            await client.close()
+
+    return asyncio.run(main())
+
+
+def test_livez_fails_once_the_monitor_stops():
+    server = HealthServer(lag_monitor(), [], catalog_version="v1")
+    [(status, body)] = query(server, "/livez")
+    assert status == 200 and body["status"] == "ok" and body["catalog"] == "v1"
+
+    server.monitor = lag_monitor(running=False)
+    [(status, body)] = query(server, "/livez")
+    assert status == 503 and body["status"] == "monitor stopped"
+
+
+def test_readyz_reports_draining_lag_and_the_bot_api():
+    bots = [Bot(1), Bot(2)]
+    server = HealthServer(lag_monitor(), bots, catalog_version="v1", ready_lag=0.5)
+    (ok, body), (again, _) = query(server, "/readyz", "/readyz")
+    assert ok == again == 200 and body["bot_api"] == {"1": True, "2": True}
+    # The second probe is answered from the cache.
+    assert [bot.probes for bot in bots] == [1, 1]
+
+    server.monitor = lag_monitor(last=0.8)
+    [(status, body)] = query(server, "/readyz")
+    assert status == 503 and body["status"] == "lagging"
+
+    server.monitor = lag_monitor()
+    server.drain()
+    [(status, body)] = query(server, "/readyz")
+    assert status == 503 and body["status"] == "draining"
+    [(status, _)] = query(server, "/livez")
+    assert status == 200
+
+
+def test_readyz_fails_while_a_bot_cannot_reach_the_api():
+    bots = [Bot(1), Bot(2, error=ConnectionError("refused"))]
+    server = HealthServer(lag_monitor(), bots, catalog_version="v1", probe_ttl=0)
+    [(status, body)] = query(server, "/readyz")
+    assert status == 503 and body["status"] == "bot api unreachable"
+    assert body["bot_api"] == {"1": True, "2": "ConnectionError: refused"}
+
+    bots[1].error = None
+    [(status, body)] = query(server, "/readyz")
+    assert status == 200 and body["status"] == "ok"
@@ -0,0 +1,29 @@
+import subprocess
+import sys
+
+SUBSYSTEMS = (
+    "broadcast",
+    "diagnostics",
+    "health",
+    "inline",
+    "leaderboard",
+    "lifecycle",
+    "mapimage",
+    "profiling",
+    "scheduler",
+    "session",
+    "stats",
+    "tracing",
+    "transport",
+)
+
+
+def test_bot_defers_subsystem_imports():
+    probe = (
+        "import sys, bot; "
+        f"print(','.join(name for name in {SUBSYSTEMS!r} if name in sys.modules))"
+    )
+    loaded = subprocess.run(
+        [sys.executable, "-c", probe], capture_output=True, text=True, check=True
+    ).stdout.strip()
+    assert loaded == ""
@@ -0,0 +1,109 @@
+import pytest
+
+from catalog import Catalog, compile_catalog
+from inline import (
+    MAX_RESULTS,
+    PAGE_SIZE,
+    Document,
+    InlineSearch,
+    ResultCache,
+    SearchIndex,
+    catalog_documents,
+    normalize,
+)
+from mapgen import generate_content, write_content
+
+
+def document(number, name):
+    return Document("project", f"p{number}", name, "", name, normalize(name))
+
+
+def brute_force(documents, query):
+    if not query:
+        return documents[:MAX_RESULTS]
+    starts = [doc for doc in documents if doc.normalized.startswith(query)]
+    inside = [
+        doc
+        for doc in documents
+        if not doc.normalized.startswith(query) and f" {query}" in doc.normalized
+    ]
+    return (starts + inside)[:MAX_RESULTS]
+
+
+def test_normalize():
+    assert normalize("📚 SQL  Bootcamp: Day-01!") == "sql bootcamp day 01"
+
+
+def test_search_finds_word_prefixes_only():
+    documents = [
+        document(number, name)
+        for number, name in enumerate(
+            ["Calculator v2", "Recalc", "Pool", "Swimming pool", "SQL Bootcamp", "C"]
+        )
+    ]
+    index = SearchIndex(documents)
+
+    def names(query):
+        return [doc.title for doc in index.search(query)]
+
+    # The trailing boundary of the query is dropped, so a query that stops in
+    # the middle of a word still matches.
+    assert names("calc") == ["Calculator v2"]
+    assert names("calculator") == ["Calculator v2"]
+    assert names("pool") == ["Pool", "Swimming pool"]
+    assert names("sql b") == ["SQL Bootcamp"]
+    assert names("sql x") == []
+    # Queries too short for trigrams go through the word prefixes.
+    assert names("c") == ["Calculator v2", "C"]
+    assert names("bo") == ["SQL Bootcamp"]
+    assert names("zz") == []
+    assert len(names("")) == len(documents)
+    assert names("alc") == []
+
+
+def test_search_matches_a_scan_of_the_catalog(catalog):
+    documents = catalog_documents(catalog)
+    index = SearchIndex(documents)
+    queries = {""}
+    for doc in documents:
+        name = doc.normalized
+        queries.update(name[:length] for length in range(1, len(name) + 1))
+        for word in name.split():
+            queries.update(word[:length] for length in range(1, len(word) + 1))
+    for query in sorted(queries):
+        assert index.search(query) == brute_force(documents, query), query
+
+
+def test_result_cache_evicts_the_least_recently_used_query():
+    cache = ResultCache(size=2)
+    cache.put("a", [1])
+    cache.put("b", [2])
+    assert cache.get("a") == [1]
+    cache.put("c", [3])
+    assert cache.get("b") is None
+    assert cache.get("a") == [1] and cache.get("c") == [3]
+    assert cache.stats() == {"cached": 2, "hits": 3, "misses": 1, "hit_rate": 0.75}
+
+
+@pytest.fixture(scope="module")
+def big_search(tmp_path_factory):
+    info_dir = str(tmp_path_factory.mktemp("big_map"))
+    write_content(generate_content(300, seed=1), info_dir)
+    return InlineSearch(Catalog(compile_catalog(info_dir)), cache_size=4)
+
+
+def test_pages_cover_every_result_once(big_search):
+    ids, offset, pages = [], "", 0
+    while True:
+        results, offset = big_search.page("", offset)
+        assert len(results) <= PAGE_SIZE
+        ids += [result.id for result in results]
+        pages += 1
+        if not offset:
+            break
+    assert pages == MAX_RESULTS // PAGE_SIZE
+    assert len(ids) == len(set(ids)) == MAX_RESULTS
+    assert big_search.cache.stats()["misses"] == 1
+
+    assert big_search.page("", "bogus")[0] == big_search.page("", "")[0]
+    assert big_search.page("", str(MAX_RESULTS)) == ([], "")
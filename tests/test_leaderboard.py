@@ -0,0 +1,88 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from leaderboard import IndexableSkipList, Leaderboard, LeaderboardMiddleware
+
+
+def test_skip_list_matches_a_sorted_list():
+    rng = random.Random(7)
+    skip_list = IndexableSkipList()
+    expected = []
+    for _ in range(2000):
+        key = (rng.randrange(10), rng.randrange(100), rng.randrange(1000))
+        if key in expected and rng.random() < 0.5:
+            skip_list.remove(key)
+            expected.remove(key)
+        elif key not in expected:
+            skip_list.insert(key)
+            expected.append(key)
+    expected.sort()
+
+    assert list(skip_list) == expected
+    assert len(skip_list) == len(expected)
+    for position in rng.sample(range(len(expected)), 50):
+        assert skip_list[position] == expected[position]
+        assert skip_list.index(expected[position]) == position
+
+
+def test_skip_list_rejects_missing_keys():
+    skip_list = IndexableSkipList()
+    skip_list.insert((0, 0, 1))
+    with pytest.raises(KeyError):
+        skip_list.remove((0, 0, 2))
+    with pytest.raises(KeyError):
+        skip_list.index((0, 0, 2))
+    with pytest.raises(IndexError):
+        skip_list[1]
+
+
+def test_leaderboard_keeps_the_best_score_of_each_player():
+    leaderboard = Leaderboard(cache_size=2)
+    assert leaderboard.record(1, "Ann", 2, 10)
+    assert leaderboard.record(2, "Bob", 3, 0)
+    assert leaderboard.record(3, "Cid", 2, 50)
+    assert [row.user_id for row in leaderboard.top()] == [2, 3]
+
+    assert not leaderboard.record(1, "Ann", 1, 90)
+    assert leaderboard.record(1, "Ann", 4, 0)
+    assert [row.user_id for row in leaderboard.top()] == [1, 2]
+    assert leaderboard.rank(3) == 3
+    assert leaderboard.standing(3).name == "Cid"
+    assert [row.rank for row in leaderboard.top(5)] == [1, 2, 3]
+    assert leaderboard.rank(4) is None
+
+
+def test_leaderboard_is_saved_when_dirty(tmp_path):
+    path = str(tmp_path / "leaderboard.snapshot")
+    leaderboard = Leaderboard(path)
+    assert not leaderboard.dirty
+    leaderboard.record(1, "Ann", 2, 10)
+    assert leaderboard.dirty
+    leaderboard.save()
+    assert not leaderboard.dirty
+
+    reloaded = Leaderboard(path)
+    assert reloaded.rank(1) == 1 and not reloaded.dirty
+
+
+def test_middleware_records_changed_scores_only():
+    leaderboard = Leaderboard()
+    player = SimpleNamespace(level=3, level_points=40, score_changed=False)
+    data = {
+        "session": SimpleNamespace(user_id=1, player=player),
+        "event_from_user": SimpleNamespace(full_name="Aboba"),
+    }
+
+    async def handler(event, data):
+        pass
+
+    asyncio.run(LeaderboardMiddleware(leaderboard)(handler, None, data))
+    assert leaderboard.rank(1) is None
+
+    player.score_changed = True
+    asyncio.run(LeaderboardMiddleware(leaderboard)(handler, None, data))
+    assert leaderboard.standing(1)[1:] == (1, "Aboba", 3, 40)
+    assert not player.score_changed
@@ -0,0 +1,149 @@
+import asyncio
+
+from aiogram import Dispatcher
+
+from lifecycle import InFlightTracker, setup_drain, setup_lifecycle
+from session import Session, SessionStore
+
+
+def test_drain_waits_for_running_updates():
+    tracker = InFlightTracker()
+    release = None
+
+    async def handler(event, data):
+        await release.wait()
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        running = asyncio.create_task(tracker(handler, None, {}))
+        await asyncio.sleep(0)
+        assert tracker.in_flight == 1
+        assert not await tracker.drain(0.01)
+        release.set()
+        assert await tracker.drain(1)
+        await running
+
+    asyncio.run(main())
+    assert tracker.in_flight == 0
+
+
+def test_drain_runs_before_the_other_shutdown_hooks():
+    dp = Dispatcher()
+    tracker = InFlightTracker()
+    order = []
+
+    async def handler(event, data):
+        await asyncio.sleep(0.05)
+        order.append("handler")
+
+    async def teardown():
+        order.append("teardown")
+
+    setup_drain(dp, tracker)
+    dp.shutdown.register(teardown)
+
+    async def main():
+        running = asyncio.create_task(tracker(handler, None, {}))
+        await asyncio.sleep(0)
+        await dp.emit_shutdown()
+        await running
+
+    asyncio.run(main())
+    assert order == ["handler", "teardown"]
+
+
+def test_new_process_waits_for_the_snapshot_of_the_old_one(tmp_path):
+    handoff_file = str(tmp_path / "handoff.snapshot")
+    old_sessions = SessionStore(cold_dir=str(tmp_path / "old"))
+    new_sessions = SessionStore(cold_dir=str(tmp_path / "new"))
+    old, new = Dispatcher(), Dispatcher()
+    setup_lifecycle(old, old_sessions, handoff_file)
+    setup_lifecycle(new, new_sessions, handoff_file, handoff_wait=5)
+
+    async def main():
+        await old.emit_startup()
+        session = old_sessions[1] = Session(1)
+        session.player_name = "Student"
+        starting = asyncio.create_task(new.emit_startup())
+        await asyncio.sleep(0.2)
+        assert not starting.done()
+        await old.emit_shutdown()
+        await asyncio.wait_for(starting, 1)
+
+    asyncio.run(main())
+    assert new_sessions[1].player_name == "Student"
+
+
+def test_stopped_process_costs_no_wait(tmp_path):
+    handoff_file = str(tmp_path / "handoff.snapshot")
+    sessions = SessionStore(cold_dir=str(tmp_path))
+    sessions[1] = Session(1)
+    sessions.snapshot(handoff_file)
+    dp = Dispatcher()
+    setup_lifecycle(dp, sessions, handoff_file, handoff_wait=60)
+
+    asyncio.run(asyncio.wait_for(dp.emit_startup(), 1))
+    assert 1 in sessions
+
+
+def test_bot_drains_before_tearing_down(tmp_path, catalog):
+    import bot
+
+    dp = bot.create_dispatcher(
+        catalog=catalog, sessions=SessionStore(cold_dir=str(tmp_path))
+    )
+    bot.setup_hosting(dp, saved=())
+    hooks = [handler.callback.__name__ for handler in dp.shutdown.handlers]
+    for teardown in ("stop_broadcast", "stop_scheduler", "close_map_renderer"):
+        assert hooks.index("drain") < hooks.index(teardown)
+    assert hooks.index("hand_off") < hooks.index("close_chat_registry")
+
+
+def test_bot_resumes_sending_after_the_takeover(tmp_path, catalog):
+    import bot
+
+    dp = bot.create_dispatcher(
+        catalog=catalog, sessions=SessionStore(cold_dir=str(tmp_path))
+    )
+    bot.setup_hosting(dp, saved=())
+    hooks = [handler.callback.__name__ for handler in dp.startup.handlers]
+    for sender in ("resume_broadcast", "start_scheduler"):
+        assert hooks.index("take_over") < hooks.index(sender)
+    hooks = [handler.callback.__name__ for handler in dp.shutdown.handlers]
+    for sender in ("stop_broadcast", "stop_scheduler"):
+        assert hooks.index(sender) < hooks.index("hand_off")
+    dp["broadcaster"].registry.close()
+
+
+def test_dirty_state_is_checkpointed(tmp_path):
+    class State:
+        path = str(tmp_path / "state")
+        dirty = False
+        saves = 0
+
+        def save(self):
+            self.saves += 1
+            self.dirty = False
+
+    state = State()
+    dp = Dispatcher()
+    setup_lifecycle(
+        dp,
+        SessionStore(cold_dir=str(tmp_path)),
+        str(tmp_path / "handoff.snapshot"),
+        saved=[state],
+        checkpoint_interval=0.01,
+    )
+
+    async def main():
+        await dp.emit_startup()
+        await asyncio.sleep(0.05)
+        assert state.saves == 0
+        state.dirty = True
+        await asyncio.sleep(0.05)
+        assert state.saves == 1
+        await dp.emit_shutdown()
+
+    asyncio.run(main())
+    assert state.saves == 2
@@ -0,0 +1,38 @@
+from collections import deque
+
+from catalog import Catalog, compile_catalog
+from mapgen import OPPOSITES, generate_content, write_content
+from routing import UNREACHABLE
+
+
+def test_same_seed_gives_the_same_content():
+    assert generate_content(200, seed=3) == generate_content(200, seed=3)
+    assert (
+        generate_content(200, seed=3)["locations.json"]
+        != generate_content(200, seed=4)["locations.json"]
+    )
+
+
+def test_generated_map_is_connected_both_ways():
+    locations = generate_content(500, seed=5)["locations.json"]
+    assert sorted(locations, key=int) == [str(key) for key in range(1, 501)]
+    for key, location in locations.items():
+        for direction, target in location["connections"].items():
+            assert locations[target]["connections"][OPPOSITES[direction]] == key
+
+    seen = {"1"}
+    queue = deque(["1"])
+    while queue:
+        for target in locations[queue.popleft()]["connections"].values():
+            if target not in seen:
+                seen.add(target)
+                queue.append(target)
+    assert len(seen) == len(locations)
+
+
+def test_generated_content_compiles_and_routes_everywhere(tmp_path):
+    write_content(generate_content(300, seed=1), str(tmp_path))
+    catalog = Catalog(compile_catalog(str(tmp_path)))
+    assert len(catalog.locations) == 300
+    distances = catalog.routes.distances_from(catalog.start_location)
+    assert UNREACHABLE not in distances
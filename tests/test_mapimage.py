@@ -0,0 +1,51 @@
+import asyncio
+import os
+
+from mapimage import MapRenderer, grid_layout
+
+
+def test_grid_layout_places_every_location_once(catalog):
+    layout = grid_layout(catalog)
+    assert len(layout.positions) == len(catalog.locations)
+    assert len(set(layout.positions)) == len(layout.positions)
+    assert all(
+        0 <= x < layout.width and 0 <= y < layout.height for x, y in layout.positions
+    )
+
+
+def test_maps_are_rendered_once_then_served_from_caches(tmp_path, catalog):
+    maps = MapRenderer(str(tmp_path))
+    start = catalog.start_location
+
+    async def main():
+        first, second = await asyncio.gather(
+            maps.render(catalog, {start}, start), maps.render(catalog, {start}, start)
+        )
+        assert first == second and os.path.exists(first.path)
+        from_disk = await maps.render(catalog, {start}, start)
+        maps.remember(first.key, "file-id")
+        return from_disk, await maps.render(catalog, [start], start)
+
+    from_disk, uploaded = asyncio.run(main())
+    assert from_disk.file_id is None and uploaded.file_id == "file-id"
+    assert maps.counters == {"file_id": 1, "disk": 1, "rendered": 1}
+
+
+def test_pruning_keeps_the_maps_just_served(tmp_path, catalog):
+    maps = MapRenderer(str(tmp_path), max_files=4)
+    locations = range(len(catalog.locations))
+
+    async def main():
+        pictures = [
+            await maps.render(catalog, {0}, current) for current in locations[:4]
+        ]
+        for age, picture in enumerate(pictures):
+            os.utime(picture.path, (1000 + age, 1000 + age))
+        served = await maps.render(catalog, {0}, 0)
+        await maps.render(catalog, {0}, 4)
+        return pictures, served
+
+    pictures, served = asyncio.run(main())
+    assert served.file_id is None and os.path.exists(served.path)
+    assert not os.path.exists(pictures[1].path)
+    assert maps.stats()["files"] <= 4
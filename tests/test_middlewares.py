@@ -0,0 +1,305 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.types import CallbackQuery, InlineQuery, Update
+
+from middlewares import (
+    ConcurrencyLimiter,
+    KeyedLocks,
+    SessionPinMiddleware,
+    ThrottlingMiddleware,
+    TokenBuckets,
+    UserSerializationMiddleware,
+)
+from session import Session, SessionStore
+
+
+class Query:
+    def __init__(self, data):
+        self.data = data
+        self.answered = 0
+
+    async def answer(self, *args, **kwargs):
+        self.answered += 1
+
+
+def update(query=None):
+    return SimpleNamespace(callback_query=query)
+
+
+def test_keyed_locks_serialize_per_key_and_drop_idle_locks():
+    locks = KeyedLocks()
+    order = []
+
+    async def job(key, name, delay):
+        order.append(f"start {name}")
+        await asyncio.sleep(delay)
+        order.append(f"end {name}")
+
+    async def main():
+        await asyncio.gather(
+            locks.run(1, lambda: job(1, "a", 0.02)),
+            locks.run(1, lambda: job(1, "b", 0)),
+            locks.run(2, lambda: job(2, "c", 0)),
+        )
+
+    asyncio.run(main())
+    assert order.index("end a") < order.index("start b")
+    assert order.index("end c") < order.index("end a")
+    assert len(locks) == 0
+
+
+def test_keyed_locks_release_on_error():
+    locks = KeyedLocks()
+
+    async def fail():
+        raise RuntimeError
+
+    async def main():
+        try:
+            await locks.run(1, fail)
+        except RuntimeError:
+            pass
+        return await locks.run(1, lambda: asyncio.sleep(0, "ok"))
+
+    assert asyncio.run(main()) == "ok"
+    assert len(locks) == 0
+
+
+def test_serialization_drops_repeated_taps():
+    middleware = UserSerializationMiddleware(window=60)
+    user = SimpleNamespace(id=1)
+    calls = []
+
+    async def handler(event, data):
+        calls.append(event.callback_query.data)
+        await asyncio.sleep(0.01)
+
+    async def main():
+        taps = [Query("fight"), Query("fight"), Query("talk")]
+        await asyncio.gather(
+            *(
+                middleware(handler, update(query), {"event_from_user": user})
+                for query in taps
+            )
+        )
+        # Finished less than a window ago, so still a duplicate.
+        late = Query("fight")
+        await middleware(handler, update(late), {"event_from_user": user})
+        return taps, late
+
+    taps, late = asyncio.run(main())
+    assert calls == ["fight", "talk"]
+    assert middleware.dropped == 2
+    assert taps[1].answered == 1 and late.answered == 1
+
+
+def test_serialization_lets_repeated_taps_through_once_processed():
+    middleware = UserSerializationMiddleware()
+    user = SimpleNamespace(id=1)
+    calls = []
+
+    async def handler(event, data):
+        calls.append(event.callback_query.data)
+
+    async def main():
+        for _ in range(3):
+            await middleware(handler, update(Query("map")), {"event_from_user": user})
+
+    asyncio.run(main())
+    assert calls == ["map"] * 3
+    assert middleware.dropped == 0
+
+
+class Button(CallbackQuery):
+    async def answer(self, text=None, **kwargs):
+        self.__dict__.setdefault("answers", []).append(text)
+
+
+def flagged(**flags):
+    return {"handler": SimpleNamespace(flags=flags)}
+
+
+def test_limiter_bounds_running_handlers_by_class():
+    limiter = ConcurrencyLimiter(limit=3, class_limits={"map": 1})
+    peaks = {"all": 0, "map": 0}
+    running = {"all": 0, "map": 0}
+
+    async def handler(event, data):
+        name = data["handler"].flags.get("concurrency")
+        for key in ("all", name):
+            running[key] = running.get(key, 0) + 1
+            peaks[key] = max(peaks.get(key, 0), running[key])
+        await asyncio.sleep(0.01)
+        for key in ("all", name):
+            running[key] -= 1
+
+    async def main():
+        await asyncio.gather(
+            *(limiter(handler, None, flagged(concurrency="map")) for _ in range(4)),
+            *(limiter(handler, None, flagged(concurrency="game")) for _ in range(6)),
+        )
+
+    asyncio.run(main())
+    assert peaks["all"] == 3 and peaks["map"] == 1
+    assert limiter.stats()["max_waiting"] >= 7
+    assert limiter.running == limiter.waiting == 0
+
+
+def test_limiter_sheds_low_priority_updates_at_high_water():
+    limiter = ConcurrencyLimiter(limit=1, high_water=2, shed={"map"})
+    calls = []
+
+    async def handler(event, data):
+        calls.append(data["handler"].flags.get("concurrency", "default"))
+        await asyncio.sleep(0.01)
+
+    async def main():
+        queued = [
+            asyncio.create_task(limiter(handler, None, flagged())) for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+        assert limiter.waiting == 2
+        button = Button.model_construct(data="map")
+        await limiter(handler, button, flagged(concurrency="map"))
+        game = asyncio.create_task(limiter(handler, None, flagged(concurrency="game")))
+        await asyncio.gather(*queued, game)
+        await limiter(handler, None, flagged(concurrency="map"))
+        return button
+
+    button = asyncio.run(main())
+    assert button.answers == [limiter.text]
+    assert limiter.rejected == 1
+    assert calls == ["default"] * 3 + ["game", "map"]
+
+
+def test_token_buckets_refill_and_forget_idle_keys():
+    buckets = TokenBuckets(capacity=2, rate=1)
+    assert buckets.take(1, now=0) and buckets.take(1, now=0)
+    assert not buckets.take(1, now=0.5)
+    assert buckets.take(1, now=1.0)
+    assert not buckets.take(1, cost=2, now=2.0)
+    assert buckets.take(2, now=2.0)
+    assert len(buckets) == 2
+    buckets.get(3, now=10)
+    assert len(buckets) == 1
+    with pytest.raises(ValueError):
+        TokenBuckets(capacity=0, rate=1)
+
+
+def tap(user_id, data="fight_1"):
+    button = Button.model_construct(data=data)
+    return Update.model_construct(update_id=0, callback_query=button), button
+
+
+def test_throttling_sheds_floods_before_the_user_lock():
+    throttle = ThrottlingMiddleware(rate=0.001, burst=2)
+    serialization = UserSerializationMiddleware(window=0)
+    user = SimpleNamespace(id=1)
+    release = None
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.callback_query.data)
+        await release.wait()
+
+    async def pipeline(update):
+        return await throttle(
+            lambda event, data: serialization(handler, event, data),
+            update,
+            {"event_from_user": user},
+        )
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        taps = [tap(1, f"fight_{n}") for n in range(4)]
+        queued = [asyncio.create_task(pipeline(update)) for update, _ in taps[:2]]
+        await asyncio.sleep(0)
+        # Shed at once, instead of waiting behind the running update.
+        await asyncio.wait_for(pipeline(taps[2][0]), 0.1)
+        await asyncio.wait_for(pipeline(taps[3][0]), 0.1)
+        release.set()
+        await asyncio.gather(*queued)
+        return [button for _, button in taps]
+
+    buttons = asyncio.run(main())
+    assert handled == ["fight_0", "fight_1"]
+    assert buttons[2].answers == [throttle.text]
+    assert "answers" not in buttons[3].__dict__
+    assert throttle.stats() == {"passed": 2, "shed": 1, "ignored": 1, "buckets": 1}
+
+
+class Search(InlineQuery):
+    async def answer(self, results, **kwargs):
+        self.__dict__.setdefault("answers", []).append(results)
+
+
+def test_inline_queries_have_their_own_bucket_and_always_get_an_answer():
+    throttle = ThrottlingMiddleware(
+        rate=0.001, burst=2, inline_rate=0.001, inline_burst=3
+    )
+    user = {"event_from_user": SimpleNamespace(id=1)}
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.event)
+
+    async def main():
+        searches = [Search.model_construct(query="calc"[:n]) for n in range(1, 6)]
+        for search in searches:
+            update = Update.model_construct(update_id=0, inline_query=search)
+            await throttle(handler, update, dict(user))
+        for update, _ in (tap(1), tap(1)):
+            await throttle(handler, update, dict(user))
+        return searches
+
+    searches = asyncio.run(main())
+    assert handled[:3] == searches[:3] and len(handled) == 5
+    assert [search.__dict__.get("answers") for search in searches[3:]] == [[[]], [[]]]
+    assert throttle.stats() == {"passed": 5, "shed": 1, "ignored": 1, "buckets": 2}
+
+
+def test_throttling_charges_costly_actions_after_the_filters():
+    throttle = ThrottlingMiddleware(
+        rate=0.001, burst=8, costs={"start": 5}, action_limits={"map": 1}
+    )
+    user = {"event_from_user": SimpleNamespace(id=1)}
+    handled = []
+
+    async def handler(event, data):
+        handled.append(data["handler"].flags.get("throttle"))
+
+    async def handle(action):
+        update, button = tap(1)
+        data = {**user, **flagged(throttle=action)}
+        await throttle(lambda *_: throttle(handler, button, data), update, data)
+        return button
+
+    async def main():
+        await handle("start")
+        await handle("map")
+        return await handle("map")
+
+    button = asyncio.run(main())
+    assert handled == ["start", "map"]
+    assert button.answers == [throttle.text]
+    assert throttle._users.get(1)[0] == pytest.approx(1, abs=0.01)
+
+
+def test_session_stays_pinned_while_its_update_runs(tmp_path):
+    store = SessionStore(max_hot=1, cold_dir=str(tmp_path))
+    mine = store[1] = Session(1)
+    mine.player_name = "Aboba"
+    data = {"event_from_user": SimpleNamespace(id=1), "sessions": store}
+
+    async def handler(event, data):
+        store[2] = Session(2)
+        assert mine in store.hot_sessions()
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(SessionPinMiddleware()(handler, None, data))
+    store[3] = Session(3)
+    assert mine not in store.hot_sessions() and 1 in store
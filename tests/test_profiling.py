@@ -0,0 +1,51 @@
+import asyncio
+import os
+
+import pytest
+
+from profiling import Profiler, ProfilingMiddleware, parse_window
+
+
+def test_window_closes_after_its_updates(tmp_path):
+    profiler = Profiler(output_dir=str(tmp_path), top=3)
+    middleware = ProfilingMiddleware(profiler)
+    summaries = []
+
+    async def on_done(summary):
+        summaries.append(summary)
+
+    async def handler(event, data):
+        return sum(range(1000))
+
+    async def main():
+        await middleware(handler, None, {})
+        profiler.start(updates=2, on_done=on_done)
+        with pytest.raises(RuntimeError):
+            profiler.start()
+        for _ in range(3):
+            await middleware(handler, None, {})
+
+    asyncio.run(main())
+    assert not profiler.active
+    (summary,) = summaries
+    assert summary.startswith("Profiled 2 updates")
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_window_closes_after_its_seconds(tmp_path):
+    profiler = Profiler(output_dir=str(tmp_path))
+
+    async def main():
+        profiler.start(seconds=0.01)
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    assert not profiler.active and len(os.listdir(tmp_path)) == 1
+
+
+def test_parse_window():
+    assert parse_window("30s") == {"seconds": 30.0}
+    assert parse_window(" 100 ") == {"updates": 100}
+    for argument in ("0", "-5s", "soon", "nans", "infs", "-infs", "1e999s"):
+        with pytest.raises(ValueError):
+            parse_window(argument)
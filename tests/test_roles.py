@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import pytest
+
+import roles
+from roles import HP_REGEN_CAP, Protagonist
+from session import Session, SessionStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(roles, "time", SimpleNamespace(time=clock.time))
+    return clock
+
+
+def test_hp_regenerates_over_time_and_keeps_the_fraction(clock):
+    player = Protagonist("Student", "1")
+    player.hp = 50
+    clock.now += 599
+    assert player.hp == 50
+    clock.now += 1
+    assert player.hp == 51
+
+    clock.now += 300
+    player.hp += 1
+    assert player.hp == 52
+    # The half nerve cell regenerated before the change still counts.
+    clock.now += 300
+    assert player.hp == 53
+    player.hp -= 10
+    clock.now += 6000
+    assert player.hp == 53
+
+
+def test_hp_regenerates_up_to_the_cap_only(clock):
+    player = Protagonist("Student", "1")
+    player.hp = 90
+    clock.now += 10 * 24 * 3600
+    assert player.hp == HP_REGEN_CAP
+
+    player.hp += 20
+    clock.now += 3600
+    assert player.hp == HP_REGEN_CAP + 20
+    player.hp -= 30
+    clock.now += 600
+    assert player.hp == 91
+
+
+def test_hp_regenerates_across_a_handoff(clock, tmp_path):
+    cold_dir, snapshot = str(tmp_path / "sessions"), str(tmp_path / "handoff")
+    store = SessionStore(cold_dir=cold_dir)
+    session = store[1] = Session(1)
+    session.player_name, session.item = "Student", "Head & Shoulders"
+    session.player = Protagonist("Student", "1")
+    session.player.hp = 40
+    clock.now += 300
+    store.snapshot(snapshot)
+
+    # Restarting takes a while; the regeneration goes on meanwhile.
+    clock.now += 900
+    successor = SessionStore(cold_dir=cold_dir)
+    assert successor.restore(snapshot) == 1
+    player = successor[1].player
+    assert player.hp_updated == session.player.hp_updated and player.hp == 42
+
+
+def test_old_sessions_with_a_plain_hp_start_regenerating_on_load(clock):
+    player = Protagonist.__new__(Protagonist)
+    player.__setstate__({"id": "1", "name": "Student", "hp": 70, "level": 3})
+    assert player.hp_updated == clock.now and player.regen_rate == roles.HP_REGEN_RATE
+    assert player.hp == 70 and "hp" not in vars(player)
+    clock.now += 1200
+    assert player.hp == 72
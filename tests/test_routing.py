@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+
+import pytest
+
+from catalog import Catalog, compile_catalog
+from mapgen import generate_content, write_content
+from routing import UNREACHABLE, RoutingTable
+
+
+def line_map(size, *islands):
+    """Locations 0 - 1 - ... - size-1 in a row, plus unconnected ones."""
+    locations = []
+    for index in range(size):
+        connections = {}
+        if index > 0:
+            connections["West"] = index - 1
+        if index < size - 1:
+            connections["East"] = index + 1
+        locations.append({"id": index, "connections": connections})
+    for index in islands:
+        locations.append({"id": index, "connections": {}})
+    return locations
+
+
+def test_distances_and_paths():
+    routes = RoutingTable(line_map(5, 5))
+    assert routes.distance(0, 4) == 4
+    assert routes.distance(3, 3) == 0
+    assert routes.path(0, 3) == [1, 2, 3]
+    assert routes.path(4, 1) == [3, 2, 1]
+    assert routes.path(2, 2) == []
+    assert routes.distance(0, 5) == UNREACHABLE
+    assert routes.path(0, 5) is None
+
+
+def test_nearest_skips_unreachable():
+    routes = RoutingTable(line_map(6, 6))
+    assert routes.nearest(0, [6, 4, 2]) == (2, 2)
+    assert routes.nearest(0, [6]) is None
+    assert routes.nearest(0, []) is None
+
+
+def test_search_cache_is_bounded():
+    routes = RoutingTable(line_map(10), cache_size=2)
+    routes.distance(0, 9)
+    routes.distance(0, 5)
+    routes.distance(1, 9)
+    routes.distance(2, 9)
+    assert routes.stats()["cached"] == 2
+    assert (routes.hits, routes.misses) == (1, 3)
+    # The least recently used search was dropped and runs again.
+    routes.distance(0, 9)
+    assert routes.misses == 4
+
+
+@pytest.fixture(scope="module")
+def big_catalog(tmp_path_factory):
+    info_dir = str(tmp_path_factory.mktemp("big_map"))
+    write_content(generate_content(300, seed=1), info_dir)
+    return Catalog(compile_catalog(info_dir))
+
+
+def test_travel_pages_cover_every_location_nearest_first(big_catalog):
+    from bot import TRAVEL_PAGE, travel_page
+
+    session = SimpleNamespace(
+        player=SimpleNamespace(current_location=big_catalog.start_location)
+    )
+    seen, distances, page = [], [], 0
+    while True:
+        text, markup = travel_page(session, big_catalog, page)
+        buttons = [button for row in markup.inline_keyboard for button in row]
+        assert len(buttons) <= 100
+        destinations = [b for b in buttons if b.callback_data.startswith("goto_")]
+        assert len(destinations) <= TRAVEL_PAGE
+        seen += [int(b.callback_data[5:]) for b in destinations]
+        distances += [int(b.text.rsplit("(", 1)[1][:-1]) for b in destinations]
+        turns = [b.callback_data for b in buttons if b.text.startswith("Farther")]
+        if not turns:
+            break
+        page = int(turns[0].split("_")[1])
+    assert sorted(seen) == sorted(
+        set(range(len(big_catalog.locations))) - {big_catalog.start_location}
+    )
+    assert distances == sorted(distances)
+    assert text.endswith(f"({page + 1}/{page + 1}):")
+    # Pages past the end show the last one.
+    assert travel_page(session, big_catalog, page + 5)[0] == text
@@ -0,0 +1,166 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from middlewares import event_session
+from scheduler import LEVELS, SLOTS, DeadlineMiddleware, Scheduler, Timer, TimerWheel
+from session import Session, SessionStore
+
+
+def test_wheel_fires_timers_across_levels_in_order():
+    wheel = TimerWheel(now=0)
+    delays = [0.5, 1, 3, SLOTS - 1, SLOTS, SLOTS + 7, SLOTS**2 + 5, SLOTS**3 * 2]
+    for delay in delays:
+        wheel.add(Timer(delay, delay, "test"))
+    assert len(wheel) == len(delays)
+
+    fired = []
+    for now in range(SLOTS**3 * 2 + 1):
+        fired.extend(timer.key for timer in wheel.advance(now))
+    assert fired == delays and len(wheel) == 0
+
+
+def test_wheel_cancel_and_replace():
+    wheel = TimerWheel(now=0)
+    wheel.add(Timer("a", 10, "test"))
+    wheel.add(Timer("b", 20, "test"))
+    wheel.add(Timer("a", 30, "test"))
+    assert wheel.cancel("b").due == 20 and wheel.cancel("b") is None
+    assert "a" in wheel and wheel.get("a").due == 30
+
+    assert wheel.advance(29) == []
+    assert [timer.key for timer in wheel.advance(30)] == ["a"]
+
+
+def test_wheel_keeps_far_timers_in_overflow():
+    start = SLOTS ** (LEVELS - 1) - 2
+    far = start + SLOTS**LEVELS + 10
+    wheel = TimerWheel(now=start)
+    wheel.add(Timer("far", far, "test"))
+    for now in range(start, start + 2 * SLOTS):
+        assert wheel.advance(now) == []
+    assert wheel.advance(far - 1) == []
+    assert [timer.key for timer in wheel.advance(far)] == ["far"]
+
+
+def test_wheel_catches_up_after_a_long_pause():
+    wheel = TimerWheel(now=0)
+    for due in (5, 500, 5000, 50000):
+        wheel.add(Timer(due, due, "test"))
+    assert [timer.key for timer in wheel.advance(1000)] == [5, 500]
+    assert len(wheel) == 2
+    assert [timer.key for timer in wheel.advance(50000)] == [5000, 50000]
+
+
+def test_scheduler_fires_one_batch_per_kind():
+    scheduler = Scheduler()
+    batches = []
+
+    async def handle(timers):
+        batches.append(sorted(timer.key for timer in timers))
+
+    async def fail(timers):
+        raise RuntimeError
+
+    scheduler.register("reminder", handle)
+    scheduler.register("broken", fail)
+    now = time.time()
+    for key in range(3):
+        scheduler.schedule(key, now - 1, "reminder")
+    scheduler.schedule("x", now - 1, "broken")
+    scheduler.schedule("y", now - 1, "unknown")
+    scheduler.schedule("later", now + 3600, "reminder")
+
+    assert asyncio.run(scheduler.fire(now)) == 5
+    assert batches == [[0, 1, 2]]
+    stats = scheduler.stats()
+    assert stats["pending"] == 1 and stats["fired"] == 5
+    assert stats["batches"] == 2 and stats["errors"] == 1
+
+
+def test_scheduler_tracks_unsaved_changes(tmp_path):
+    path = str(tmp_path / "timers.snapshot")
+    scheduler = Scheduler(path)
+    assert not scheduler.dirty
+    now = time.time()
+    scheduler.schedule("a", now + 60, "test", {"quest": "Pool"})
+    scheduler.schedule("b", now + 120, "test")
+    assert scheduler.dirty
+
+    scheduler.save()
+    assert not scheduler.dirty
+    assert not scheduler.cancel("missing") and not scheduler.reschedule("missing", 0)
+    assert not scheduler.dirty
+    assert scheduler.reschedule("b", now + 30) and scheduler.dirty
+
+    scheduler.save()
+    restored = Scheduler(path)
+    # Loaded by the takeover of the lifecycle only, after the lock is held.
+    assert len(restored.wheel) == 0
+    restored.load()
+    assert not restored.dirty
+    assert {(timer.key, timer.due) for timer in restored.wheel} == {
+        ("a", now + 60),
+        ("b", now + 30),
+    }
+    assert restored.wheel.get("a").payload == {"quest": "Pool"}
+
+    restored.register("test", lambda timers: asyncio.sleep(0))
+    assert asyncio.run(restored.fire(now + 40)) == 1 and restored.dirty
+
+
+def quest_session(user_id, events):
+    session = Session(user_id)
+    session.player = SimpleNamespace(events=events)
+    return session
+
+
+def test_deadline_middleware_schedules_and_cancels_quests():
+    scheduler = Scheduler()
+    middleware = DeadlineMiddleware(scheduler, remind_before=600)
+    due = time.time() + 3600
+    session = quest_session(1, [("quest_accepted", "Pool", due)])
+    data = {"session": session}
+
+    async def handler(event, data):
+        pass
+
+    asyncio.run(middleware(handler, None, data))
+    assert scheduler.wheel.get(("quest_deadline", 1, "Pool")).payload == (
+        1,
+        "Pool",
+        due,
+    )
+    assert scheduler.wheel.get(("quest_reminder", 1, "Pool")).due == due - 600
+
+    session.player.events[:] = [("quest_accepted", "Rush", time.time() + 60)]
+    asyncio.run(middleware(handler, None, data))
+    assert ("quest_deadline", 1, "Rush") in scheduler.wheel
+    assert ("quest_reminder", 1, "Rush") not in scheduler.wheel
+
+    session.player.events[:] = [("quest_done", "Pool")]
+    asyncio.run(middleware(handler, None, data))
+    assert ("quest_deadline", 1, "Pool") not in scheduler.wheel
+    assert ("quest_reminder", 1, "Pool") not in scheduler.wheel
+
+
+def test_message_middlewares_find_the_session_in_the_store(tmp_path):
+    store = SessionStore(cold_dir=str(tmp_path))
+    session = store[1] = quest_session(1, [("quest_accepted", "Pool", time.time())])
+    user = SimpleNamespace(id=1)
+    assert event_session({"event_from_user": user, "sessions": store}) is session
+    assert event_session({"session": session}) is session
+
+    misses = store.stats()["misses"]
+    stranger = SimpleNamespace(id=2)
+    assert event_session({"event_from_user": stranger, "sessions": store}) is None
+    assert store.stats()["misses"] == misses
+
+    scheduler = Scheduler()
+
+    async def handler(event, data):
+        pass
+
+    data = {"event_from_user": user, "sessions": store}
+    asyncio.run(DeadlineMiddleware(scheduler)(handler, None, data))
+    assert ("quest_deadline", 1, "Pool") in scheduler.wheel
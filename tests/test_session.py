@@ -0,0 +1,89 @@
+import os
+
+from session import SESSION_BYTES, Session, SessionStore
+
+
+def chosen(user_id):
+    session = Session(user_id)
+    session.player_name = "Student"
+    return session
+
+
+def test_least_recently_used_sessions_move_to_disk(tmp_path):
+    store = SessionStore(max_hot=2, cold_dir=str(tmp_path))
+    for user_id in (1, 2, 3):
+        store[user_id] = chosen(user_id)
+    assert store.stats()["hot"] == 2 and store.stats()["cold"] == 1
+    assert os.path.exists(tmp_path / "1.session")
+
+    assert store[1].player_name == "Student"
+    assert store.stats()["cold_hits"] == 1
+    assert not os.path.exists(tmp_path / "1.session")
+    assert len(store) == 3
+
+
+def test_empty_and_pinned_sessions_are_not_written(tmp_path):
+    store = SessionStore(max_hot=1, cold_dir=str(tmp_path))
+    store[1] = Session(1)
+    store[2] = chosen(2)
+    assert 1 not in store
+
+    store.pin(2)
+    store[3] = chosen(3)
+    assert [session.user_id for session in store.hot_sessions()] == [2]
+    store.unpin(2)
+    store.get(3)
+    assert [session.user_id for session in store.hot_sessions()] == [3]
+    assert 2 in store
+
+
+def test_idle_sessions_expire(tmp_path):
+    store = SessionStore(ttl=0, cold_dir=str(tmp_path))
+    store[1] = chosen(1)
+    store.get(2)
+    assert store.stats()["hot"] == 0 and 1 in store
+
+
+def test_byte_budget_applies_before_any_demotion(tmp_path):
+    store = SessionStore(max_bytes=3 * SESSION_BYTES, cold_dir=str(tmp_path))
+    for user_id in range(5):
+        store[user_id] = chosen(user_id)
+    assert store.stats()["hot"] == 3
+    assert store.hot_bytes <= 3 * SESSION_BYTES
+
+
+def test_byte_budget_follows_measured_sizes(tmp_path):
+    store = SessionStore(
+        max_bytes=10_000, cold_dir=str(tmp_path), measure=lambda session: 1000
+    )
+    for user_id in range(20):
+        store[user_id] = chosen(user_id)
+    assert store.stats()["hot"] == 10
+    assert store.hot_bytes == 10_000
+
+
+def test_unreadable_cold_session_is_dropped(tmp_path):
+    store = SessionStore(max_hot=1, cold_dir=str(tmp_path))
+    store[1] = chosen(1)
+    store[2] = chosen(2)
+    (tmp_path / "1.session").write_bytes(b"not a session")
+
+    assert store.get(1) is None
+    assert 1 not in store
+    assert not os.path.exists(tmp_path / "1.session")
+    store[1] = chosen(1)
+    assert store[1].player_name == "Student"
+
+
+def test_snapshot_restores_hot_and_cold_sessions(tmp_path):
+    cold_dir = str(tmp_path / "sessions")
+    snapshot = str(tmp_path / "handoff")
+    store = SessionStore(max_hot=1, cold_dir=cold_dir)
+    store[1] = chosen(1)
+    store[2] = chosen(2)
+    assert store.snapshot(snapshot) == 1
+
+    successor = SessionStore(cold_dir=cold_dir)
+    assert successor.restore(snapshot) == 1
+    assert successor[1].user_id == 1 and successor[2].user_id == 2
+    assert not os.path.exists(snapshot)
@@ -0,0 +1,87 @@
+import asyncio
+from types import SimpleNamespace
+
+from session import Session, SessionStore
+from stats import GameStats, RingCounter, StatsMiddleware
+
+
+def test_ring_counter_forgets_old_buckets():
+    counter = RingCounter(slots=3, width=10)
+    counter.add("moves", now=0)
+    counter.add("moves", 2, now=15)
+    counter.add("games", now=25)
+    assert counter.total(now=29) == {"moves": 3, "games": 1}
+    assert counter.total(now=35) == {"moves": 2, "games": 1}
+    counter.add("moves", now=45)
+    assert counter.total(now=45) == {"moves": 1, "games": 1}
+    assert counter.total(now=100) == {}
+
+
+def test_game_stats_count_games_and_events():
+    stats = GameStats()
+    stats.game_started()
+    stats.game_started()
+    stats.record_events([("level", 1, 2), ("project_failed", "Pool"), ("expelled",)])
+    stats.game_ended(2, "expelled")
+    stats.visited("Kazan")
+
+    assert stats.active == 1
+    assert +stats.levels == {1: 1}
+    assert stats.totals["games_started"] == 2 and stats.totals["expulsions"] == 1
+    assert stats.last_hour.total()["projects_failed"] == 1
+    report = stats.report()
+    assert "Active games: 1" in report and "Pool: 1" in report
+
+
+def game(user_id, level):
+    session = Session(user_id)
+    session.player = SimpleNamespace(level=level)
+    return session
+
+
+def test_idle_games_stop_counting_as_active(tmp_path):
+    stats = GameStats()
+    store = SessionStore(ttl=60, cold_dir=str(tmp_path))
+    store.on_demote = stats.session_demoted
+    store.on_promote = stats.session_promoted
+    for user_id in (1, 2):
+        store[user_id] = game(user_id, level=3)
+        stats.game_started(3)
+
+    store.ttl = 0
+    store.get(3)
+    assert stats.active == 0 and stats.levels[3] == 0
+
+    store.ttl = 60
+    store.get(1)
+    assert stats.active == 1 and stats.levels[3] == 1
+
+
+def test_saved_stats_keep_counters_but_not_gauges(tmp_path):
+    path = str(tmp_path / "stats.snapshot")
+    stats = GameStats(path)
+    stats.game_started()
+    assert stats.dirty
+    stats.save()
+    assert not stats.dirty
+
+    reloaded = GameStats(path)
+    assert reloaded.totals["games_started"] == 1
+    assert reloaded.last_day.total()["games_started"] == 1
+    assert reloaded.active == 0 and not reloaded.dirty
+
+
+def test_middleware_counts_the_events_of_an_update_once():
+    stats = GameStats()
+    session = game(1, level=2)
+    session.player.events = [("project_passed", "Pool")]
+    data = {"session": session}
+
+    async def handler(event, data):
+        session.player.events.append(("quest_done", "Rush"))
+
+    asyncio.run(StatsMiddleware(stats)(handler, None, data))
+    assert session.player.events == []
+    asyncio.run(StatsMiddleware(stats)(handler, None, data))
+    assert stats.totals["projects_passed"] == 1
+    assert stats.totals["quests_done"] == 2
@@ -0,0 +1,104 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from tracing import (
+    DispatchSpanMiddleware,
+    HandlerSpanMiddleware,
+    Tracer,
+    TracingMiddleware,
+    span,
+)
+
+
+def update(update_id):
+    return SimpleNamespace(update_id=update_id, event_type="callback_query")
+
+
+def read_spans(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file]
+
+
+def test_update_spans_are_exported_as_one_trace(tmp_path):
+    tracer = Tracer(str(tmp_path / "traces.jsonl"))
+
+    async def show_map(event, data):
+        with span("render", size=3):
+            pass
+
+    async def dispatch(event, data):
+        data["handler"] = SimpleNamespace(callback=show_map)
+        return await HandlerSpanMiddleware()(show_map, event, data)
+
+    async def route(event, data):
+        return await DispatchSpanMiddleware()(dispatch, event, data)
+
+    data = {"event_from_user": SimpleNamespace(id=7)}
+    asyncio.run(TracingMiddleware(tracer)(route, update(1), data))
+    tracer.close()
+
+    spans = read_spans(tracer.path)
+    assert [record["name"] for record in spans] == [
+        "update",
+        "dispatch",
+        "filters",
+        "handler",
+        "render",
+    ]
+    assert len({record["trace"] for record in spans}) == 1
+    by_name = {record["name"]: record for record in spans}
+    assert by_name["update"]["attrs"] == {
+        "update_id": 1,
+        "type": "callback_query",
+        "user": 7,
+        "handler": "show_map",
+    }
+    assert by_name["render"]["parent"] == by_name["handler"]["span"]
+    assert all(record["ms"] is not None for record in spans)
+
+
+def test_failed_and_unsampled_updates(tmp_path):
+    tracer = Tracer(str(tmp_path / "traces.jsonl"))
+
+    async def fail(event, data):
+        raise KeyError
+
+    with pytest.raises(KeyError):
+        asyncio.run(TracingMiddleware(tracer)(fail, update(1), {}))
+    tracer.sample = 0.0
+    with pytest.raises(KeyError):
+        asyncio.run(TracingMiddleware(tracer)(fail, update(2), {}))
+    tracer.close()
+
+    (root,) = read_spans(tracer.path)
+    assert root["attrs"]["error"] == "KeyError" and root["attrs"]["user"] is None
+    assert tracer.exported == 1
+
+
+def test_tasks_spawned_by_a_handler_do_not_extend_its_trace(tmp_path):
+    tracer = Tracer(str(tmp_path / "traces.jsonl"))
+    later = []
+
+    async def background():
+        await asyncio.sleep(0.01)
+        with span("api", method="SendMessage") as child:
+            later.append(child)
+
+    async def handler(event, data):
+        with span("handler"):
+            later.append(asyncio.create_task(background()))
+
+    async def main():
+        await TracingMiddleware(tracer)(handler, update(1), {})
+        await later[0]
+
+    asyncio.run(main())
+    tracer.close()
+    assert later[1] is None
+    assert [record["name"] for record in read_spans(tracer.path)] == [
+        "update",
+        "handler",
+    ]
@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError
+from aiogram.methods import GetUpdates, SendMessage
+
+from transport import CircuitBreaker, CircuitOpenError, PooledSession
+
+SEND = SendMessage(chat_id=1, text="hi")
+
+
+def test_breaker_opens_and_lets_one_trial_through():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.opened == 1
+
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    assert breaker.allow(trial=False)
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.opened == 2
+
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow() and breaker.allow()
+
+
+def session_failing_with(*errors):
+    session = PooledSession(
+        retries=0, breaker=CircuitBreaker(threshold=1, reset_timeout=0)
+    )
+    outcomes = list(errors)
+
+    async def request(bot, method, timeout):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        if callable(outcome):
+            return await outcome()
+        return outcome
+
+    session._request = request
+    return session
+
+
+def network_error(method, cause=None):
+    error = TelegramNetworkError(method=method, message="down")
+    error.__cause__ = cause
+    return error
+
+
+@pytest.mark.parametrize(
+    "trial_error",
+    [
+        TelegramBadRequest(method=SEND, message="Bad Request: chat not found"),
+        asyncio.CancelledError(),
+    ],
+)
+def test_trial_without_network_failure_does_not_wedge_the_breaker(trial_error):
+    session = session_failing_with(network_error(SEND), trial_error, True)
+
+    async def main():
+        with pytest.raises(TelegramNetworkError):
+            await session.make_request(None, SEND)
+        assert session.breaker.state == "open"
+        with pytest.raises(type(trial_error)):
+            await session.make_request(None, SEND)
+        return await session.make_request(None, SEND)
+
+    assert asyncio.run(main()) is True
+    assert session.breaker.state == "closed"
+
+
+def test_bad_requests_count_as_success():
+    session = session_failing_with(
+        *(TelegramBadRequest(method=SEND, message="Bad Request") for _ in range(3))
+    )
+
+    async def main():
+        for _ in range(3):
+            with pytest.raises(TelegramBadRequest):
+                await session.make_request(None, SEND)
+
+    asyncio.run(main())
+    assert session.breaker.state == "closed"
+
+
+def test_long_poll_timeouts_are_not_failures():
+    poll = GetUpdates(timeout=10)
+    session = session_failing_with(
+        *(network_error(poll, asyncio.TimeoutError()) for _ in range(3))
+    )
+
+    async def main():
+        for _ in range(3):
+            with pytest.raises(TelegramNetworkError):
+                await session.make_request(None, poll)
+
+    asyncio.run(main())
+    assert session.breaker.state == "closed"
+
+
+def test_long_poll_does_not_take_the_trial():
+    poll = GetUpdates(timeout=10)
+    release = None
+
+    async def long_poll():
+        await release.wait()
+        return []
+
+    session = session_failing_with(network_error(SEND), long_poll, True)
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        with pytest.raises(TelegramNetworkError):
+            await session.make_request(None, SEND)
+        polling = asyncio.create_task(session.make_request(None, poll))
+        await asyncio.sleep(0)
+        assert session.breaker.state == "half_open"
+        assert await session.make_request(None, SEND) is True
+        release.set()
+        return await polling
+
+    assert asyncio.run(main()) == []
+    assert session.breaker.state == "closed"
+
+
+def test_open_breaker_rejects_calls():
+    session = session_failing_with(network_error(SEND))
+    session.breaker.reset_timeout = 60
+
+    async def main():
+        with pytest.raises(TelegramNetworkError):
+            await session.make_request(None, SEND)
+        with pytest.raises(CircuitOpenError):
+            await session.make_request(None, SEND)
+
+    asyncio.run(main())
+    assert session.counters["rejected"] == 1
@@ -0,0 +1,450 @@
+"""
+Module for per-update tracing with span timings.
+
+Every traced update gets a trace ID and a root ``update`` span. Nested spans
+are opened around the stages of its processing:
+
+- ``dispatch``: routing of the update, from the first filter to the end of the handler;
+- ``filters``: filter matching, until the handler is chosen;
+- ``handler``: the handler itself, tagged with its name;
+- ``session``: session lookups;
+- ``game``: game logic in :mod:`roles`;
+- ``keyboard``: building of inline keyboards;
+- ``api``: each outbound Bot API call, tagged with the method.
+
+The current span is kept in a context variable, so :func:`span` can be used
+anywhere in the code of a handler. Outside of a traced update it does nothing,
+and so does it in a task spawned by a handler that outlives the update: the
+task inherits the context, but the trace was already exported.
+
+When the root span ends, all spans of the trace are written at once to a
+rotating JSONL file, one span per line. The file can be aggregated offline
+into per-stage percentiles with::
+
+    python3 tracing.py aggregate traces.jsonl
+"""
+
+import argparse
+import contextlib
+import contextvars
+import glob
+import json
+import logging
+import math
+import os
+import random
+import time
+from logging.handlers import RotatingFileHandler
+from typing import Any, Dict, Iterator, List, Optional
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+
+from middlewares import Handler
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class Span:
+    """
+    One timed stage of a trace.
+
+    Attributes
+    ----------
+    trace : Trace
+        The trace the span belongs to.
+    span_id : int
+        ID of the span, unique within the trace.
+    parent_id : int or None
+        ID of the enclosing span, None for the root span.
+    name : str
+        Name of the stage.
+    start : float
+        Wall-clock start time, in seconds since the epoch.
+    duration : float or None
+        Duration in seconds, None while the span is open.
+    attrs : dict
+        Extra attributes, e.g. the handler name or the API method.
+    """
+
+    __slots__ = (
+        "trace",
+        "span_id",
+        "parent_id",
+        "name",
+        "start",
+        "duration",
+        "attrs",
+        "_started",
+    )
+
+    def __init__(
+        self,
+        trace: "Trace",
+        name: str,
+        parent_id: Optional[int],
+        attrs: Dict[str, Any],
+        started: Optional[float] = None,
+    ):
+        self.trace = trace
+        self.span_id = len(trace.spans)
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self._started = time.perf_counter() if started is None else started
+        self.start = trace.start + (self._started - trace.started)
+        self.duration: Optional[float] = None
+        trace.spans.append(self)
+
+    def finish(self) -> None:
+        """
+        Close the span; closing the root span exports the whole trace.
+        """
+        self.duration = time.perf_counter() - self._started
+        if self.parent_id is None:
+            self.trace.finished = True
+            self.trace.tracer.export(self.trace)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        The span as one JSONL record.
+        """
+        return {
+            "trace": self.trace.trace_id,
+            "span": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "ms": None if self.duration is None else round(self.duration * 1000, 3),
+            "attrs": self.attrs,
+        }
+
+
+class Trace:
+    """
+    The spans of one update.
+
+    Attributes
+    ----------
+    tracer : Tracer
+        Where the trace is exported.
+    trace_id : str
+        Random hexadecimal ID of the trace.
+    spans : List[Span]
+        Spans in the order they were opened.
+    finished : bool
+        Whether the root span ended and the trace was exported.
+    """
+
+    def __init__(self, tracer: "Tracer"):
+        self.tracer = tracer
+        self.trace_id = os.urandom(8).hex()
+        self.spans: List[Span] = []
+        self.finished = False
+        self.start = time.time()
+        self.started = time.perf_counter()
+
+
+class Tracer:
+    """
+    Samples updates for tracing and writes their spans to a rotating JSONL file.
+
+    Attributes
+    ----------
+    path : str
+        The JSONL file; rotated files get ``.1``, ``.2``... suffixes.
+    sample : float
+        Share of updates that are traced, from 0 to 1.
+    exported : int
+        Number of traces written so far.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 5,
+        sample: float = 1.0,
+    ):
+        """
+        Parameters
+        ----------
+        path : str
+            The JSONL file.
+        max_bytes : int
+            Size at which the file is rotated.
+        backup_count : int
+            Number of rotated files kept.
+        sample : float
+            Share of updates that are traced, from 0 to 1.
+        """
+        self.path = path
+        self.sample = sample
+        self.exported = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._handler = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, delay=True
+        )
+
+    def start_trace(self, **attrs) -> Optional[Span]:
+        """
+        Open the root span of a new trace, unless the update is not sampled.
+
+        Returns
+        -------
+        Span or None
+            The root span.
+        """
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return None
+        return Span(Trace(self), "update", None, attrs)
+
+    def export(self, trace: Trace) -> None:
+        """
+        Write all spans of a finished trace as one block of JSONL lines.
+
+        The spans are written together, so a rotation never splits a trace.
+        """
+        lines = "\n".join(
+            json.dumps(span.to_dict(), ensure_ascii=False) for span in trace.spans
+        )
+        self._handler.handle(logging.makeLogRecord({"msg": lines}))
+        self.exported += 1
+
+    def close(self) -> None:
+        """
+        Flush and close the JSONL file.
+        """
+        self._handler.close()
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """
+    Time a stage of the current trace.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    **attrs
+        Extra attributes of the span.
+
+    Yields
+    ------
+    Span or None
+        The new span, or None outside of a traced update or after it ended.
+    """
+    parent = _current_span.get()
+    if parent is None or parent.trace.finished:
+        yield None
+        return
+    child = Span(parent.trace, name, parent.span_id, attrs)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as error:
+        child.attrs["error"] = type(error).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        child.finish()
+
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Opens the root span of each sampled update.
+    """
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+
+    async def __call__(
+        self, handler: Handler, event: Update, data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        root = self.tracer.start_trace(
+            update_id=event.update_id,
+            type=event.event_type,
+            user=user.id if user else None,
+        )
+        if root is None:
+            return await handler(event, data)
+        token = _current_span.set(root)
+        try:
+            return await handler(event, data)
+        except BaseException as error:
+            root.attrs["error"] = type(error).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            root.finish()
+
+
+class DispatchSpanMiddleware(BaseMiddleware):
+    """
+    Outer observer middleware: times routing from the first filter to the end of the handler.
+    """
+
+    async def __call__(
+        self, handler: Handler, event: TelegramObject, data: Dict[str, Any]
+    ) -> Any:
+        with span("dispatch"):
+            return await handler(event, data)
+
+
+class HandlerSpanMiddleware(BaseMiddleware):
+    """
+    Inner observer middleware: records the filter matching that led to the
+    handler, then times the handler itself.
+    """
+
+    async def __call__(
+        self, handler: Handler, event: TelegramObject, data: Dict[str, Any]
+    ) -> Any:
+        dispatch = _current_span.get()
+        if dispatch is None:
+            return await handler(event, data)
+        Span(
+            dispatch.trace, "filters", dispatch.span_id, {}, dispatch._started
+        ).finish()
+        name = data["handler"].callback.__name__
+        dispatch.trace.spans[0].attrs["handler"] = name
+        with span("handler", handler=name):
+            return await handler(event, data)
+
+
+class ApiSpanMiddleware(BaseRequestMiddleware):
+    """
+    Bot request middleware: times each outbound Bot API call.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        with span("api", method=type(method).__name__):
+            return await make_request(bot, method)
+
+
+def setup_tracing(
+    dp: Dispatcher, tracer: Tracer, observers=("message", "callback_query")
+) -> None:
+    """
+    Register the tracing middlewares on a dispatcher.
+
+    The root span middleware should be registered early among the outer update
+    middlewares, so that waiting for the per-user lock is part of the trace.
+    Outbound calls are timed by :class:`ApiSpanMiddleware` on the bot session.
+
+    Parameters
+    ----------
+    dp : Dispatcher
+        The dispatcher to trace.
+    tracer : Tracer
+        Where the traces are written.
+    observers : tuple
+        Observers whose filters and handlers get spans.
+    """
+    dp.update.outer_middleware(TracingMiddleware(tracer))
+    for observer in observers:
+        dp.observers[observer].outer_middleware(DispatchSpanMiddleware())
+        dp.observers[observer].middleware(HandlerSpanMiddleware())
+
+    async def close_tracer():
+        tracer.close()
+
+    dp.shutdown.register(close_tracer)
+
+
+def percentile(values: List[float], share: float) -> float:
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    return values[max(0, math.ceil(share * len(values)) - 1)]
+
+
+def aggregate(
+    paths: List[str], handler: Optional[str] = None
+) -> Dict[str, Dict[str, float]]:
+    """
+    Compute per-stage latency percentiles from JSONL trace files.
+
+    Parameters
+    ----------
+    paths : List[str]
+        Trace files, e.g. the current file and its rotated backups.
+    handler : str, optional
+        Only count the traces of this handler.
+
+    Returns
+    -------
+    dict
+        For every span name: count, p50, p90, p99 and max, in milliseconds.
+    """
+    durations: Dict[str, List[float]] = {}
+    traces: Dict[str, List[Dict[str, Any]]] = {}
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    traces.setdefault(record["trace"], []).append(record)
+
+    for spans in traces.values():
+        root = next((record for record in spans if record["parent"] is None), None)
+        if root is None:
+            continue
+        if handler is not None and root["attrs"].get("handler") != handler:
+            continue
+        for record in spans:
+            if record["ms"] is not None:
+                durations.setdefault(record["name"], []).append(record["ms"])
+
+    result = {}
+    for name, values in durations.items():
+        values.sort()
+        result[name] = {
+            "count": len(values),
+            "p50": percentile(values, 0.5),
+            "p90": percentile(values, 0.9),
+            "p99": percentile(values, 0.99),
+            "max": values[-1],
+        }
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    aggregate_parser = subparsers.add_parser(
+        "aggregate", help="Per-stage latency percentiles of trace files."
+    )
+    aggregate_parser.add_argument(
+        "path", help="Trace file; its rotated backups are included too."
+    )
+    aggregate_parser.add_argument("--handler", help="Only traces of this handler.")
+    aggregate_parser.add_argument(
+        "--json", action="store_true", help="Print the result as JSON."
+    )
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(glob.escape(args.path) + ".*"), reverse=True)
+    paths = [path for path in paths if path[len(args.path) + 1 :].isdigit()]
+    paths.append(args.path)
+    result = aggregate(paths, args.handler)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"{'stage':<10} {'count':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    for name, row in sorted(result.items(), key=lambda item: -item[1]["p50"]):
+        print(
+            f"{name:<10} {row['count']:>7} {row['p50']:>9.3f} {row['p90']:>9.3f}"
+            f" {row['p99']:>9.3f} {row['max']:>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
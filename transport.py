@@ -0,0 +1,366 @@
+"""
+Module with a tuned HTTP transport for the Telegram Bot API.
+
+:class:`PooledSession` is a drop-in aiogram session that keeps a bounded pool
+of keep-alive connections, applies separate connect and read timeouts, retries
+failed calls with jittered exponential backoff and stops calling a degraded API
+for a while with a :class:`CircuitBreaker`. It counts how often a pooled
+connection is reused instead of opened, since connection churn shows up as
+tail latency on outbound messages.
+
+The transport can be exercised against the local stand-in server of
+:mod:`stub_api`.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Dict, Optional
+
+from aiohttp import (
+    ClientConnectorError,
+    ClientError,
+    ClientSession,
+    ClientTimeout,
+    TraceConfig,
+)
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+from aiogram import Bot, __version__
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.methods import GetUpdates, TelegramMethod
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(TelegramNetworkError):
+    """
+    Raised instead of calling the API while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing API and lets a single trial call through later.
+
+    After ``threshold`` consecutive failures the breaker opens and every call
+    is rejected for ``reset_timeout`` seconds. Then it is half-open: one trial
+    call is allowed, and its outcome closes the breaker or opens it again. A
+    trial call that ends without an outcome, e.g. because it was cancelled,
+    must give the trial back with :meth:`release`.
+
+    Attributes
+    ----------
+    threshold : int
+        Consecutive failures that open the breaker.
+    reset_timeout : float
+        Seconds the breaker stays open.
+    state : str
+        ``"closed"``, ``"open"`` or ``"half_open"``.
+    opened : int
+        Number of times the breaker opened.
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        Parameters
+        ----------
+        threshold : int
+            Consecutive failures that open the breaker.
+        reset_timeout : float
+            Seconds the breaker stays open.
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.opened = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+
+    def allow(self, trial: bool = True) -> bool:
+        """
+        Whether a call may be made now.
+
+        Parameters
+        ----------
+        trial : bool
+            Whether the call may be the trial of a half-open breaker; calls
+            that may take long, such as long polls, are let through half-open
+            breakers without taking the trial.
+
+        Returns
+        -------
+        bool
+            True if the call may be made; a half-open breaker then counts it
+            as its trial if ``trial`` is set.
+        """
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self._trial_running = False
+        if not trial:
+            return True
+        if self._trial_running:
+            return False
+        self._trial_running = True
+        return True
+
+    def release(self) -> None:
+        """
+        Give back the trial of a half-open breaker after a call without an outcome.
+        """
+        self._trial_running = False
+
+    def record_success(self) -> None:
+        """
+        Note a successful call; closes the breaker.
+        """
+        if self.state != "closed":
+            logger.info("Bot API recovered, circuit closed.")
+        self.state = "closed"
+        self._failures = 0
+        self._trial_running = False
+
+    def record_failure(self) -> None:
+        """
+        Note a failed call; opens the breaker after too many of them.
+        """
+        self._failures += 1
+        self._trial_running = False
+        if self.state == "half_open" or self._failures >= self.threshold:
+            if self.state != "open":
+                self.opened += 1
+                logger.warning(
+                    f"Bot API failing, circuit opened for {self.reset_timeout}s."
+                )
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+class PooledSession(AiohttpSession):
+    """
+    aiogram session with a tuned connection pool, timeouts, retries and a circuit breaker.
+
+    Calls that fail with a network error or a 5xx response are retried up to
+    ``retries`` times, waiting a random time up to ``backoff * 2 ** attempt``
+    seconds (capped at ``max_backoff``) between attempts. Read timeouts and
+    dropped connections are retried only for read-only ``get*`` methods, since
+    a message may already have been sent. Flood control errors are retried after
+    the wait the API asks for, if it is short enough. ``getUpdates`` is never
+    retried here, as the dispatcher has its own backoff for polling.
+
+    Any response of the API, including a 4xx error, counts as a success for the
+    circuit breaker; only network errors and 5xx responses count as failures.
+    ``getUpdates`` never takes the trial of a half-open breaker, since a long
+    poll holds it for its whole timeout, and its timeouts are not failures.
+
+    Attributes
+    ----------
+    counters : Dict[str, int]
+        Requests, retries, failures, rejected calls and connections created and reused.
+    breaker : CircuitBreaker
+        The circuit breaker of the API.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 100,
+        pool_size_per_host: int = 0,
+        keepalive_timeout: float = 60.0,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 30.0,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 10.0,
+        breaker: Optional[CircuitBreaker] = None,
+        **kwargs: Any,
+    ):
+        """
+        Parameters
+        ----------
+        pool_size : int
+            Maximum number of open connections.
+        pool_size_per_host : int
+            Maximum number of open connections to one host; 0 for no limit.
+        keepalive_timeout : float
+            Seconds an idle connection is kept in the pool.
+        connect_timeout : float
+            Seconds to wait for a connection, from the pool or a new one.
+        read_timeout : float
+            Seconds to wait for each read of the response.
+        retries : int
+            Maximum number of retries of a failed call.
+        backoff : float
+            Base of the exponential backoff, in seconds.
+        max_backoff : float
+            Maximum backoff, in seconds; longer flood waits are not retried.
+        breaker : CircuitBreaker, optional
+            The circuit breaker; a default one is created if not given.
+        **kwargs
+            Passed on to :class:`aiogram.client.session.aiohttp.AiohttpSession`,
+            e.g. ``api`` or ``timeout`` (the total timeout of a call).
+        """
+        super().__init__(limit=pool_size, **kwargs)
+        self._connector_init.update(
+            limit_per_host=pool_size_per_host, keepalive_timeout=keepalive_timeout
+        )
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.counters: Dict[str, int] = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "rejected": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+        }
+
+    async def create_session(self) -> ClientSession:
+        if self._should_reset_connector:
+            await self.close()
+        if self._session is None or self._session.closed:
+            trace_config = TraceConfig()
+            trace_config.on_connection_create_end.append(
+                self._count("connections_created")
+            )
+            trace_config.on_connection_reuseconn.append(
+                self._count("connections_reused")
+            )
+            self._session = ClientSession(
+                connector=self._connector_type(**self._connector_init),
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{__version__}"},
+                trace_configs=[trace_config],
+            )
+            self._should_reset_connector = False
+        return self._session
+
+    def _count(self, name: str):
+        async def count(*args):
+            self.counters[name] += 1
+
+        return count
+
+    def _timeout(self, timeout: Optional[float]) -> ClientTimeout:
+        if timeout is not None:
+            # An explicit timeout, e.g. of a long poll, replaces the read timeout.
+            return ClientTimeout(total=timeout, connect=self.connect_timeout)
+        return ClientTimeout(
+            total=self.timeout,
+            connect=self.connect_timeout,
+            sock_read=self.read_timeout,
+        )
+
+    def _retry_delay(self, error: Exception, method: TelegramMethod, attempt: int):
+        if attempt >= self.retries or isinstance(method, GetUpdates):
+            return None
+        if isinstance(error, TelegramRetryAfter):
+            return error.retry_after if error.retry_after <= self.max_backoff else None
+        if isinstance(error, TelegramNetworkError) and not (
+            isinstance(error.__cause__, ClientConnectorError)
+            or method.__api_method__.startswith("get")
+        ):
+            return None
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    async def make_request(
+        self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None
+    ) -> Any:
+        polling = isinstance(method, GetUpdates)
+        attempt = 0
+        while True:
+            if not self.breaker.allow(trial=not polling):
+                self.counters["rejected"] += 1
+                raise CircuitOpenError(
+                    method=method, message="Bot API circuit breaker is open"
+                )
+            trial = not polling and self.breaker.state == "half_open"
+            self.counters["requests"] += 1
+            try:
+                result = await self._request(bot, method, timeout)
+            except (TelegramNetworkError, TelegramServerError) as error:
+                if not (polling and isinstance(error.__cause__, asyncio.TimeoutError)):
+                    self.breaker.record_failure()
+                delay = self._retry_delay(error, method, attempt)
+                if delay is None:
+                    self.counters["failures"] += 1
+                    raise
+            except TelegramRetryAfter as error:
+                self.breaker.record_success()
+                delay = self._retry_delay(error, method, attempt)
+                if delay is None:
+                    self.counters["failures"] += 1
+                    raise
+            except TelegramAPIError:
+                # A 4xx response: the API works and rejected the call itself.
+                self.breaker.record_success()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+            finally:
+                if trial:
+                    self.breaker.release()
+            attempt += 1
+            self.counters["retries"] += 1
+            logger.debug(
+                f"Retrying {method.__api_method__} in {delay:.2f}s (attempt {attempt})."
+            )
+            await asyncio.sleep(delay)
+
+    async def _request(
+        self, bot: Bot, method: TelegramMethod, timeout: Optional[int]
+    ) -> Any:
+        session = await self.create_session()
+        url = self.api.api_url(token=bot.token, method=method.__api_method__)
+        form = self.build_form_data(bot=bot, method=method)
+        try:
+            async with session.post(
+                url, data=form, timeout=self._timeout(timeout)
+            ) as response:
+                raw_result = await response.text()
+        except asyncio.TimeoutError as error:
+            raise TelegramNetworkError(
+                method=method, message="Request timeout error"
+            ) from error
+        except ClientError as error:
+            raise TelegramNetworkError(
+                method=method, message=f"{type(error).__name__}: {error}"
+            ) from error
+        response = self.check_response(
+            bot=bot, method=method, status_code=response.status, content=raw_result
+        )
+        return response.result
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Request counters, the state of the circuit breaker and the connection reuse rate.
+
+        Returns
+        -------
+        dict
+            The counters plus ``breaker``, ``breaker_opened`` and ``reuse_rate``.
+        """
+        used = (
+            self.counters["connections_created"] + self.counters["connections_reused"]
+        )
+        return {
+            **self.counters,
+            "breaker": self.breaker.state,
+            "breaker_opened": self.breaker.opened,
+            "reuse_rate": self.counters["connections_reused"] / used if used else 0.0,
+        }